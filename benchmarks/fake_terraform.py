@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stand-in of the terraform binary for the benchmarks.
+
+It understands the commands run by the plugin and is configured with environment variables:
+  FAKE_TF_LINES            number of lines printed by plan, apply and destroy (default 100)
+  FAKE_TF_LINE_SIZE        size of each line in characters (default 80)
+  FAKE_TF_RATE             lines per second, 0 for as fast as possible (default 0)
+  FAKE_TF_STDERR_RATIO     one line out of N is printed on stderr, 0 for none (default 0)
+  FAKE_TF_EXIT             exit code of plan, apply and destroy (default 0)
+  FAKE_TF_STATE_RESOURCES  number of resources of the terraform.tfstate file
+                           written by apply (default 0, no state written)
+  FAKE_TF_STATE_INSTANCES  number of instances of each resource (default 1)
+"""
+
+import json
+import os
+import sys
+import time
+import uuid
+
+
+def _env(name, default):
+    return int(os.environ.get(name, default))
+
+
+def write_state(file_path, resources, instances=1):
+    """
+    write a synthetic state file
+    :param file_path: path of the state file
+    :param resources: number of resources
+    :param instances: number of instances of each resource
+    """
+    with open(file_path, 'w') as f:
+        f.write('{"version": 4, "terraform_version": "1.6.0", "serial": %d, "lineage": "%s", ' % (int(time.time()), uuid.uuid4()))
+        f.write('"outputs": {"name": {"value": "bench", "type": "string"}}, "resources": [')
+        for r in range(resources):
+            if r > 0:
+                f.write(', ')
+            f.write(json.dumps({
+                'mode': 'managed',
+                'type': 'azurerm_resource_group',
+                'name': 'rg{0}'.format(r),
+                'provider': 'provider["registry.terraform.io/hashicorp/azurerm"]',
+                'each': 'list' if instances > 1 else None,
+                'instances': [{
+                    'index_key': i if instances > 1 else None,
+                    'schema_version': 0,
+                    'attributes': {
+                        'id': '/subscriptions/00000000-0000-0000-0000-000000000000/resourceGroups/rg{0}-{1}'.format(r, i),
+                        'location': 'westeurope',
+                        'name': 'rg{0}-{1}'.format(r, i),
+                        'tags': {'env': 'bench', 'index': str(i), 'owner': 'lemniscat'},
+                        'timeouts': None,
+                    },
+                    'sensitive_attributes': [],
+                    'dependencies': [],
+                } for i in range(instances)],
+            }))
+        f.write(']}')
+
+
+def emit_lines():
+    lines = _env('FAKE_TF_LINES', 100)
+    line_size = _env('FAKE_TF_LINE_SIZE', 80)
+    rate = _env('FAKE_TF_RATE', 0)
+    stderr_ratio = _env('FAKE_TF_STDERR_RATIO', 0)
+    padding = 'x' * max(line_size - 20, 0)
+    start = time.monotonic()
+    for i in range(lines):
+        stream = sys.stderr if stderr_ratio and i % stderr_ratio == 0 else sys.stdout
+        stream.write('line {0:>10} {1}\n'.format(i, padding))
+        if rate:
+            delay = start + (i + 1) / rate - time.monotonic()
+            if delay > 0:
+                sys.stdout.flush()
+                time.sleep(delay)
+    sys.stdout.flush()
+
+
+def main(args):
+    command = args[0] if args else ''
+    if command == 'version':
+        if '-json' in args:
+            print(json.dumps({'terraform_version': '1.6.0', 'platform': 'linux_amd64'}))
+        else:
+            print('Terraform v1.6.0')
+        return 0
+    if command == 'init':
+        os.makedirs('.terraform', exist_ok=True)
+        print('Terraform has been successfully initialized!')
+        return 0
+    if command == 'output':
+        print(json.dumps({'name': {'value': 'bench', 'type': 'string', 'sensitive': False}}))
+        return 0
+    if command == 'show':
+        print(json.dumps({'resource_changes': []}))
+        return 0
+    if command in ('plan', 'apply', 'destroy'):
+        emit_lines()
+        for arg in args:
+            if arg.startswith('-out='):
+                with open(arg[len('-out='):], 'w') as f:
+                    f.write('fake plan')
+        resources = _env('FAKE_TF_STATE_RESOURCES', 0)
+        if command == 'apply' and resources:
+            write_state('terraform.tfstate', resources, _env('FAKE_TF_STATE_INSTANCES', 1))
+        return _env('FAKE_TF_EXIT', 0)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
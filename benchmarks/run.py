@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the overhead of the plugin, terraform is replaced with fake_terraform.py.
+
+  python benchmarks/run.py [--lines 10000 100000] [--state-sizes 100 1000 10000] [--repeat 3] [--json results.json]
+
+Reports:
+  - lines/sec of plan through Terraform.cmd and the wall time added to the bare command
+  - the wall time added to short commands (version, output)
+  - the time and the peak RSS of Tfstate.load_file, eager and lazy, for several state sizes
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+try:  # POSIX only
+    import resource
+except ImportError:
+    resource = None
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'src'))
+sys.path.insert(0, BENCH_DIR)
+
+import fake_terraform  # noqa: E402
+from lemniscat.plugin.terraform.terraform import Terraform  # noqa: E402
+from lemniscat.plugin.terraform.tfstate import Tfstate  # noqa: E402
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in KB on Linux, in bytes on macOS
+    if resource is None:
+        return 0.0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+def _silence_logs():
+    devnull = open(os.devnull, 'w')
+    for name, logger in logging.Logger.manager.loggerDict.items():
+        if isinstance(logger, logging.Logger) and name.startswith(('lemniscat', 'plugin')):
+            for handler in logger.handlers:
+                if isinstance(handler, logging.StreamHandler):
+                    handler.setStream(devnull)
+
+
+def _fake_binary(tmp_dir):
+    """
+    wrapper running fake_terraform.py with the current interpreter
+    :return: path of the wrapper, to be used as terraform_bin_path
+    """
+    script = os.path.join(BENCH_DIR, 'fake_terraform.py')
+    if os.name == 'nt':
+        path = os.path.join(tmp_dir, 'terraform.cmd')
+        with open(path, 'w') as f:
+            f.write('@"{0}" "{1}" %*\n'.format(sys.executable, script))
+    else:
+        path = os.path.join(tmp_dir, 'terraform')
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\nexec "{0}" "{1}" "$@"\n'.format(sys.executable, script))
+        os.chmod(path, 0o755)
+    return path
+
+
+def _timed(function, repeat):
+    """
+    :return: median wall time of function in seconds
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def bench_lines(binary, work_dir, lines, repeat):
+    os.environ['FAKE_TF_LINES'] = str(lines)
+    tf = Terraform(working_dir=work_dir, terraform_bin_path=binary)
+    bare = _timed(lambda: subprocess.run([binary, 'plan'], cwd=work_dir, stdout=subprocess.DEVNULL,
+                                         stderr=subprocess.DEVNULL, check=False), repeat)
+    wrapped = _timed(lambda: tf.plan(), repeat)
+    return {
+        'lines': lines,
+        'bare_s': round(bare, 4),
+        'plugin_s': round(wrapped, 4),
+        'overhead_s': round(wrapped - bare, 4),
+        'lines_per_s': int(lines / wrapped) if wrapped else None,
+    }
+
+
+def bench_commands(binary, work_dir, repeat):
+    os.environ['FAKE_TF_LINES'] = '0'
+    tf = Terraform(working_dir=work_dir, terraform_bin_path=binary)
+    results = []
+    for name, argv, call in (('version', ['version', '-json'], tf.version),
+                             ('output', ['output', '-json'], tf.output)):
+        bare = _timed(lambda: subprocess.run([binary] + argv, cwd=work_dir, stdout=subprocess.DEVNULL, check=False), repeat)
+        wrapped = _timed(call, repeat)
+        results.append({'command': name, 'bare_s': round(bare, 4), 'plugin_s': round(wrapped, 4),
+                        'overhead_s': round(wrapped - bare, 4)})
+    return results
+
+
+def bench_load(state_file, lazy):
+    """
+    load a state file in this process
+    :return: load time in seconds, number of resources and peak RSS in MB
+    """
+    rss_before = _peak_rss_mb()
+    start = time.perf_counter()
+    tfstate = Tfstate.load_file(state_file, lazy=lazy)
+    resources = len(tfstate.index)
+    elapsed = time.perf_counter() - start
+    return {'load_s': round(elapsed, 4), 'resources': resources,
+            'peak_rss_mb': round(_peak_rss_mb(), 1), 'rss_added_mb': round(_peak_rss_mb() - rss_before, 1)}
+
+
+def bench_states(work_dir, sizes, repeat):
+    results = []
+    for size in sizes:
+        state_file = os.path.join(work_dir, 'state-{0}.tfstate'.format(size))
+        fake_terraform.write_state(state_file, size)
+        for lazy in (False, True):
+            # each load runs in a new process, so that the peak RSS is the one of the load
+            runs = []
+            for _ in range(repeat):
+                out = subprocess.run([sys.executable, __file__, '--load', state_file] + (['--lazy'] if lazy else []),
+                                     stdout=subprocess.PIPE, check=True).stdout
+                runs.append(json.loads(out))
+            results.append({
+                'resources': size,
+                'file_mb': round(os.path.getsize(state_file) / (1024 * 1024), 2),
+                'lazy': lazy,
+                'load_s': round(statistics.median(run['load_s'] for run in runs), 4),
+                'peak_rss_mb': statistics.median(run['peak_rss_mb'] for run in runs),
+                'rss_added_mb': statistics.median(run['rss_added_mb'] for run in runs),
+            })
+        os.unlink(state_file)
+    return results
+
+
+def _print_table(title, rows):
+    print('\n' + title)
+    if not rows:
+        return
+    keys = list(rows[0].keys())
+    widths = [max(len(str(key)), *(len(str(row[key])) for row in rows)) for key in keys]
+    print('  '.join(str(key).rjust(width) for key, width in zip(keys, widths)))
+    for row in rows:
+        print('  '.join(str(row[key]).rjust(width) for key, width in zip(keys, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of lemniscat.plugin.terraform with a fake terraform binary')
+    parser.add_argument('--lines', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='numbers of lines printed by the fake plan')
+    parser.add_argument('--state-sizes', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='numbers of resources of the loaded state files')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each measure, the median is reported')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--verbose', action='store_true', help='keep the logs of the plugin')
+    parser.add_argument('--load', help=argparse.SUPPRESS)
+    parser.add_argument('--lazy', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if not args.verbose:
+        _silence_logs()
+
+    if args.load:
+        print(json.dumps(bench_load(args.load, args.lazy)))
+        return 0
+
+    work_dir = tempfile.mkdtemp(prefix='lemniscat-bench-')
+    try:
+        binary = _fake_binary(work_dir)
+        results = {
+            'lines': [bench_lines(binary, work_dir, lines, args.repeat) for lines in args.lines],
+            'commands': bench_commands(binary, work_dir, args.repeat),
+            'states': bench_states(work_dir, args.state_sizes, args.repeat),
+        }
+        results['peak_rss_mb'] = round(_peak_rss_mb(), 1)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    _print_table('Output pump (plan)', results['lines'])
+    _print_table('Command overhead', results['commands'])
+    _print_table('Tfstate.load_file', results['states'])
+    print('\nPeak RSS of the benchmark process: {0} MB'.format(results['peak_rss_mb']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
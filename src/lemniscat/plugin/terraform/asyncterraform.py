@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+# above is for compatibility of python2.7.11
+
+import asyncio
+import inspect
+import logging
+import time
+
+from lemniscat.core.util.helpers import LogUtil
+from lemniscat.plugin.terraform import processes
+from lemniscat.plugin.terraform.pump import StreamPump
+from lemniscat.plugin.terraform.terraform import Terraform
+
+logging.setLoggerClass(LogUtil)
+log = logging.getLogger(__name__.replace('lemniscat.', ''))
+
+
+class AsyncTerraformCommand(object):
+    """
+    A running terraform command.
+
+    Iterate on it with 'async for kind, line in command' to receive the lines of
+    stdout (kind == STDOUT) and stderr (kind == STDERR) while the command runs,
+    then 'await command.wait()' to get ret_code, out, err.
+    The lines are only queued once the iteration started, the lines written before are only
+    in the output (kept within the bounds of the capture).
+    """
+
+    def __init__(self, terraform, cmds, process, disable_logs=False, raise_on_error=False, json_ui=None, buffers=None,
+                 start=None, spawned=None, name=None, supervisor=None):
+        self.terraform = terraform
+        self.cmds = cmds
+        self.process = process
+        self.raise_on_error = raise_on_error
+        # created by the iteration, nothing is kept in memory if the lines aren't consumed
+        self._queue = None
+        self._result = None
+
+        handlers = terraform._log_handlers(json_ui, disable_logs is False)
+        self._buffers = buffers
+        pump = StreamPump(capture=True, buffers=buffers,
+                          redactor=terraform.redactor if disable_logs is False else None)
+        for kind in (pump.handlers.keys()):
+            pump.handlers[kind] = self._handler(kind, handlers.get(kind))
+        self._pump = pump
+        self._start = start
+        self._spawned = spawned
+        self._name = name
+        self._supervisor = supervisor
+        self._pumping = asyncio.ensure_future(pump.run_async(process))
+        self._pumping.add_done_callback(lambda future: self._queue.put_nowait(None) if self._queue is not None else None)
+
+    def _handler(self, kind, log_handler):
+        def handler(line):
+            if log_handler is not None:
+                log_handler(line)
+            if self._queue is not None:
+                self._queue.put_nowait((kind, line))
+        return handler
+
+    async def __aiter__(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            if self._pumping.done():
+                self._queue.put_nowait(None)
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                break
+            yield item
+
+    def _stop_supervisor(self, abandoned=False):
+        if self._supervisor is not None:
+            self._supervisor.stop(abandoned)
+
+    async def wait(self):
+        """
+        wait for the end of the command
+        :return: ret_code, out, err
+        """
+        if self._result is None:
+            try:
+                out, err = await self._pumping
+            except BaseException:
+                # cancelled or interrupted, the command mustn't be left running
+                self._stop_supervisor(abandoned=True)
+                raise
+            finally:
+                self.terraform._close_buffers(self._buffers)
+                if self.terraform.log_sink is not None:
+                    self.terraform.log_sink.end_command()
+            self._stop_supervisor()
+            if self.terraform.metrics is not None and self._start is not None:
+                # the resources used by the process aren't available with asyncio
+                self.terraform.metrics.record_process(f'terraform {self._name}', self._start, self._spawned,
+                                                      self._pump, None, self.process.returncode,
+                                                      working_dir=self.terraform.working_dir)
+            ret_code, err = self.terraform._check_timed_out(self._name, self._supervisor, self.process.returncode, err) \
+                if self._supervisor is not None else (self.process.returncode, err)
+            self._result = self.terraform._cmd_done(self.cmds, ret_code, out, err, self.raise_on_error)
+        return self._result
+
+
+class AsyncTerraform(Terraform):
+    """
+    Wrapper of terraform command line tool for asyncio.
+
+    Same options as Terraform, init/plan/apply/destroy/output/version and any
+    other command are coroutines returning the same values as Terraform.
+    The orchestration of the commands is shared with Terraform (see _flow), only
+    the processes are run with asyncio and the blocking steps in threads.
+    """
+
+    async def start(self, cmd, *args, **kwargs) -> AsyncTerraformCommand:
+        """
+        start a terraform command
+        :param cmd: command and sub-command of terraform, seperated with space
+        :param args: arguments of a command
+        :param kwargs: same as kwags in method 'cmd', capture_output and synchronous are not supported
+        :return: AsyncTerraformCommand
+        """
+        raise_on_error = kwargs.pop('raise_on_error', False)
+        disable_logs = kwargs.pop('disable_logs', False)
+        kwargs.pop('capture_output', None)
+        kwargs.pop('synchronous', None)
+        json_ui = kwargs.pop('json_ui', None)
+
+        deadline = self._command_deadline()
+        cmds, working_folder, environ_vars = self._prepare_cmd(cmd, *args, **kwargs)
+        buffers = self._capture_buffers(cmd) if disable_logs is False else None
+        start = time.perf_counter()
+        options = processes.popen_options()
+        process = await asyncio.create_subprocess_exec(*cmds, stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.PIPE,
+                                                       cwd=working_folder, env=environ_vars, **options)
+        supervisor = processes.Supervisor(process, deadline, self.kill_grace_period, f'terraform {cmd}',
+                                          group=bool(options))
+        supervisor.start()
+        return AsyncTerraformCommand(self, cmds, process, disable_logs, raise_on_error, json_ui, buffers,
+                                     start, time.perf_counter(), cmd, supervisor)
+
+    async def _run_cmd(self, cmd, *args, **kwargs):
+        """
+        run a terraform command once, not started if the deadline of the task is exceeded
+        :return: ret_code, out, err
+        """
+        deadline = self._command_deadline()
+        if deadline is not None and deadline.expired():
+            return self._deadline_exceeded(cmd, *args, **kwargs)
+        command = await self.start(cmd, *args, **kwargs)
+        return await command.wait()
+
+    async def _run_flow(self, flow):
+        """
+        refer to Terraform._run_flow, the steps returning an awaitable (commands, flows...) are awaited
+        :return: the value returned by the flow
+        """
+        result = error = None
+        while True:
+            try:
+                step = flow.send(result) if error is None else flow.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                result, error = step(), None
+                if inspect.isawaitable(result):
+                    result = await result
+            except BaseException as e:
+                result, error = None, e
+
+    @staticmethod
+    def _blocking(function, *args, **kwargs):
+        """
+        run a step which may block in a thread, refer to Terraform._blocking
+        """
+        return asyncio.to_thread(function, *args, **kwargs)
+
+    @staticmethod
+    def _sleep(delay):
+        return asyncio.sleep(delay)
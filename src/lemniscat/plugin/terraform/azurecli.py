@@ -2,34 +2,52 @@
 # above is for compatibility of python2.7.11
 
 import logging
-import os
-import subprocess, sys 
-from queue import Queue
-import threading  
-from lemniscat.core.util.helpers import LogUtil
 import re
+import subprocess
+import time
 
-try:  # Python 2.7+
-    from logging import NullHandler
-except ImportError:
-    class NullHandler(logging.Handler):
-        def emit(self, record):
-            pass
-
-def enqueue_stream(stream, queue, type):
-    for line in iter(stream.readline, b''):
-        queue.put(str(type) + line.decode('utf-8').rstrip('\r\n'))
-
-def enqueue_process(process, queue):
-    process.wait()
-    queue.put('x')
+from lemniscat.core.util.helpers import LogUtil
+from lemniscat.plugin.terraform.environment import EnvOverlay
+from lemniscat.plugin.terraform.pump import StreamPump, STDOUT, STDERR
+from lemniscat.plugin.terraform import processes
 
 logging.setLoggerClass(LogUtil)
 log = logging.getLogger(__name__.replace('lemniscat.', ''))
 
+_REGEX_PUSHVAR = re.compile(r"^\[lemniscat\.pushvar\] (?P<key>\w+)=(?P<value>.*)")
+# errors of the azurerm backend when the storage account key is wrong, ex. after a rotation
+_REGEX_KEY_REJECTED = re.compile(r"StatusCode=403|AuthenticationFailed|AuthorizationFailure")
+
 class AzureCli:
-    def __init__(self):
-        pass
+    def __init__(self, metrics=None, env=None, redactor=None, command_timeout=None, deadline=None,
+                 kill_grace_period=processes.GRACE_PERIOD):
+        """
+        :param metrics: Metrics recording the measures of the commands
+        :param env: EnvOverlay or dict of environment variables (ARM_CLIENT_ID, ARM_CLIENT_SECRET...)
+                    added to os.environ for the commands
+        :param redactor: Redactor masking the secrets in the logged lines, the storage account key is added to it
+        :param command_timeout: maximum duration in seconds of each command
+        :param deadline: processes.Deadline of the task, the commands are stopped at the deadline
+        :param kill_grace_period: seconds between the interruption of a command and its kill
+        """
+        self.metrics = metrics
+        self.redactor = redactor
+        self.env = EnvOverlay(env)
+        self.command_timeout = command_timeout
+        self.deadline = deadline
+        self.kill_grace_period = kill_grace_period
+        self.timed_out = False
+        # True when the access key of the last run comes from the credential cache
+        self.cache_hit = False
+        self._environ = None
+
+    def environ(self):
+        """
+        :return: environment of the commands, built once
+        """
+        if self._environ is None:
+            self._environ = self.env.apply()
+        return self._environ
     
     def cmd(self, cmds, **kwargs):
         outputVar = {}
@@ -37,61 +55,111 @@ class AzureCli:
         stderr = subprocess.PIPE
         stdout = subprocess.PIPE
 
+        processes.check_interrupted()
+        deadline = processes.earliest(self.deadline, processes.Deadline(self.command_timeout) if self.command_timeout else None)
+        if deadline is not None and deadline.expired():
+            self.timed_out = True
+            log.error(f'Azure CLI not started, the deadline of {deadline.timeout}s is exceeded')
+            return processes.TIMEOUT_RET_CODE, '', 'deadline exceeded', outputVar
+
+        start = time.perf_counter()
+        options = processes.popen_options()
         p = subprocess.Popen(cmds, stdout=stdout, stderr=stderr,
-                             cwd=None) 
-        q = Queue()
-        to = threading.Thread(target=enqueue_stream, args=(p.stdout, q, 1))
-        te = threading.Thread(target=enqueue_stream, args=(p.stderr, q, 2))
-        tp = threading.Thread(target=enqueue_process, args=(p, q))
-        te.start()
-        to.start()
-        tp.start()
-        
+                             cwd=None, env=self.environ(), **options)
+        spawned = time.perf_counter()
+
+        def on_stdout(line):
+            m = _REGEX_PUSHVAR.match(line)
+            if(not m is None):
+                outputVar[m.group('key').strip()] = m.group('value').strip()
+                if(m.group('key').strip() == "arm_access_key"):
+                    log.info('Storage account key retrieved.')
+                    if self.redactor is not None:
+                        self.redactor.add(m.group('value').strip())
+            else:
+                log.info(self._redact(f'  {line}'))
+
+        def on_stderr(line):
+            if(line.startswith("ERROR:")):
+                log.error(self._redact(f'  {line}'))
+            else:
+                log.warning(self._redact(f'  {line}'))
+
+        pump = StreamPump(capture=capture_output is True)
         if(capture_output is True):
-            while True:
-                line = q.get()
-                if line[0] == 'x':
-                    break
-                if line[0] == '2':  # stderr
-                    if(line[1:].startswith("ERROR:")):
-                        log.error(f'  {line[1:]}')
-                    else:
-                        log.warning(f'  {line[1:]}')
-                if line[0] == '1':
-                    ltrace = line[1:]
-                    m = re.match(r"^\[lemniscat\.pushvar\] (?P<key>\w+)=(?P<value>.*)", str(ltrace))
-                    if(not m is None):
-                        outputVar[m.group('key').strip()] = m.group('value').strip()
-                        if(m.group('key').strip() == "arm_access_key"):
-                            log.info('Set ARM_ACCESS_KEY environment variable.')
-                            os.environ["ARM_ACCESS_KEY"] = m.group('value').strip()
-                    else:
-                        log.info(f'  {ltrace}')
-
-        tp.join()
-        to.join()
-        te.join()
-                          
-        out, err = p.communicate()
+            pump.handlers = {STDOUT: on_stdout, STDERR: on_stderr}
+        with processes.Supervisor(p, deadline, self.kill_grace_period, 'Azure CLI', group=bool(options)) as supervisor:
+            out, err = pump.run(p)
         ret_code = p.returncode
-
-        if capture_output is True:
-            out = out.decode('utf-8')
-            err = err.decode('utf-8')
-        else:
-            out = None
-            err = None
+        if self.metrics is not None:
+            self.metrics.record_process('azure cli', start, spawned, pump, pump.rusage, ret_code)
+        if supervisor.timed_out:
+            self.timed_out = True
+            ret_code = processes.TIMEOUT_RET_CODE
 
         return ret_code, out, err, outputVar
     
-    def append_loginCommand(self):
-        self.cmd(['pwsh', '-Command', "az config unset core.allow_broker"], capture_output=False)
-        self.cmd(['pwsh', '-Command', f"az login --service-principal -u {os.environ['ARM_CLIENT_ID']} -p {os.environ['ARM_CLIENT_SECRET']} --tenant {os.environ['ARM_TENANT_ID']}"], capture_output=False)
-        self.cmd(['pwsh', '-Command', f"az account set --subscription {os.environ['ARM_SUBSCRIPTION_ID']}"], capture_output=False)
-        
-    def run(self, storage_account_name):
-        log.info('Logging to Azure...')
-        self.append_loginCommand()
-        log.info('Getting storage account key...')
-        self.cmd(['pwsh', '-Command', f"az configure --defaults group="], capture_output=False)
-        return self.cmd(['pwsh', '-Command', f'$result = az storage account keys list -n {storage_account_name} --query "[0].value" -o tsv; Write-Host "[lemniscat.pushvar] arm_access_key=$result"'], capture_output=True)
+    def _redact(self, text):
+        # the lines are masked one by one: the key pushed by the login commands mustn't be masked
+        return self.redactor.redact(text) if self.redactor is not None else text
+
+    def login_commands(self, storage_account_name):
+        # login and key retrieval run in a single pwsh session, stop at the first failing az command
+        check = 'if ($LASTEXITCODE -ne 0) { [Console]::Error.WriteLine("ERROR: az command failed"); exit $LASTEXITCODE }'
+        environ = self.environ()
+        return [
+            "az config unset core.allow_broker 2>&1 | Out-Null",
+            f"az login --service-principal -u {environ['ARM_CLIENT_ID']} -p {environ['ARM_CLIENT_SECRET']} --tenant {environ['ARM_TENANT_ID']} | Out-Null",
+            check,
+            f"az account set --subscription {environ['ARM_SUBSCRIPTION_ID']}",
+            check,
+            "az configure --defaults group=",
+            f'$result = az storage account keys list -n {storage_account_name} --query "[0].value" -o tsv',
+            check,
+            'Write-Host "[lemniscat.pushvar] arm_access_key=$result"',
+        ]
+
+    def run(self, storage_account_name, cache=None):
+        """
+        Get the access key of the storage account, os.environ is left unchanged
+        :param storage_account_name: name of the storage account of the backend
+        :param cache: CredentialCache where the access key is looked up before logging to Azure
+        :return: ret_code, out, err, outputVar (the key is outputVar['arm_access_key'])
+        """
+        environ = self.environ()
+        cache_key = (environ.get('ARM_TENANT_ID'), environ.get('ARM_SUBSCRIPTION_ID'), storage_account_name)
+        if cache is not None:
+            access_key = cache.get(*cache_key)
+            if access_key is not None:
+                log.info('Storage account key found in credential cache.')
+                self.cache_hit = True
+                if self.redactor is not None:
+                    self.redactor.add(access_key)
+                return 0, None, None, {'arm_access_key': access_key}
+
+        self.cache_hit = False
+        log.info('Logging to Azure and getting storage account key...')
+        result = self.cmd(['pwsh', '-Command', '\n'.join(self.login_commands(storage_account_name))], capture_output=True)
+        if cache is not None and result[0] == 0 and result[3].get('arm_access_key'):
+            cache.set(*cache_key, result[3]['arm_access_key'])
+        return result
+
+    def refresh(self, storage_account_name, cache):
+        """
+        Get the access key of the storage account again when the cached one has been rejected by the backend
+        :param storage_account_name: name of the storage account of the backend
+        :param cache: CredentialCache where the rejected key is removed and the new one is stored
+        :return: ret_code, out, err, outputVar (the key is outputVar['arm_access_key'])
+        """
+        environ = self.environ()
+        log.warning('Storage account key of the credential cache rejected by the backend, it is retrieved again.')
+        cache.invalidate(environ.get('ARM_TENANT_ID'), environ.get('ARM_SUBSCRIPTION_ID'), storage_account_name)
+        return self.run(storage_account_name, cache)
+
+    @staticmethod
+    def is_key_rejected(err):
+        """
+        :param err: error output of a terraform command
+        :return: True if the backend rejected the storage account key
+        """
+        return _REGEX_KEY_REJECTED.search(err or '') is not None
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+# above is for compatibility of python2.7.11
+
+import glob
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+
+from lemniscat.core.util.helpers import LogUtil
+
+logging.setLoggerClass(LogUtil)
+log = logging.getLogger(__name__.replace('lemniscat.', ''))
+
+DEFAULT_CACHE_FILE = os.path.join(tempfile.gettempdir(), 'lemniscat-terraform-versions.json')
+
+_REGEX_REQUIRED_VERSION = re.compile(r'\brequired_version\s*=\s*"(?P<constraint>[^"]*)"')
+_REGEX_CONSTRAINT = re.compile(r'^\s*(?P<op>!=|>=|<=|~>|=|>|<)?\s*v?(?P<version>\d+(?:\.\d+)*(?:-[\w.]+)?)\s*$')
+_REGEX_VERSION_NAME = re.compile(r'^(?:terraform[_-])?v?(?P<version>\d+\.\d+\.\d+(?:-[\w.]+)?)(?:\.exe)?$')
+_BINARY_NAME = 'terraform.exe' if os.name == 'nt' else 'terraform'
+
+_probes = {}
+_probes_lock = threading.Lock()
+
+
+def parse_version(version):
+    """
+    :param version: version string, ex. 1.6.0 or 1.7.0-beta1
+    :return: tuple (numbers, prerelease), prerelease is '' for a release
+    """
+    version = version.strip().lstrip('v')
+    number, _, prerelease = version.partition('-')
+    numbers = tuple(int(n) for n in number.split('.'))
+    return numbers + (0,) * (3 - len(numbers)), prerelease
+
+
+def _sort_key(version):
+    numbers, prerelease = parse_version(version)
+    # a release is newer than its prereleases
+    return numbers, prerelease == '', prerelease
+
+
+def required_versions(working_dir):
+    """
+    read the required_version constraints of the terraform blocks of a configuration
+    :param working_dir: the folder of the terraform configuration
+    :return: list of constraints, ex. ['>= 1.5.0, < 2.0.0']
+    """
+    constraints = []
+    for tf_file in sorted(glob.glob(os.path.join(working_dir or '.', '*.tf'))):
+        with open(tf_file, encoding='utf-8', errors='replace') as f:
+            constraints.extend(m.group('constraint') for m in _REGEX_REQUIRED_VERSION.finditer(f.read()))
+    return constraints
+
+
+def matches(version, constraints):
+    """
+    check a version against terraform version constraints
+    https://developer.hashicorp.com/terraform/language/expressions/version-constraints
+    :param version: version string
+    :param constraints: list of constraint strings, each one a comma separated list of conditions
+    :return: True if the version meets all the conditions
+    """
+    numbers, prerelease = parse_version(version)
+    for constraint in constraints:
+        for condition in constraint.split(','):
+            if not condition.strip():
+                continue
+            m = _REGEX_CONSTRAINT.match(condition)
+            if m is None:
+                log.warning('unsupported version constraint {0}'.format(condition.strip()))
+                return False
+            op = m.group('op') or '='
+            expected, expected_prerelease = parse_version(m.group('version'))
+            # prereleases only match an exact condition
+            if prerelease and (op != '=' or expected_prerelease != prerelease):
+                return False
+            if op == '=' and (numbers != expected or prerelease != expected_prerelease):
+                return False
+            if op == '!=' and numbers == expected and prerelease == expected_prerelease:
+                return False
+            if op == '>' and not numbers > expected:
+                return False
+            if op == '>=' and not numbers >= expected:
+                return False
+            if op == '<' and not numbers < expected:
+                return False
+            if op == '<=' and not numbers <= expected:
+                return False
+            if op == '~>':
+                # only the rightmost version component given may increase
+                digits = len(m.group('version').split('-')[0].split('.'))
+                prefix = max(digits - 1, 1)
+                if not numbers >= expected or numbers[:prefix] != expected[:prefix]:
+                    return False
+    return True
+
+
+def list_binaries(versions_dir):
+    """
+    list the terraform binaries of a folder of versions, with one of the layouts:
+    <version>/terraform, <version>/bin/terraform, terraform_<version>, terraform-<version>
+    :param versions_dir: folder of terraform versions
+    :return: dict version -> path of the binary
+    """
+    binaries = {}
+    if not versions_dir or not os.path.isdir(versions_dir):
+        return binaries
+    for name in os.listdir(versions_dir):
+        m = _REGEX_VERSION_NAME.match(name)
+        if m is None:
+            continue
+        path = os.path.join(versions_dir, name)
+        if os.path.isdir(path):
+            for candidate in (os.path.join(path, _BINARY_NAME), os.path.join(path, 'bin', _BINARY_NAME)):
+                if os.path.isfile(candidate):
+                    binaries[m.group('version')] = candidate
+                    break
+        elif name.startswith('terraform'):
+            binaries[m.group('version')] = path
+    return binaries
+
+
+def _probe_key(path):
+    stat = os.stat(path)
+    return '{0}|{1}|{2}'.format(os.path.realpath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def _read_cache(cache_file):
+    if not cache_file or not os.path.exists(cache_file):
+        return {}
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+
+def _write_cache(cache_file, key, version):
+    if not cache_file:
+        return
+    try:
+        entries = _read_cache(cache_file)
+        entries[key] = version
+        tmp_path = '{0}.{1}.tmp'.format(cache_file, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, cache_file)
+    except OSError as e:
+        log.debug('version cache {0} not written: {1}'.format(cache_file, e))
+
+
+def probe(binary, cache_file=DEFAULT_CACHE_FILE, env=None):
+    """
+    get the version of a terraform binary, the probes are cached by path, mtime and size
+    in memory and in cache_file
+    :param binary: path or name (looked up in PATH) of the binary
+    :param cache_file: JSON file shared by the processes of the host, None to cache in memory only
+    :param env: environment of the probe, its PATH is used to look up the binary
+    :return: the version, None if the binary can't be run
+    """
+    path = binary if os.path.dirname(binary) else shutil.which(binary, path=(env or os.environ).get('PATH'))
+    if path is None or not os.path.exists(path):
+        return None
+    key = _probe_key(path)
+    with _probes_lock:
+        if key in _probes:
+            return _probes[key]
+    version = _read_cache(cache_file).get(key)
+    if version is None:
+        version = _run_probe(path, env)
+        if version is not None:
+            _write_cache(cache_file, key, version)
+    if version is not None:
+        with _probes_lock:
+            _probes[key] = version
+    return version
+
+
+def _run_probe(path, env=None):
+    try:
+        p = subprocess.run([path, 'version', '-json'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, timeout=60)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        log.warning('{0} version failed: {1}'.format(path, e))
+        return None
+    if p.returncode != 0:
+        return None
+    out = p.stdout.decode('utf-8', errors='replace')
+    try:
+        return json.loads(out)['terraform_version']
+    except (ValueError, KeyError):
+        # terraform < 0.13 doesn't support -json
+        return out.strip().splitlines()[0].replace('Terraform v', '') if out.strip() else None
+
+
+def resolve(working_dir, versions_dir=None, default_binary='terraform', cache_file=DEFAULT_CACHE_FILE, env=None):
+    """
+    choose the terraform binary of a configuration: the newest version of versions_dir
+    meeting the required_version constraints, default_binary if there is none
+    :param working_dir: the folder of the terraform configuration
+    :param versions_dir: folder of terraform versions, see list_binaries
+    :param default_binary: binary used when no version of versions_dir matches
+    :param cache_file: see probe
+    :param env: see probe
+    :return: path of the binary, its version (None if unknown)
+    """
+    constraints = required_versions(working_dir)
+    binaries = list_binaries(versions_dir)
+    candidates = sorted((v for v in binaries if matches(v, constraints)), key=_sort_key, reverse=True)
+    # prereleases are only chosen when they are required explicitly
+    releases = [v for v in candidates if not parse_version(v)[1]]
+    candidates = releases or candidates
+    if candidates:
+        log.debug('terraform {0} chosen for {1} (constraints: {2})'.format(candidates[0], working_dir, constraints))
+        _remember(binaries[candidates[0]], candidates[0])
+        return binaries[candidates[0]], candidates[0]
+
+    if versions_dir:
+        log.warning('no terraform version of {0} meets {1}, {2} is used'.format(versions_dir, constraints, default_binary))
+    version = probe(default_binary, cache_file, env)
+    if version is not None and constraints and not matches(version, constraints):
+        log.warning('terraform {0} doesn\'t meet the required version {1}'.format(version, constraints))
+    return default_binary, version
+
+
+def _remember(path, version):
+    # the version of a binary of versions_dir is known from its folder name
+    try:
+        key = _probe_key(path)
+    except OSError:
+        return
+    with _probes_lock:
+        _probes[key] = version
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# above is for compatibility of python2.7.11
+
+import csv
+import json
+import logging
+import os
+
+import yaml
+
+from lemniscat.core.util.helpers import LogUtil
+
+logging.setLoggerClass(LogUtil)
+log = logging.getLogger(__name__.replace('lemniscat.', ''))
+
+# import blocks are supported since terraform 1.5
+MIN_VERSION = (1, 5, 0)
+# generated in the root module for the time of an import
+IMPORTS_FILE = 'lemniscat_imports.tf'
+PLAN_FILE = 'lemniscat-import.tfplan'
+LOCK_FILE = 'lemniscat.import.lock'
+
+IMPORTED = 'imported'
+FAILED = 'failed'
+# already in the state, not imported again
+MANAGED = 'managed'
+
+
+def read_mapping(file_path):
+    """
+    Read the resources to import from a CSV file (address,id lines, with an optional header)
+    or a YAML/JSON file (address: id, or a list of {address, id})
+    :param file_path: path of the file
+    :return: dict address -> id, in the order of the file
+    """
+    mapping = {}
+    if os.path.splitext(file_path)[1].lower() == '.csv':
+        with open(file_path, newline='') as f:
+            for row in csv.reader(f):
+                if not row or row[0].strip().startswith('#'):
+                    continue
+                if len(row) < 2:
+                    raise ValueError('{0}: line without id: {1}'.format(file_path, ','.join(row)))
+                if not mapping and [c.strip().lower() for c in row[:2]] == ['address', 'id']:
+                    continue
+                mapping[row[0].strip()] = ','.join(row[1:]).strip()
+        return mapping
+    with open(file_path) as f:
+        try:
+            content = yaml.safe_load(f) or {}
+        except yaml.YAMLError as e:
+            raise ValueError('{0}: {1}'.format(file_path, e))
+    if isinstance(content, dict):
+        return {str(address): str(resource_id) for address, resource_id in content.items()}
+    for item in content:
+        if not isinstance(item, dict) or 'address' not in item or 'id' not in item:
+            raise ValueError('{0}: item without address or id: {1}'.format(file_path, item))
+        mapping[str(item['address'])] = str(item['id'])
+    return mapping
+
+
+def _hcl_string(value):
+    # the JSON escapes are valid in HCL, the template sequences are escaped
+    return json.dumps(str(value)).replace('${', '$${').replace('%{', '%%{')
+
+
+def render(mapping):
+    """
+    :param mapping: dict address -> id
+    :return: content of a terraform file with one import block by resource
+    """
+    blocks = []
+    for address, resource_id in mapping.items():
+        blocks.append('import {{\n  to = {0}\n  id = {1}\n}}\n'.format(address, _hcl_string(resource_id)))
+    return '\n'.join(blocks)
+
+
+def write_imports(working_dir, mapping):
+    """
+    write the import blocks in the root module
+    :return: path of the file
+    """
+    file_path = os.path.join(working_dir or '.', IMPORTS_FILE)
+    if os.path.exists(file_path):
+        raise FileExistsError('{0} already exists, remove it before importing'.format(file_path))
+    with open(file_path, 'w') as f:
+        f.write(render(mapping))
+    log.debug('{0} import blocks wrote to {1}'.format(len(mapping), file_path))
+    return file_path
+
+
+def batches(addresses, batch_size=None):
+    """
+    :param addresses: list of addresses
+    :param batch_size: maximum number of addresses by batch, one batch if None or 0
+    :return: list of batches
+    """
+    if not batch_size:
+        return [list(addresses)] if addresses else []
+    return [list(addresses[i:i + batch_size]) for i in range(0, len(addresses), batch_size)]
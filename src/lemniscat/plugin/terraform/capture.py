@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# above is for compatibility of python2.7.11
+
+import gzip
+import logging
+import os
+from collections import deque
+
+from lemniscat.core.util.helpers import LogUtil
+
+logging.setLoggerClass(LogUtil)
+log = logging.getLogger(__name__.replace('lemniscat.', ''))
+
+
+class BoundedCapture(object):
+    """
+    Capture of the lines of a stream keeping only the last lines in memory,
+    the whole stream is written to a gzip file.
+    The file is removed on close if no line was dropped from memory.
+    """
+
+    def __init__(self, max_lines=None, max_bytes=None, spill_path=None):
+        """
+        :param max_lines: maximum number of lines kept in memory
+        :param max_bytes: maximum size of the lines kept in memory
+        :param spill_path: path of the gzip file receiving the whole stream
+        """
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.spill_path = spill_path
+        self.truncated = False
+        self.total_lines = 0
+        self._lines = deque()
+        self._size = 0
+        self._spill = None
+        if spill_path:
+            os.makedirs(os.path.dirname(spill_path) or '.', exist_ok=True)
+            self._spill = gzip.open(spill_path, 'wt', encoding='utf-8', compresslevel=1)
+
+    def append(self, line):
+        self.total_lines += 1
+        if self._spill is not None:
+            self._spill.write(line)
+            self._spill.write('\n')
+        self._lines.append(line)
+        self._size += len(line) + 1
+        while (self.max_lines is not None and len(self._lines) > self.max_lines) \
+                or (self.max_bytes is not None and self._size > self.max_bytes and len(self._lines) > 1):
+            self._size -= len(self._lines.popleft()) + 1
+            self.truncated = True
+
+    def __iter__(self):
+        return iter(self._lines)
+
+    def close(self):
+        """
+        close the spill file
+        :return: path of the spill file, None if it isn't needed
+        """
+        if self._spill is None:
+            return None
+        self._spill.close()
+        self._spill = None
+        if not self.truncated:
+            os.unlink(self.spill_path)
+            return None
+        log.info(f'{self.total_lines} lines wrote to {self.spill_path}, only the last {len(self._lines)} are kept in memory')
+        return self.spill_path
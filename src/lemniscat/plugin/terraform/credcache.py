@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+# above is for compatibility of python2.7.11
+
+import base64
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+
+from lemniscat.core.util.helpers import LogUtil
+from lemniscat.plugin.terraform.filelock import FileLock
+
+logging.setLoggerClass(LogUtil)
+log = logging.getLogger(__name__.replace('lemniscat.', ''))
+
+CREDENTIAL_CACHE_SECRET = 'LEMNISCAT_CREDENTIAL_CACHE_SECRET'
+# first line of the cache file, followed by the salt of the key derivation and the encrypted entries
+FILE_HEADER = b'lemniscat-credential-cache-v2'
+KDF_ITERATIONS = 480000
+SALT_SIZE = 16
+
+
+class CredentialCache(object):
+    """
+    Cache of storage account access keys keyed by tenant, subscription and storage account.
+
+    Keys are kept in memory for the life of the process and, when a file path is given,
+    in a file encrypted with the secret of the LEMNISCAT_CREDENTIAL_CACHE_SECRET environment
+    variable. The encryption key is derived from the secret with PBKDF2 and a random salt stored
+    in the file.
+    """
+
+    # shared by all the instances of the process
+    _memory = {}
+    # Fernet by (secret digest, salt), the derivation is slow on purpose
+    _fernets = {}
+
+    def __init__(self, file_path=None, ttl=3600):
+        """
+        :param file_path: path of the encrypted cache file, memory only if None
+        :param ttl: time to live of a cached key in seconds
+        """
+        self.ttl = ttl
+        self.file_path = None
+        self._secret = None
+        self._salt = None
+        if file_path:
+            secret = os.environ.get(CREDENTIAL_CACHE_SECRET)
+            if not secret:
+                log.warning(f'{CREDENTIAL_CACHE_SECRET} is not set, credential cache file is disabled, the keys are cached in memory only')
+            else:
+                self.file_path = file_path
+                self._secret = secret.encode('utf-8')
+                log.debug(f'credential cache in memory and in the encrypted file {file_path}')
+        else:
+            log.debug('credential cache in memory only')
+
+    def _fernet(self, salt):
+        """
+        :param salt: salt of the key derivation
+        :return: Fernet encrypting with the key derived from the secret and the salt
+        """
+        cache_key = (hashlib.sha256(self._secret).hexdigest(), salt)
+        fernet = CredentialCache._fernets.get(cache_key)
+        if fernet is None:
+            kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=KDF_ITERATIONS)
+            fernet = CredentialCache._fernets[cache_key] = Fernet(base64.urlsafe_b64encode(kdf.derive(self._secret)))
+        return fernet
+
+    @staticmethod
+    def _key(tenant, subscription, storage_account):
+        return hashlib.sha256('|'.join([str(tenant), str(subscription), str(storage_account)]).encode('utf-8')).hexdigest()
+
+    def _read_file(self):
+        if self.file_path is None or not os.path.exists(self.file_path):
+            return {}
+        with open(self.file_path, 'rb') as f:
+            content = f.read()
+        try:
+            header, salt, token = content.split(b'\n', 2)
+            if header != FILE_HEADER:
+                raise ValueError('unknown format')
+            salt = base64.b64decode(salt)
+            entries = json.loads(self._fernet(salt).decrypt(token))
+        except (InvalidToken, ValueError):
+            log.warning(f'credential cache file {self.file_path} can\'t be decrypted, it will be replaced')
+            return {}
+        self._salt = salt
+        return entries
+
+    def _write_file(self, entries):
+        if self._salt is None:
+            self._salt = os.urandom(SALT_SIZE)
+        tmp_path = self.file_path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b'\n'.join([FILE_HEADER, base64.b64encode(self._salt),
+                                self._fernet(self._salt).encrypt(json.dumps(entries).encode('utf-8'))]))
+        os.replace(tmp_path, self.file_path)
+
+    def get(self, tenant, subscription, storage_account) -> Optional[str]:
+        """
+        get a cached access key
+        :return: the access key, None if not cached or expired
+        """
+        key = self._key(tenant, subscription, storage_account)
+        now = time.time()
+        entry = CredentialCache._memory.get(key)
+        if entry is None and self.file_path is not None:
+            with FileLock(self.file_path + '.lock', shared=True):
+                entry = self._read_file().get(key)
+            if entry is not None:
+                CredentialCache._memory[key] = entry
+        if entry is None or entry['expires'] < now:
+            return None
+        return entry['value']
+
+    def set(self, tenant, subscription, storage_account, value):
+        """
+        cache an access key for ttl seconds
+        """
+        key = self._key(tenant, subscription, storage_account)
+        now = time.time()
+        entry = {'value': value, 'expires': now + self.ttl}
+        CredentialCache._memory[key] = entry
+        if self.file_path is not None:
+            with FileLock(self.file_path + '.lock'):
+                entries = {k: v for k, v in self._read_file().items() if v['expires'] >= now}
+                entries[key] = entry
+                self._write_file(entries)
+
+    def invalidate(self, tenant, subscription, storage_account):
+        """
+        remove a cached access key, ex. when it has been rotated
+        """
+        key = self._key(tenant, subscription, storage_account)
+        CredentialCache._memory.pop(key, None)
+        if self.file_path is not None:
+            with FileLock(self.file_path + '.lock'):
+                entries = self._read_file()
+                if entries.pop(key, None) is not None:
+                    self._write_file(entries)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# above is for compatibility of python2.7.11
+
+import logging
+import os
+from collections.abc import Mapping
+
+from lemniscat.core.util.helpers import LogUtil
+
+logging.setLoggerClass(LogUtil)
+log = logging.getLogger(__name__.replace('lemniscat.', ''))
+
+
+class EnvOverlay(Mapping):
+    """
+    Immutable set of environment variables (backend credentials, TF_* settings...) added to the
+    environment of the commands, so that tasks with different credentials can run in one process
+    without changing os.environ.
+    """
+
+    def __init__(self, values=None, base=None):
+        """
+        :param values: dict of environment variables, the None values are ignored
+        :param base: environment the overlay is applied on instead of os.environ (ex. the environment
+                of the client of the plugin worker), kept from values if it is an EnvOverlay
+        """
+        if base is None and isinstance(values, EnvOverlay):
+            base = values.base
+        self.base = dict(base) if base is not None else None
+        self._values = {key: str(value) for key, value in (values or {}).items() if value is not None}
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        # the values are credentials
+        return 'EnvOverlay({0})'.format(sorted(self._values.keys()))
+
+    def union(self, values):
+        """
+        :param values: dict of environment variables overriding the ones of the overlay
+        :return: a new overlay
+        """
+        return EnvOverlay(dict(self._values, **{key: value for key, value in values.items() if value is not None}), self.base)
+
+    def apply(self, base=None):
+        """
+        :param base: environment the overlay is applied on, the base of the overlay or os.environ by default
+        :return: new dict of the environment with the variables of the overlay
+        """
+        if base is None:
+            base = self.base if self.base is not None else os.environ
+        environ = dict(base)
+        environ.update(self._values)
+        return environ
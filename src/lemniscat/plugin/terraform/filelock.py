@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# above is for compatibility of python2.7.11
+
+import logging
+import os
+
+from lemniscat.core.util.helpers import LogUtil
+
+try:  # POSIX only
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logging.setLoggerClass(LogUtil)
+log = logging.getLogger(__name__.replace('lemniscat.', ''))
+
+
+class FileLock(object):
+    """
+    Advisory lock on a file, shared between the processes of one host.
+    On platforms without fcntl the lock is a no-op.
+    """
+
+    def __init__(self, path, shared=False):
+        """
+        :param path: path of the lock file, created if it doesn't exist
+        :param shared: take a shared lock instead of an exclusive one
+        """
+        self.path = path
+        self.shared = shared
+        self._file = None
+
+    def acquire(self, blocking=True):
+        """
+        :param blocking: wait until the lock is available
+        :return: True if the lock is acquired, False if it isn't available and blocking is False
+        """
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._file = open(self.path, 'a+')
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._file.fileno(), (fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX) | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                self._file.close()
+                self._file = None
+                return False
+        log.debug('{0} lock acquired on {1}'.format('shared' if self.shared else 'exclusive', self.path))
+        return True
+
+    def release(self):
+        if self._file is None:
+            return
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# above is for compatibility of python2.7.11
+
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+
+from lemniscat.core.util.helpers import LogUtil
+
+logging.setLoggerClass(LogUtil)
+log = logging.getLogger(__name__.replace('lemniscat.', ''))
+
+FINGERPRINT_FILE = 'lemniscat.init.fingerprint'
+
+_REGEX_MODULE_BLOCK = re.compile(r'^\s*module\s+"(?P<name>[^"]+)"\s*\{', re.MULTILINE)
+_REGEX_TERRAFORM_BLOCK = re.compile(r'^\s*terraform\s*\{', re.MULTILINE)
+_REGEX_MODULE_ATTRIBUTE = re.compile(r'^\s*(?P<key>source|version)\s*=\s*(?P<value>.+?)\s*$', re.MULTILINE)
+# sources of the modules of the local file system, installed from the configuration by init
+_REGEX_LOCAL_SOURCE = re.compile(r'^"(?P<path>\.\.?[/\\][^"]*)"$')
+
+
+def _block(content, start):
+    """
+    :param content: content of a .tf file
+    :param start: position following the opening brace of a block
+    :return: body of the block
+    """
+    depth = 1
+    end = start
+    while depth > 0 and end < len(content):
+        if content[end] == '{':
+            depth += 1
+        elif content[end] == '}':
+            depth -= 1
+        end += 1
+    return content[start:end]
+
+
+def _module_sources(content):
+    """
+    Extract the source and version attributes of every module block of a .tf file
+    :param content: content of the .tf file
+    :return: list of (module name, attribute, value)
+    """
+    sources = []
+    for m in _REGEX_MODULE_BLOCK.finditer(content):
+        for attr in _REGEX_MODULE_ATTRIBUTE.finditer(_block(content, m.end())):
+            sources.append((m.group('name'), attr.group('key'), attr.group('value')))
+    return sources
+
+
+def _terraform_blocks(content):
+    """
+    Extract the terraform blocks of a .tf file (required_version, required_providers, backend...)
+    :param content: content of the .tf file
+    :return: list of the bodies of the blocks, without indentation and blank lines
+    """
+    blocks = []
+    for m in _REGEX_TERRAFORM_BLOCK.finditer(content):
+        lines = (line.strip() for line in _block(content, m.end()).splitlines())
+        blocks.append('\n'.join(line for line in lines if line))
+    return blocks
+
+
+def _update_module(digest, module_dir, root_dir, visited):
+    """
+    hash the terraform blocks and the module sources of a module, then of its local modules
+    """
+    module_dir = os.path.normpath(module_dir)
+    if module_dir in visited:
+        return
+    visited.add(module_dir)
+    prefix = os.path.relpath(module_dir, root_dir)
+    local_dirs = []
+    for tf_file in sorted(glob.glob(os.path.join(module_dir, '*.tf'))):
+        with open(tf_file, encoding='utf-8', errors='replace') as f:
+            content = f.read()
+        file_name = os.path.join(prefix, os.path.basename(tf_file)) if prefix != '.' else os.path.basename(tf_file)
+        for block in _terraform_blocks(content):
+            digest.update('{0}:terraform={1}\n'.format(file_name, block).encode('utf-8'))
+        for name, key, value in _module_sources(content):
+            digest.update('{0}:{1}.{2}={3}\n'.format(file_name, name, key, value).encode('utf-8'))
+            m = _REGEX_LOCAL_SOURCE.match(value) if key == 'source' else None
+            if m is not None:
+                local_dirs.append(os.path.join(module_dir, m.group('path')))
+    for local_dir in local_dirs:
+        _update_module(digest, local_dir, root_dir, visited)
+
+
+def compute(working_dir, backend_config, terraform_version, options=None):
+    """
+    Compute the init fingerprint of a terraform configuration: the backend config, the options of init, the terraform version,
+    the lock file, the terraform blocks (required_providers, backend...) and the module sources of
+    the root module and, recursively, of its local modules
+    :param working_dir: the folder of the terraform configuration
+    :param backend_config: dictionary of backend config options passed to init
+    :param terraform_version: version of the terraform binary
+    :param options: other options of init (reconfigure, plugin_dir, get...)
+    :return: hex digest of the fingerprint
+    """
+    working_dir = working_dir or '.'
+    digest = hashlib.sha256()
+    digest.update(json.dumps(backend_config or {}, sort_keys=True, default=str).encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(json.dumps(options or {}, sort_keys=True, default=str).encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(str(terraform_version).encode('utf-8'))
+    digest.update(b'\0')
+
+    lock_file = os.path.join(working_dir, '.terraform.lock.hcl')
+    if os.path.exists(lock_file):
+        with open(lock_file, 'rb') as f:
+            digest.update(f.read())
+    digest.update(b'\0')
+
+    _update_module(digest, working_dir, os.path.normpath(working_dir), set())
+
+    return digest.hexdigest()
+
+
+def providers_intact(working_dir):
+    """
+    Check that the providers installed by the last init still exist,
+    the links to a shared plugin cache could have been evicted
+    :param working_dir: the folder of the terraform configuration
+    :return: False if a provider link is broken
+    """
+    providers_dir = os.path.join(working_dir or '.', '.terraform', 'providers')
+    for root, dirs, files in os.walk(providers_dir):
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            if os.path.islink(path) and not os.path.exists(path):
+                return False
+    return True
+
+
+def _fingerprint_path(working_dir):
+    return os.path.join(working_dir or '.', '.terraform', FINGERPRINT_FILE)
+
+
+def read(working_dir):
+    """
+    Read the fingerprint stored by the last successful init
+    :param working_dir: the folder of the terraform configuration
+    :return: the stored fingerprint or None
+    """
+    file_path = _fingerprint_path(working_dir)
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path) as f:
+        return f.read().strip()
+
+
+def write(working_dir, fingerprint):
+    """
+    Store the fingerprint of a successful init under .terraform/
+    :param working_dir: the folder of the terraform configuration
+    :param fingerprint: fingerprint to store
+    """
+    file_path = _fingerprint_path(working_dir)
+    if not os.path.isdir(os.path.dirname(file_path)):
+        return
+    with open(file_path, 'w') as f:
+        f.write(fingerprint)
+    log.debug('init fingerprint wrote to {0}'.format(file_path))
+
+
+def clear(working_dir):
+    """
+    Remove the stored fingerprint, the next init will be run
+    :param working_dir: the folder of the terraform configuration
+    """
+    file_path = _fingerprint_path(working_dir)
+    if os.path.exists(file_path):
+        os.unlink(file_path)
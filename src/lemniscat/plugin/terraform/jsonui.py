@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# above is for compatibility of python2.7.11
+
+import json
+import logging
+import time
+
+from lemniscat.core.util.helpers import LogUtil
+
+logging.setLoggerClass(LogUtil)
+log = logging.getLogger(__name__.replace('lemniscat.', ''))
+
+
+class JsonUiParser(object):
+    """
+    Incremental parser of the machine readable UI of terraform (-json option of plan, apply and destroy)
+    https://developer.hashicorp.com/terraform/internals/machine-readable-ui
+
+    Lines are fed one at a time, nothing but the results is kept in memory.
+    """
+
+    def __init__(self):
+        self.changes = None
+        self.planned_changes = {}
+        self.resource_durations = {}
+        # resources being applied: address -> action and start time (monotonic clock)
+        self._started = {}
+        self.diagnostics = []
+
+    def feed(self, line):
+        """
+        parse a line of stdout
+        :param line: a line of terraform output
+        :return: the event as a dict, None if the line isn't a JSON event
+        """
+        if not line.startswith('{'):
+            return None
+        try:
+            event = json.loads(line)
+        except ValueError:
+            return None
+
+        event_type = event.get('type')
+        if event_type == 'planned_change':
+            change = event.get('change', {})
+            self.planned_changes[change.get('resource', {}).get('addr')] = change.get('action')
+        elif event_type == 'apply_start':
+            hook = event.get('hook', {})
+            self._started[hook.get('resource', {}).get('addr')] = (hook.get('action'), time.monotonic())
+        elif event_type == 'apply_complete' or event_type == 'apply_errored':
+            hook = event.get('hook', {})
+            address = hook.get('resource', {}).get('addr')
+            started = self._started.pop(address, None)
+            elapsed = hook.get('elapsed_seconds')
+            if elapsed is None and started is not None:
+                elapsed = round(time.monotonic() - started[1])
+            self.resource_durations[address] = elapsed
+        elif event_type == 'change_summary':
+            self.changes = event.get('changes')
+        elif event_type == 'diagnostic':
+            diagnostic = event.get('diagnostic', {})
+            self.diagnostics.append({
+                'severity': diagnostic.get('severity'),
+                'summary': diagnostic.get('summary'),
+                'detail': diagnostic.get('detail'),
+                'address': diagnostic.get('address'),
+            })
+        return event
+
+    @property
+    def resources_in_flight(self):
+        """
+        :return: dict address -> action and elapsed seconds of the resources started and not completed yet
+                 (still running, or the command was stopped before they completed)
+        """
+        now = time.monotonic()
+        return {address: {'action': action, 'elapsed_seconds': round(now - start)}
+                for address, (action, start) in self._started.items()}
+
+    @property
+    def errors(self):
+        return [d for d in self.diagnostics if d['severity'] == 'error']
+
+    @property
+    def warnings(self):
+        return [d for d in self.diagnostics if d['severity'] == 'warning']
+
+    def results(self):
+        """
+        :return: dict with the change counts, the planned changes, the duration of each
+                 applied resource in seconds, the resources not completed and the diagnostics
+        """
+        return {
+            'changes': self.changes or {},
+            'planned_changes': self.planned_changes,
+            'resource_durations': self.resource_durations,
+            'resources_in_flight': self.resources_in_flight,
+            'diagnostics': self.diagnostics,
+        }
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+# above is for compatibility of python2.7.11
+
+import logging
+import os
+import re
+import threading
+import time
+
+from lemniscat.core.util.helpers import LogUtil
+
+logging.setLoggerClass(LogUtil)
+log = logging.getLogger(__name__.replace('lemniscat.', ''))
+
+_REGEX_PROGRESS = re.compile(r'^\s*(?P<address>\S+): Still (?P<action>creating|modifying|destroying|reading)\.\.\. \[(?P<elapsed>[^\]]*)\]\s*$')
+_REGEX_RESOURCE_LINE = re.compile(r'^\s*(?P<address>\S+): ')
+
+
+class LogSink(object):
+    """
+    Sink of the lines of the terraform commands of a task.
+
+    The info lines are logged by batches, when a line is received flush_interval seconds after the
+    first pending one, every batch_size lines and at the end of each command: the lines are logged by
+    the threads of the command, never after it's done. The 'Still creating... [10s elapsed]' lines of a resource are collapsed into one summary line,
+    logged when the resource is done. Once max_lines info lines are logged, the next ones are only
+    written to the overflow file. In quiet mode, only the warnings, the errors and the summary
+    are logged. Warnings and errors are always logged immediately, after the pending info lines.
+    """
+
+    def __init__(self, logger=None, flush_interval=0.5, batch_size=500, collapse_progress=True,
+                 max_lines=None, overflow_path=None, quiet=False):
+        """
+        :param logger: logger receiving the lines, set to the logger of Terraform if None
+        :param flush_interval: delay in seconds after which the pending info lines are logged with the next line,
+                0 to log each line
+        :param batch_size: maximum number of lines logged at once
+        :param collapse_progress: collapse the progress lines of each resource
+        :param max_lines: maximum number of info lines logged for the task
+        :param overflow_path: file receiving the info lines beyond max_lines
+        :param quiet: log only warnings, errors and the summary
+        """
+        self.logger = logger
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.collapse_progress = collapse_progress
+        self.max_lines = max_lines
+        self.overflow_path = overflow_path
+        self.quiet = quiet
+        self.total_lines = 0
+        self.logged_lines = 0
+        self.collapsed_lines = 0
+        self.overflow_lines = 0
+        self._batch = []
+        self._progress = {}
+        self._overflow = None
+        # monotonic time of the first pending line
+        self._batch_start = None
+        self._lock = threading.RLock()
+
+    def _logger(self):
+        return self.logger or log
+
+    def info(self, line):
+        with self._lock:
+            self.total_lines += 1
+            if self._batch and time.monotonic() - self._batch_start >= self.flush_interval:
+                self.flush()
+            if self.collapse_progress and self._collapse(line):
+                return
+            if self.quiet:
+                return
+            if not self._log(line):
+                return
+            if self.flush_interval <= 0 or len(self._batch) >= self.batch_size:
+                self.flush()
+
+    def _log(self, line):
+        """
+        add an info line to the batch, or to the overflow file once max_lines lines are logged
+        :return: True if the line is in the batch
+        """
+        if self.max_lines is not None and self.logged_lines >= self.max_lines:
+            self._write_overflow(line)
+            return False
+        self.logged_lines += 1
+        if not self._batch:
+            self._batch_start = time.monotonic()
+        self._batch.append(line)
+        return True
+
+    def warning(self, line):
+        with self._lock:
+            self.total_lines += 1
+            self.flush()
+            self._logger().warning(line)
+
+    def error(self, line):
+        with self._lock:
+            self.total_lines += 1
+            self.flush()
+            self._logger().error(line)
+
+    def _collapse(self, line):
+        """
+        :return: True if the line is a progress line
+        """
+        m = _REGEX_PROGRESS.match(line)
+        if m is not None:
+            count, _ = self._progress.get(m.group('address'), (0, None))
+            self._progress[m.group('address')] = (count + 1, line.strip())
+            self.collapsed_lines += 1
+            return True
+        m = _REGEX_RESOURCE_LINE.match(line)
+        if m is not None and m.group('address') in self._progress:
+            # the resource is done, summarize its progress before its last line
+            self._summarize(m.group('address'))
+        return False
+
+    def _summarize(self, address):
+        count, last = self._progress.pop(address)
+        if self.quiet:
+            return
+        self._log(f'  {last} ({count} progress lines collapsed)')
+
+    def _write_overflow(self, line):
+        self.overflow_lines += 1
+        if self.overflow_path is None:
+            return
+        if self._overflow is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.overflow_path)), exist_ok=True)
+            self._overflow = open(self.overflow_path, 'a', encoding='utf-8')
+        self._overflow.write(line)
+        self._overflow.write('\n')
+
+    def flush(self):
+        """
+        log the pending info lines as one message
+        """
+        with self._lock:
+            if self._batch:
+                batch = self._batch
+                self._batch = []
+                self._logger().info('\n'.join(batch))
+
+    def end_command(self):
+        """
+        log the progress summaries and the pending lines at the end of a command
+        """
+        with self._lock:
+            for address in list(self._progress.keys()):
+                self._summarize(address)
+            self.flush()
+            if self._overflow is not None:
+                self._overflow.flush()
+
+    def close(self):
+        """
+        log the summary of the task and close the overflow file
+        :return: dict with the number of lines received, logged, collapsed and written to the overflow file
+        """
+        with self._lock:
+            self.end_command()
+            if self._overflow is not None:
+                self._overflow.close()
+                self._overflow = None
+            summary = {
+                'lines': self.total_lines,
+                'logged': self.logged_lines,
+                'collapsed': self.collapsed_lines,
+                'overflow': self.overflow_lines,
+            }
+            message = '{lines} lines of terraform output, {collapsed} progress lines collapsed'.format(**summary)
+            if self.overflow_lines > 0:
+                message += ', {0} lines over the budget of {1}'.format(self.overflow_lines, self.max_lines)
+                if self.overflow_path is not None:
+                    message += ' written to {0}'.format(self.overflow_path)
+            if self.quiet or self.collapsed_lines > 0 or self.overflow_lines > 0:
+                self._logger().info(message)
+            return summary
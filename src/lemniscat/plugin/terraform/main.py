@@ -1,14 +1,30 @@
 
 import argparse
 import ast
+import importlib
+import json
 import logging
 import os
 from logging import Logger
 import re
+import threading
 from lemniscat.core.contract.engine_contract import PluginCore
 from lemniscat.core.model.models import Meta, TaskResult, VariableValue
 from lemniscat.core.util.helpers import FileSystem, LogUtil
 from lemniscat.plugin.terraform.azurecli import AzureCli
+from lemniscat.plugin.terraform.credcache import CredentialCache
+from lemniscat.plugin.terraform.environment import EnvOverlay
+from lemniscat.plugin.terraform.metrics import Metrics
+from lemniscat.plugin.terraform.logsink import LogSink
+from lemniscat.plugin.terraform.models import TerraformTaskResult
+from lemniscat.plugin.terraform.parallelism import ParallelismTuner, history_path
+from lemniscat.plugin.terraform.redaction import Redactor
+from lemniscat.plugin.terraform import bulkimport
+from lemniscat.plugin.terraform import plancache
+from lemniscat.plugin.terraform import processes
+from lemniscat.plugin.terraform import stacks
+from lemniscat.plugin.terraform import statedelta
+from lemniscat.plugin.terraform import workspaces
 
 from lemniscat.plugin.terraform.terraform import Terraform
 
@@ -25,10 +41,20 @@ class Action(PluginCore):
             description=manifest_data['description'],
             version=manifest_data['version']
         )
+        # secrets masked in the logs, kept between the tasks of a plugin worker
+        self.redactor = Redactor()
+        # environment of the task replacing os.environ, set by the plugin worker to the environment of its client
+        self.base_env = None
+        # storage account key of the task taken from the credential cache, refreshed once if the backend rejects it
+        self.cached_access_key = None
+        self.access_key_lock = threading.Lock()
         
     def set_backend_config(self) -> dict:
-        # set backend config
+        # set backend config, the backend credentials are kept in self.env (not in os.environ)
         backend_config = {}
+        self.backend_errors = [0x0001]
+        self.env = EnvOverlay(base=self.base_env)
+        self.cached_access_key = None
         #override configuration with backend configuration
         if(self.parameters.keys().__contains__('backend')):
             if(self.parameters['backend'].keys().__contains__('backend_type')):
@@ -57,11 +83,23 @@ class Action(PluginCore):
         # set backend config for azure
         if(self.variables['tf.backend_type'].value == 'azurerm'):
             if(not self.variables.keys().__contains__('tf.arm_access_key') or self.variables["tf.arm_access_key"].value is None or len(self.variables["tf.arm_access_key"].value) == 0):
-                cli = AzureCli()
-                cli.run(self.variables["tf.storage_account_name"].value)
+                cli = AzureCli(self.metrics, env=self.env, redactor=self.redactor, **self.timeouts)
+                result = cli.run(self.variables["tf.storage_account_name"].value, self.set_credential_cache())
+                if(cli.timed_out):
+                    self.timed_out = True
+                    self._logger.error('Azure CLI timed out, no storage account key')
+                    self.backend_errors = ['Azure CLI timed out, no storage account key']
+                    return backend_config
+                access_key = result[3].get('arm_access_key')
+                if(result[0] != 0 or not access_key):
+                    self._logger.error('No storage account key retrieved with Azure CLI')
+                    self.backend_errors = [self.redactor.redact(line) for line in (result[2] or '').splitlines() if line.strip()] or ['No storage account key retrieved with Azure CLI']
+                    return backend_config
+                self.cached_access_key = access_key if cli.cache_hit else None
+                self.env = self.env.union({'ARM_ACCESS_KEY': access_key})
             else:
-                os.environ["ARM_ACCESS_KEY"] = self.variables["tf.arm_access_key"].value
-            super().appendVariables({ "tf.arm_access_key": VariableValue(os.environ["ARM_ACCESS_KEY"], True), 'tf.storage_account_name': self.variables["tf.storage_account_name"], 'tf.container_name': self.variables["tf.container_name"], 'tf.key': self.variables["tf.key"] })
+                self.env = self.env.union({'ARM_ACCESS_KEY': self.variables["tf.arm_access_key"].value})
+            self.appendVariables({ "tf.arm_access_key": VariableValue(self.env.get('ARM_ACCESS_KEY'), True), 'tf.storage_account_name': self.variables["tf.storage_account_name"], 'tf.container_name': self.variables["tf.container_name"], 'tf.key': self.variables["tf.key"] })
             backend_config = {'storage_account_name': self.variables["tf.storage_account_name"].value, 'container_name': self.variables["tf.container_name"].value, 'key': self.variables["tf.key"].value}
         
         # set backend config for AWS s3
@@ -75,13 +113,66 @@ class Action(PluginCore):
 
             # override environment configuration with aws configuration
             if(self.variables.keys().__contains__('tf.aws_access_key')):
-                os.environ["AWS_ACCESS_KEY_ID"] = self.variables["tf.aws_access_key"].value
+                self.env = self.env.union({'AWS_ACCESS_KEY_ID': self.variables["tf.aws_access_key"].value})
             if(self.variables.keys().__contains__('tf.aws_secret_key')):
-                os.environ["AWS_SECRET_ACCESS_KEY"] = self.variables["tf.aws_secret_key"].value
+                self.env = self.env.union({'AWS_SECRET_ACCESS_KEY': self.variables["tf.aws_secret_key"].value})
 
             backend_config = {'bucket': self.variables["tf.bucket"].value, 'key': self.variables["tf.key"].value, 'region': self.variables["tf.region"].value}
+        self.redactor.add_environ(self.env)
         return backend_config
     
+    def __refresh_access_key(self, rejected_key: str, err: str) -> bool:
+        # a cached storage account key rejected by the backend has been rotated, it is retrieved again once for all the stacks
+        if(rejected_key is None or not AzureCli.is_key_rejected(err)):
+            return False
+        with self.access_key_lock:
+            if(self.env.get('ARM_ACCESS_KEY') != rejected_key):
+                # already refreshed by another stack
+                return True
+            if(self.cached_access_key != rejected_key):
+                return False
+            self.cached_access_key = None
+            cli = AzureCli(self.metrics, env=self.env, redactor=self.redactor, **self.timeouts)
+            result = cli.refresh(self.variables["tf.storage_account_name"].value, self.set_credential_cache())
+            access_key = result[3].get('arm_access_key')
+            if(result[0] != 0 or not access_key):
+                self._logger.error('No storage account key retrieved with Azure CLI')
+                return False
+            self.env = self.env.union({'ARM_ACCESS_KEY': access_key})
+            self.appendVariables({'tf.arm_access_key': VariableValue(access_key, True)})
+        return True
+
+    def set_credential_cache(self) -> CredentialCache:
+        # set cache of the storage account keys retrieved with Azure CLI
+        cache_file = None
+        ttl = 3600
+        if(self.variables.keys().__contains__('tf.credentialCacheFile')):
+            cache_file = self.variables['tf.credentialCacheFile'].value
+        if(self.parameters.keys().__contains__('credentialCacheFile')):
+            cache_file = self.parameters['credentialCacheFile']
+        if(self.variables.keys().__contains__('tf.credentialCacheTtl')):
+            ttl = int(self.variables['tf.credentialCacheTtl'].value)
+        if(self.parameters.keys().__contains__('credentialCacheTtl')):
+            ttl = int(self.parameters['credentialCacheTtl'])
+        return CredentialCache(cache_file, ttl)
+
+    def set_metrics(self) -> Metrics:
+        # set the JSON lines trace file and the hook (module:function) receiving the measures
+        trace_file = None
+        hook = None
+        if(self.variables.keys().__contains__('tf.metricsTraceFile')):
+            trace_file = self.variables['tf.metricsTraceFile'].value
+        if(self.parameters.keys().__contains__('metricsTraceFile')):
+            trace_file = self.parameters['metricsTraceFile']
+        if(self.variables.keys().__contains__('tf.metricsHook')):
+            hook = self.variables['tf.metricsHook'].value
+        if(self.parameters.keys().__contains__('metricsHook')):
+            hook = self.parameters['metricsHook']
+        if(hook is not None):
+            module_name, function_name = hook.split(':', 1)
+            hook = getattr(importlib.import_module(module_name), function_name)
+        return Metrics(trace_file, hook)
+
     def set_tf_var_file(self) -> str:
         # set terraform var file
         var_file = None
@@ -100,8 +191,425 @@ class Action(PluginCore):
             tfplan_file = self.parameters['tfplanFile']  
         return tfplan_file
 
+    def set_force_init(self) -> bool:
+        # force terraform init even if nothing changed since the last init
+        force_init = False
+        if(self.variables.keys().__contains__('tf.forceInit')):
+            force_init = str(self.variables['tf.forceInit'].value).lower() == 'true'
+        if(self.parameters.keys().__contains__('forceInit')):
+            force_init = str(self.parameters['forceInit']).lower() == 'true'
+        return force_init
+
+    def set_force_apply(self) -> bool:
+        # force terraform apply even if the plan file has no changes
+        force_apply = False
+        if(self.variables.keys().__contains__('tf.forceApply')):
+            force_apply = str(self.variables['tf.forceApply'].value).lower() == 'true'
+        if(self.parameters.keys().__contains__('forceApply')):
+            force_apply = str(self.parameters['forceApply']).lower() == 'true'
+        return force_apply
+
+    def set_state_delta(self) -> bool:
+        # compare the state before and after apply/destroy to publish the changed resources
+        state_delta = False
+        if(self.variables.keys().__contains__('tf.stateDelta')):
+            state_delta = str(self.variables['tf.stateDelta'].value).lower() == 'true'
+        if(self.parameters.keys().__contains__('stateDelta')):
+            state_delta = str(self.parameters['stateDelta']).lower() == 'true'
+        return state_delta
+
+    def set_plugin_cache(self) -> tuple:
+        # set shared provider plugin cache folder and maximum size (in MB)
+        plugin_cache_dir = None
+        plugin_cache_max_size = None
+        if(self.variables.keys().__contains__('tf.pluginCacheDir')):
+            plugin_cache_dir = self.variables['tf.pluginCacheDir'].value
+        if(self.parameters.keys().__contains__('pluginCacheDir')):
+            plugin_cache_dir = self.parameters['pluginCacheDir']
+        if(self.variables.keys().__contains__('tf.pluginCacheMaxSize')):
+            plugin_cache_max_size = int(self.variables['tf.pluginCacheMaxSize'].value) * 1024 * 1024
+        if(self.parameters.keys().__contains__('pluginCacheMaxSize')):
+            plugin_cache_max_size = int(self.parameters['pluginCacheMaxSize']) * 1024 * 1024
+        return plugin_cache_dir, plugin_cache_max_size
+
+    def set_versions_dir(self) -> str:
+        # set the folder of terraform versions, the binary is chosen from the required_version of each stack
+        versions_dir = None
+        if(self.variables.keys().__contains__('tf.versionsDir')):
+            versions_dir = self.variables['tf.versionsDir'].value
+        if(self.parameters.keys().__contains__('versionsDir')):
+            versions_dir = self.parameters['versionsDir']
+        return versions_dir
+
+    def set_plan_cache(self) -> tuple:
+        # set plan cache folder and maximum size (in MB)
+        plan_cache_dir = None
+        plan_cache_max_size = None
+        if(self.variables.keys().__contains__('tf.planCacheDir')):
+            plan_cache_dir = self.variables['tf.planCacheDir'].value
+        if(self.parameters.keys().__contains__('planCacheDir')):
+            plan_cache_dir = self.parameters['planCacheDir']
+        if(self.variables.keys().__contains__('tf.planCacheMaxSize')):
+            plan_cache_max_size = int(self.variables['tf.planCacheMaxSize'].value) * 1024 * 1024
+        if(self.parameters.keys().__contains__('planCacheMaxSize')):
+            plan_cache_max_size = int(self.parameters['planCacheMaxSize']) * 1024 * 1024
+        return plan_cache_dir, plan_cache_max_size
+
+    def set_json_output(self) -> bool:
+        # use the machine readable UI of terraform for plan, apply and destroy
+        json_output = False
+        if(self.variables.keys().__contains__('tf.jsonOutput')):
+            json_output = str(self.variables['tf.jsonOutput'].value).lower() == 'true'
+        if(self.parameters.keys().__contains__('jsonOutput')):
+            json_output = str(self.parameters['jsonOutput']).lower() == 'true'
+        return json_output
+
+    def set_capture(self, tfpath: str) -> tuple:
+        # set the number of lines/bytes of output kept in memory and the folder receiving the whole output
+        max_lines = None
+        max_bytes = None
+        spill_dir = None
+        if(self.variables.keys().__contains__('tf.captureMaxLines')):
+            max_lines = int(self.variables['tf.captureMaxLines'].value)
+        if(self.parameters.keys().__contains__('captureMaxLines')):
+            max_lines = int(self.parameters['captureMaxLines'])
+        if(self.variables.keys().__contains__('tf.captureMaxBytes')):
+            max_bytes = int(self.variables['tf.captureMaxBytes'].value)
+        if(self.parameters.keys().__contains__('captureMaxBytes')):
+            max_bytes = int(self.parameters['captureMaxBytes'])
+        if(self.variables.keys().__contains__('tf.captureSpillDir')):
+            spill_dir = self.variables['tf.captureSpillDir'].value
+        if(self.parameters.keys().__contains__('captureSpillDir')):
+            spill_dir = self.parameters['captureSpillDir']
+        if(spill_dir is None and (max_lines is not None or max_bytes is not None)):
+            spill_dir = os.path.join(tfpath, '.terraform', 'logs')
+        return max_lines, max_bytes, spill_dir
+
+    def set_log_sink(self, tfpath: str) -> LogSink:
+        # set how the output of terraform is logged: flush interval (seconds), line budget, overflow file, quiet mode
+        options = {'flush_interval': 0.5, 'collapse_progress': True, 'max_lines': None, 'overflow_path': None, 'quiet': False}
+        if(self.variables.keys().__contains__('tf.logFlushInterval')):
+            options['flush_interval'] = float(self.variables['tf.logFlushInterval'].value)
+        if(self.parameters.keys().__contains__('logFlushInterval')):
+            options['flush_interval'] = float(self.parameters['logFlushInterval'])
+        if(self.variables.keys().__contains__('tf.logCollapseProgress')):
+            options['collapse_progress'] = str(self.variables['tf.logCollapseProgress'].value).lower() == 'true'
+        if(self.parameters.keys().__contains__('logCollapseProgress')):
+            options['collapse_progress'] = str(self.parameters['logCollapseProgress']).lower() == 'true'
+        if(self.variables.keys().__contains__('tf.logMaxLines')):
+            options['max_lines'] = int(self.variables['tf.logMaxLines'].value)
+        if(self.parameters.keys().__contains__('logMaxLines')):
+            options['max_lines'] = int(self.parameters['logMaxLines'])
+        if(self.variables.keys().__contains__('tf.logOverflowFile')):
+            options['overflow_path'] = self.variables['tf.logOverflowFile'].value
+        if(self.parameters.keys().__contains__('logOverflowFile')):
+            options['overflow_path'] = self.parameters['logOverflowFile']
+        if(self.variables.keys().__contains__('tf.logQuiet')):
+            options['quiet'] = str(self.variables['tf.logQuiet'].value).lower() == 'true'
+        if(self.parameters.keys().__contains__('logQuiet')):
+            options['quiet'] = str(self.parameters['logQuiet']).lower() == 'true'
+        if(options['overflow_path'] is None and options['max_lines'] is not None):
+            options['overflow_path'] = os.path.join(tfpath, '.terraform', 'logs', 'output-overflow.log')
+        return LogSink(**options)
+
+    def set_state_lock(self) -> dict:
+        # set the -lock-timeout of terraform and the retries (with a backoff in seconds) when the state is locked
+        options = {'lock_timeout': None, 'lock_retries': 3, 'lock_retry_delay': 5, 'lock_retry_max_delay': 60}
+        if(self.variables.keys().__contains__('tf.lockTimeout')):
+            options['lock_timeout'] = self.variables['tf.lockTimeout'].value
+        if(self.parameters.keys().__contains__('lockTimeout')):
+            options['lock_timeout'] = self.parameters['lockTimeout']
+        if(self.variables.keys().__contains__('tf.lockRetries')):
+            options['lock_retries'] = int(self.variables['tf.lockRetries'].value)
+        if(self.parameters.keys().__contains__('lockRetries')):
+            options['lock_retries'] = int(self.parameters['lockRetries'])
+        if(self.variables.keys().__contains__('tf.lockRetryDelay')):
+            options['lock_retry_delay'] = float(self.variables['tf.lockRetryDelay'].value)
+        if(self.parameters.keys().__contains__('lockRetryDelay')):
+            options['lock_retry_delay'] = float(self.parameters['lockRetryDelay'])
+        if(self.variables.keys().__contains__('tf.lockRetryMaxDelay')):
+            options['lock_retry_max_delay'] = float(self.variables['tf.lockRetryMaxDelay'].value)
+        if(self.parameters.keys().__contains__('lockRetryMaxDelay')):
+            options['lock_retry_max_delay'] = float(self.parameters['lockRetryMaxDelay'])
+        return options
+
+    def set_timeouts(self) -> dict:
+        # set the maximum durations in seconds of each command and of the task, and the grace period before a stopped command is killed
+        options = {'command_timeout': None, 'task_timeout': None, 'kill_grace_period': processes.GRACE_PERIOD}
+        if(self.variables.keys().__contains__('tf.commandTimeout')):
+            options['command_timeout'] = float(self.variables['tf.commandTimeout'].value)
+        if(self.parameters.keys().__contains__('commandTimeout')):
+            options['command_timeout'] = float(self.parameters['commandTimeout'])
+        if(self.variables.keys().__contains__('tf.taskTimeout')):
+            options['task_timeout'] = float(self.variables['tf.taskTimeout'].value)
+        if(self.parameters.keys().__contains__('taskTimeout')):
+            options['task_timeout'] = float(self.parameters['taskTimeout'])
+        if(self.variables.keys().__contains__('tf.killGracePeriod')):
+            options['kill_grace_period'] = float(self.variables['tf.killGracePeriod'].value)
+        if(self.parameters.keys().__contains__('killGracePeriod')):
+            options['kill_grace_period'] = float(self.parameters['killGracePeriod'])
+        return options
+
+    def set_parallelism(self, tfpath: str) -> tuple:
+        # set a fixed -parallelism, or the bounds of the -parallelism chosen from the previous runs of the stack
+        parallelism = None
+        adaptive = False
+        bounds = {'min_parallelism': 2, 'max_parallelism': 50}
+        if(self.variables.keys().__contains__('tf.parallelism')):
+            parallelism = int(self.variables['tf.parallelism'].value)
+        if(self.parameters.keys().__contains__('parallelism')):
+            parallelism = int(self.parameters['parallelism'])
+        if(self.variables.keys().__contains__('tf.adaptiveParallelism')):
+            adaptive = str(self.variables['tf.adaptiveParallelism'].value).lower() == 'true'
+        if(self.parameters.keys().__contains__('adaptiveParallelism')):
+            adaptive = str(self.parameters['adaptiveParallelism']).lower() == 'true'
+        if(self.variables.keys().__contains__('tf.minParallelism')):
+            bounds['min_parallelism'] = int(self.variables['tf.minParallelism'].value)
+        if(self.parameters.keys().__contains__('minParallelism')):
+            bounds['min_parallelism'] = int(self.parameters['minParallelism'])
+        if(self.variables.keys().__contains__('tf.maxParallelism')):
+            bounds['max_parallelism'] = int(self.variables['tf.maxParallelism'].value)
+        if(self.parameters.keys().__contains__('maxParallelism')):
+            bounds['max_parallelism'] = int(self.parameters['maxParallelism'])
+        tuner = ParallelismTuner(history_path(tfpath), **bounds) if adaptive and parallelism is None else None
+        return parallelism, tuner
+
+    def set_import(self) -> tuple:
+        # set the file of the resources to import (address -> id) and the number of resources imported at once
+        import_file = None
+        batch_size = None
+        if(self.variables.keys().__contains__('tf.importFile')):
+            import_file = self.variables['tf.importFile'].value
+        if(self.parameters.keys().__contains__('importFile')):
+            import_file = self.parameters['importFile']
+        if(self.variables.keys().__contains__('tf.importBatchSize')):
+            batch_size = int(self.variables['tf.importBatchSize'].value)
+        if(self.parameters.keys().__contains__('importBatchSize')):
+            batch_size = int(self.parameters['importBatchSize'])
+        return import_file, batch_size
+
+    def set_state_operations(self) -> tuple:
+        # set the state mv/rm operations applied with one pull and one push of the state, and the dry run mode
+        operations = []
+        dry_run = False
+        if(self.variables.keys().__contains__('tf.stateOperations')):
+            operations = self.variables['tf.stateOperations'].value
+        if(self.parameters.keys().__contains__('stateOperations')):
+            operations = self.parameters['stateOperations']
+        if(self.variables.keys().__contains__('tf.stateDryRun')):
+            dry_run = str(self.variables['tf.stateDryRun'].value).lower() == 'true'
+        if(self.parameters.keys().__contains__('stateDryRun')):
+            dry_run = str(self.parameters['stateDryRun']).lower() == 'true'
+        return operations, dry_run
+
+    def set_stacks(self) -> tuple:
+        # set stacks, their dependencies and the number of stacks run in parallel
+        dependencies = {}
+        max_workers = 4
+        if(self.parameters.keys().__contains__('stackDependencies')):
+            dependencies = self.parameters['stackDependencies']
+        if(self.variables.keys().__contains__('tf.maxParallelStacks')):
+            max_workers = int(self.variables['tf.maxParallelStacks'].value)
+        if(self.parameters.keys().__contains__('maxParallelStacks')):
+            max_workers = int(self.parameters['maxParallelStacks'])
+        return stacks.resolve_stacks(self.parameters['tfPath']), dependencies, max_workers
+
+    def set_workspaces(self) -> tuple:
+        # set the workspaces the action is run on and the number of workspaces run in parallel
+        tf_workspaces = []
+        max_workers = 4
+        if(self.variables.keys().__contains__('tf.workspaces')):
+            tf_workspaces = self.variables['tf.workspaces'].value
+        if(self.parameters.keys().__contains__('workspaces')):
+            tf_workspaces = self.parameters['workspaces']
+        if(isinstance(tf_workspaces, str)):
+            tf_workspaces = [w.strip() for w in tf_workspaces.split(',') if w.strip()]
+        if(self.variables.keys().__contains__('tf.maxParallelWorkspaces')):
+            max_workers = int(self.variables['tf.maxParallelWorkspaces'].value)
+        if(self.parameters.keys().__contains__('maxParallelWorkspaces')):
+            max_workers = int(self.parameters['maxParallelWorkspaces'])
+        return tf_workspaces, max_workers
+
+    def is_multi_stack(self) -> bool:
+        tfpath = self.parameters['tfPath']
+        return isinstance(tfpath, list) or any(c in tfpath for c in ('*', '?', '['))
+
+    def __stack_value(self, value: str, name: str) -> str:
+        # make a per stack value of a parameter shared by several stacks
+        if(value is None or not self.is_multi_stack()):
+            return value
+        if('{stack}' in value):
+            return value.replace('{stack}', name)
+        return f'{name}/{value}'
+
+    def __workspace_value(self, value: str, workspace: str) -> str:
+        # make a per workspace path of a file shared by the workspaces of a stack
+        if(value is None or workspace is None):
+            return value
+        if('{workspace}' in value):
+            return value.replace('{workspace}', workspace)
+        root, ext = os.path.splitext(value)
+        return f'{root}.{workspace}{ext}'
+
+    def __run_stack(self, name: str, tfpath: str, backendConfig: dict, var_file: str, prefix: str, workspace: str = None) -> dict:
+        # launch terraform command on one stack, in its own data dir when a workspace is given
+        command = self.parameters['action']
+        result = {}
+        outputs = {}
+        json_ui = self.set_json_output()
+        var_prefix = f'tf.{name}' if name else 'tf'
+        backendConfig = dict(backendConfig, key=self.__stack_value(backendConfig['key'], name))
+        tfplan_file = self.set_tfplan_file()
+        if(os.path.isabs(tfplan_file)):
+            tfplan_file = self.__stack_value(tfplan_file, name)
+        tfplan_file = self.__workspace_value(tfplan_file, workspace)
+        if(var_file is not None and workspace is not None):
+            var_file = var_file.replace('{workspace}', workspace)
+        data_dir = workspaces.prepare(tfpath, workspace) if workspace is not None else None
+
+        plugin_cache_dir, plugin_cache_max_size = self.set_plugin_cache()
+        capture_max_lines, capture_max_bytes, capture_spill_dir = self.set_capture(tfpath)
+        plan_cache_dir, plan_cache_max_size = self.set_plan_cache()
+        log_sink = self.set_log_sink(tfpath)
+        if(log_sink.overflow_path is not None and os.path.isabs(log_sink.overflow_path)):
+            log_sink.overflow_path = self.__stack_value(log_sink.overflow_path, name)
+        log_sink.overflow_path = self.__workspace_value(log_sink.overflow_path, workspace)
+        # the tasks of the host using the same state queue up on a local lock
+        state_lock_key = '{0}|{1}|{2}'.format(self.variables['tf.backend_type'].value, json.dumps(backendConfig, sort_keys=True, default=str),
+                                             workspace or plancache.workspace(tfpath, self.env.apply()))
+        parallelism, parallelism_tuner = self.set_parallelism(tfpath)
+        tf = Terraform(working_dir=tfpath, var_file=var_file, parallelism=parallelism, parallelism_tuner=parallelism_tuner, plugin_cache_dir=plugin_cache_dir, plugin_cache_max_size=plugin_cache_max_size,
+                       capture_max_lines=capture_max_lines, capture_max_bytes=capture_max_bytes, capture_spill_dir=capture_spill_dir,
+                       plan_cache_dir=plan_cache_dir, plan_cache_max_size=plan_cache_max_size, metrics=self.metrics,
+                       log_sink=log_sink, versions_dir=self.set_versions_dir(), env=self.env, data_dir=data_dir,
+                       redactor=self.redactor, state_lock_key=state_lock_key, **self.set_state_lock(), **self.timeouts)
+        if(workspace is not None):
+            # init runs once in .terraform before the fan-out, the workspace only needs to be selected in its data dir
+            result = tf.select_workspace(workspace)
+            if(result[0] != 0):
+                return dict(status='Failed', errors=result[2], outputs=outputs, output_artifacts=tf.output_artifacts, timed_out=tf.timed_out, log=log_sink.close())
+        if(command == 'init' and workspace is None):
+            result = tf.init(backend_config=backendConfig, use_fingerprint=not self.set_force_init())
+            if(result[0] != 0 and self.__refresh_access_key(tf.env.get('ARM_ACCESS_KEY'), result[2])):
+                tf.update_env({'ARM_ACCESS_KEY': self.env.get('ARM_ACCESS_KEY')})
+                result = tf.init(backend_config=backendConfig, use_fingerprint=not self.set_force_init())
+        elif(command == 'plan'):        
+            result = tf.plan(out=tfplan_file, json_ui=json_ui)
+            if(tf.plan_record is not None):
+                outputs[f'{var_prefix}.plan.hasChanges'] = VariableValue(tf.plan_record['has_changes'])
+                for key in ('add', 'change', 'destroy'):
+                    outputs[f'{var_prefix}.plan.{key}'] = VariableValue(tf.plan_record['summary'][key])
+        elif(command == 'apply'):
+            result = tf.apply(dir_or_plan=tfplan_file, json_ui=json_ui, skip_noop_plan=not self.set_force_apply(), state_delta=self.set_state_delta())
+            if(result[0] == 0):
+                outputs = tf.state_outputs(prefix=prefix) or {}
+        elif(command == 'destroy'):
+            result = tf.destroy(json_ui=json_ui, state_delta=self.set_state_delta())
+        elif(command == 'import'):
+            import_file, batch_size = self.set_import()
+            if(import_file is None):
+                return dict(status='Failed', errors=['importFile is required to import resources'], outputs=outputs, log=log_sink.close())
+            import_file = import_file.replace('{stack}', name or '').replace('{workspace}', workspace or '')
+            try:
+                mapping = bulkimport.read_mapping(import_file)
+            except (OSError, ValueError) as e:
+                return dict(status='Failed', errors=[str(e)], outputs=outputs, log=log_sink.close())
+            result = tf.bulk_import(mapping, batch_size=batch_size, json_ui=json_ui)
+            if(tf.import_results is not None):
+                for status in (bulkimport.IMPORTED, bulkimport.MANAGED, bulkimport.FAILED):
+                    addresses = [address for address, value in tf.import_results.items() if value == status]
+                    outputs[f'{var_prefix}.import.{status}'] = VariableValue(len(addresses))
+                    outputs[f'{var_prefix}.import.{status}Addresses'] = VariableValue(addresses)
+        elif(command == 'state'):
+            operations, dry_run = self.set_state_operations()
+            if(len(operations) == 0):
+                return dict(status='Failed', errors=['stateOperations is required to change the state'], outputs=outputs, log=log_sink.close())
+            result = tf.state_batch(operations, dry_run=dry_run)
+            if(tf.state_changes is not None):
+                moved = [change for change in tf.state_changes if change['operation'] == 'mv']
+                outputs[f'{var_prefix}.state.moved'] = VariableValue(len(moved))
+                outputs[f'{var_prefix}.state.removed'] = VariableValue(len(tf.state_changes) - len(moved))
+        if(tf.state_delta is not None):
+            for kind in statedelta.KINDS:
+                outputs[f'{var_prefix}.delta.{kind}'] = VariableValue(len(tf.state_delta[kind]))
+                outputs[f'{var_prefix}.delta.{kind}Addresses'] = VariableValue(tf.state_delta[kind])
+
+        details = {'output_artifacts': tf.output_artifacts, 'plan_cache_hit': tf.plan_cache_hit, 'state_delta': tf.state_delta,
+                   'state_lock_waits': tf.state_lock_waits, 'state_lock_retries': tf.state_lock_retries,
+                   'parallelism': tf.tuned_parallelism, 'throttles': tf.throttles, 'imports': tf.import_results or {},
+                   'state_changes': tf.state_changes or [], 'timed_out': tf.timed_out, 'log': log_sink.close()}
+        if(tf.json_ui is not None):
+            details.update(tf.json_ui.results())
+            if(len(details['resources_in_flight']) > 0):
+                self._logger.warning(f'Resources not completed: {", ".join(details["resources_in_flight"].keys())}')
+            for key, value in details['changes'].items():
+                if(isinstance(value, int)):
+                    outputs[f'{var_prefix}.changes.{key}'] = VariableValue(value)
+            outputs[f'{var_prefix}.diagnostics.errors'] = VariableValue(len(tf.json_ui.errors))
+            outputs[f'{var_prefix}.diagnostics.warnings'] = VariableValue(len(tf.json_ui.warnings))
+
+        if(result[0] != 0 and result[0] != 2):
+            errors = result[2]
+            # the partial output of a command stopped at its deadline is kept
+            if(tf.json_ui is not None and len(tf.json_ui.errors) > 0 and not tf.timed_out):
+                errors = [f'{d["summary"]}: {d["detail"]}' for d in tf.json_ui.errors]
+            return dict(details, status='Failed', errors=errors, outputs=outputs)
+        return dict(details, status='Completed', errors=[], outputs=outputs)
+
+    @staticmethod
+    def __aggregated_status(errors: list, results: dict) -> str:
+        # the task fails if a stack or a workspace failed or was skipped
+        return 'Failed' if len(errors) > 0 or any(r['status'] != 'Completed' for r in results.values()) else 'Completed'
+
+    def __run_workspaces(self, tf_workspaces: list, max_workers: int, backendConfig: dict, var_file: str, prefix: str) -> TaskResult:
+        # launch terraform command on several workspaces of one stack in parallel, each one in its own data dir
+        command = self.parameters['action']
+        if(self.is_multi_stack()):
+            self._logger.error('workspaces can\'t be used with several stacks')
+            return TerraformTaskResult(name=f'Terraform {command}', status='Failed', errors=['workspaces can\'t be used with several stacks'])
+        tfpath = self.parameters['tfPath']
+        if(command == 'init'):
+            # init once in .terraform, the data dirs of the workspaces are populated from it
+            result = self.__run_stack(None, tfpath, backendConfig, var_file, prefix)
+            if(result['status'] != 'Completed'):
+                return TerraformTaskResult(name=f'Terraform {command}', status='Failed', errors=result['errors'], timed_out=result.get('timed_out', False), metrics=self.metrics.summary())
+
+        self._logger.info(f'Terraform {command} on {len(tf_workspaces)} workspaces, {max_workers} in parallel')
+        results = stacks.run_stacks(
+            {workspace: tfpath for workspace in tf_workspaces},
+            lambda workspace, path: self.__run_stack(workspace, path, backendConfig, var_file, f'{prefix}.{workspace}' if prefix else workspace, workspace),
+            {},
+            max_workers)
+
+        errors = []
+        changes = {}
+        for workspace, result in results.items():
+            for key, value in result.get('changes', {}).items():
+                if(isinstance(value, int)):
+                    changes[key] = changes.get(key, 0) + value
+            self.appendVariables(result.pop('outputs', {}))
+            if(result['status'] == 'Failed'):
+                errors.append(f'{workspace}: {result["errors"]}')
+            self._logger.info(f'  {workspace}: {result["status"]} in {result["duration"]}s')
+        return TerraformTaskResult(
+            name=f'Terraform {command}',
+            status=self.__aggregated_status(errors, results),
+            errors=errors,
+            workspaces=results,
+            changes=changes,
+            state_lock_waits=sum(r.get('state_lock_waits', 0) for r in results.values()),
+            state_lock_retries=sum(r.get('state_lock_retries', 0) for r in results.values()),
+            timed_out=any(r.get('timed_out', False) for r in results.values()),
+            metrics=self.metrics.summary())
+
     def __run_terraform(self) -> TaskResult:
         # launch terraform command
+        self.metrics = self.set_metrics()
+        # the deadline of the task is shared by the commands of all the stacks and workspaces
+        timeouts = self.set_timeouts()
+        task_timeout = timeouts.pop('task_timeout')
+        self.timeouts = dict(timeouts, deadline=processes.Deadline(task_timeout) if task_timeout else None)
+        self.timed_out = False
         backendConfig = self.set_backend_config()
         
         # set terraform var file
@@ -111,47 +619,85 @@ class Action(PluginCore):
         command = self.parameters['action']
             
         if(backendConfig != {}):
-            result = {}
-            tfpath = self.parameters['tfPath']
-            tf = Terraform(working_dir=tfpath, var_file=var_file)
-            if(command == 'init'):
-                result = tf.init(backend_config=backendConfig)
-            elif(command == 'plan'):        
-                result = tf.plan(out=self.set_tfplan_file())
-            elif(command == 'apply'):
-                result = tf.apply(dir_or_plan=self.set_tfplan_file())
-                if(result[0] == 0):
-                    if(self.parameters.keys().__contains__('prefixOutput')):
-                        outputs = tf.output(prefix=self.parameters['prefixOutput'])
-                    else:
-                        outputs = tf.output()
-                    super().appendVariables(outputs)
-            elif(command == 'destroy'):
-                result = tf.destroy()
-            
-            if(result[0] != 0 and result[0] != 2):
-                return TaskResult(
-                    name=f'Terraform {command}',
-                    status='Failed',
-                    errors=result[2])
-            else:
-                return TaskResult(
+            prefix = None
+            if(self.parameters.keys().__contains__('prefixOutput')):
+                prefix = self.parameters['prefixOutput']
+
+            tf_workspaces, max_workspaces = self.set_workspaces()
+            if(len(tf_workspaces) > 0):
+                return self.__run_workspaces(tf_workspaces, max_workspaces, backendConfig, var_file, prefix)
+
+            if(not self.is_multi_stack()):
+                result = self.__run_stack(None, self.parameters['tfPath'], backendConfig, var_file, prefix)
+                self.appendVariables(result['outputs'])
+                return TerraformTaskResult(
                     name=f'Terraform {command}',
-                    status='Completed',
-                    errors=[])
+                    status=result['status'],
+                    errors=result['errors'],
+                    changes=result.get('changes', {}),
+                    resource_durations=result.get('resource_durations', {}),
+                    resources_in_flight=result.get('resources_in_flight', {}),
+                    diagnostics=result.get('diagnostics', []),
+                    output_artifacts=result.get('output_artifacts', {}),
+                    plan_cache_hit=result.get('plan_cache_hit'),
+                    state_delta=result.get('state_delta'),
+                    state_lock_waits=result.get('state_lock_waits', 0),
+                    state_lock_retries=result.get('state_lock_retries', 0),
+                    imports=result.get('imports', {}),
+                    state_changes=result.get('state_changes', []),
+                    timed_out=result.get('timed_out', False),
+                    metrics=self.metrics.summary())
+
+            tf_stacks, dependencies, max_workers = self.set_stacks()
+            self._logger.info(f'Terraform {command} on {len(tf_stacks)} stacks, {max_workers} in parallel')
+            results = stacks.run_stacks(
+                tf_stacks,
+                lambda name, tfpath: self.__run_stack(name, tfpath, backendConfig, var_file, f'{prefix}.{name}' if prefix else name),
+                dependencies,
+                max_workers)
+
+            errors = []
+            changes = {}
+            for name, result in results.items():
+                for key, value in result.get('changes', {}).items():
+                    if(isinstance(value, int)):
+                        changes[key] = changes.get(key, 0) + value
+                self.appendVariables(result.pop('outputs', {}))
+                if(result['status'] == 'Failed'):
+                    errors.append(f'{name}: {result["errors"]}')
+                self._logger.info(f'  {name}: {result["status"]} in {result["duration"]}s')
+            return TerraformTaskResult(
+                name=f'Terraform {command}',
+                status=self.__aggregated_status(errors, results),
+                errors=errors,
+                stacks=results,
+                changes=changes,
+                state_lock_waits=sum(r.get('state_lock_waits', 0) for r in results.values()),
+                state_lock_retries=sum(r.get('state_lock_retries', 0) for r in results.values()),
+                timed_out=any(r.get('timed_out', False) for r in results.values()),
+                metrics=self.metrics.summary())
         else:
             self._logger.error(f'No backend config found')
             
-            return TaskResult(
+            return TerraformTaskResult(
                 name=f'Terraform {command}',
                 status='Failed',
-                errors=[0x0001])
+                errors=self.backend_errors,
+                timed_out=self.timed_out)
         
 
+    def appendVariables(self, variables: dict) -> None:
+        self.redactor.add_variables(variables)
+        super().appendVariables(variables)
+
     def invoke(self, parameters: dict = {}, variables: dict = {}) -> TaskResult:
         super().invoke(parameters, variables)
+        self.redactor.add_variables(self.variables)
+        self.redactor.add_environ(os.environ if self.base_env is None else self.base_env)
         self._logger.debug(f'Command: {self.parameters["action"]} -> {self.meta}')
-        task = self.__run_terraform()
+        # the commands run in their own process groups, SIGINT and SIGTERM are forwarded to them
+        with processes.forward_signals():
+            task = self.__run_terraform()
         return task
     
     def test_logger(self) -> None:
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# above is for compatibility of python2.7.11
+
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from lemniscat.core.util.helpers import LogUtil
+
+logging.setLoggerClass(LogUtil)
+log = logging.getLogger(__name__.replace('lemniscat.', ''))
+
+
+def wait_rusage(process):
+    """
+    wait for a process and get the resources it used
+    :param process: subprocess.Popen object
+    :return: resource.struct_rusage of the process, None if not available on the platform
+    """
+    if not hasattr(os, 'wait4') or process.returncode is not None:
+        process.wait()
+        return None
+    try:
+        pid, status, rusage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        # already reaped
+        process.wait()
+        return None
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return rusage
+
+
+class Metrics(object):
+    """
+    Measures of the phases of a task (terraform commands, Azure CLI, state loading, outputs).
+
+    Each measure is a flat dict with at least 'phase', 'time' (epoch of the end of the phase)
+    and 'wall_s'. It is kept in records, appended to the JSON lines trace file if any and
+    passed to the hook. Metrics can be shared between threads.
+    """
+
+    def __init__(self, trace_file=None, hook=None):
+        """
+        :param trace_file: path of a JSON lines file receiving each measure
+        :param hook: callable receiving each measure, ex. to forward it to a telemetry system
+        """
+        self.trace_file = trace_file
+        self.hook = hook
+        self.records = []
+        self._lock = threading.Lock()
+        if trace_file:
+            os.makedirs(os.path.dirname(os.path.abspath(trace_file)), exist_ok=True)
+
+    def record(self, phase, **values):
+        """
+        record a measure
+        :param phase: name of the phase, ex. 'terraform plan'
+        :param values: measured values
+        :return: the measure
+        """
+        measure = dict(phase=phase, time=round(time.time(), 3), **values)
+        with self._lock:
+            self.records.append(measure)
+            if self.trace_file:
+                with open(self.trace_file, 'a') as f:
+                    f.write(json.dumps(measure, default=str) + '\n')
+        if self.hook is not None:
+            try:
+                self.hook(measure)
+            except Exception as e:
+                log.warning('metrics hook failed: {0}'.format(e))
+        return measure
+
+    @contextmanager
+    def measure(self, phase, **values):
+        """
+        measure the wall time of a block, values can be added to the yielded dict
+        """
+        start = time.perf_counter()
+        try:
+            yield values
+        finally:
+            self.record(phase, wall_s=round(time.perf_counter() - start, 6), **values)
+
+    def record_process(self, phase, start, spawned, pump, rusage, ret_code, **values):
+        """
+        record the measure of a process
+        :param phase: name of the phase
+        :param start: perf_counter before the process was started
+        :param spawned: perf_counter after the process was started
+        :param pump: StreamPump which read the output of the process, None if not read
+        :param rusage: resources used by the process, see wait_rusage
+        :param ret_code: exit code of the process
+        :return: the measure
+        """
+        end = time.perf_counter()
+        values['wall_s'] = round(end - start, 6)
+        values['spawn_s'] = round(spawned - start, 6)
+        if pump is not None:
+            values['ttfb_s'] = round(pump.first_data_time - start, 6) if pump.first_data_time else None
+            # keys of line_counts are pump.STDOUT and pump.STDERR
+            values['lines_stdout'] = pump.line_counts[1]
+            values['lines_stderr'] = pump.line_counts[2]
+        if rusage is not None:
+            values['cpu_user_s'] = round(rusage.ru_utime, 6)
+            values['cpu_system_s'] = round(rusage.ru_stime, 6)
+            # kilobytes on Linux, bytes on macOS
+            values['max_rss_kb'] = rusage.ru_maxrss // 1024 if sys.platform == 'darwin' else rusage.ru_maxrss
+        values['ret_code'] = ret_code
+        return self.record(phase, **values)
+
+    def summary(self):
+        """
+        :return: dict with the totals by phase (count, wall_s, cpu_s, max_rss_kb, lines)
+                 and the list of the measures
+        """
+        phases = {}
+        with self._lock:
+            records = list(self.records)
+        for measure in records:
+            total = phases.setdefault(measure['phase'], {'count': 0, 'wall_s': 0.0})
+            total['count'] += 1
+            total['wall_s'] = round(total['wall_s'] + measure.get('wall_s', 0.0), 6)
+            if 'cpu_user_s' in measure:
+                total['cpu_s'] = round(total.get('cpu_s', 0.0) + measure['cpu_user_s'] + measure['cpu_system_s'], 6)
+                total['max_rss_kb'] = max(total.get('max_rss_kb', 0), measure['max_rss_kb'])
+            if 'lines_stdout' in measure:
+                total['lines'] = total.get('lines', 0) + measure['lines_stdout'] + measure['lines_stderr']
+        return {'phases': phases, 'records': records}
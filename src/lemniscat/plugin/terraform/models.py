@@ -0,0 +1,23 @@
+from dataclasses import dataclass, field
+from typing import Optional
+
+from lemniscat.core.model.models import TaskResult
+
+
+@dataclass
+class TerraformTaskResult(TaskResult):
+    stacks: dict = field(default_factory=dict)
+    workspaces: dict = field(default_factory=dict)
+    changes: dict = field(default_factory=dict)
+    resource_durations: dict = field(default_factory=dict)
+    resources_in_flight: dict = field(default_factory=dict)
+    diagnostics: list = field(default_factory=list)
+    output_artifacts: dict = field(default_factory=dict)
+    plan_cache_hit: Optional[bool] = None
+    state_delta: Optional[dict] = None
+    state_lock_waits: int = 0
+    state_lock_retries: int = 0
+    imports: dict = field(default_factory=dict)
+    state_changes: list = field(default_factory=list)
+    timed_out: bool = False
+    metrics: dict = field(default_factory=dict)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# above is for compatibility of python2.7.11
+
+import json
+import logging
+import os
+import re
+import time
+
+from lemniscat.core.util.helpers import LogUtil
+from lemniscat.plugin.terraform.filelock import FileLock
+
+logging.setLoggerClass(LogUtil)
+log = logging.getLogger(__name__.replace('lemniscat.', ''))
+
+HISTORY_FILE = 'lemniscat.parallelism.json'
+# commands run with -parallelism
+TUNED_COMMANDS = ('plan', 'apply', 'destroy')
+# default -parallelism of terraform
+DEFAULT_PARALLELISM = 10
+
+# throttling of the provider APIs and retries of the providers
+_REGEX_THROTTLE = re.compile(r'\b429\b|too ?many ?requests|throttl|request ?limit ?exceeded|rate ?exceeded|rate ?limit|slowdown|retry-after',
+                             re.IGNORECASE)
+# lines of the warnings and errors of stdout, with the human readable UI and with the JSON UI,
+# the other lines (the attributes of the planned changes...) aren't searched
+_DIAGNOSTIC_PREFIXES = ('│', 'Warning:', 'Error:', '{"@level":"warn"', '{"@level":"error"')
+
+
+def is_throttle(line, diagnostic_only=False):
+    """
+    :param line: line of the output of terraform
+    :param diagnostic_only: only search the lines of warnings and errors (stdout)
+    :return: True if the line reports a throttled request
+    """
+    if diagnostic_only and not line.lstrip().startswith(_DIAGNOSTIC_PREFIXES):
+        return False
+    return _REGEX_THROTTLE.search(line) is not None
+
+
+def history_path(working_dir):
+    """
+    :param working_dir: the folder of the terraform configuration
+    :return: path of the parallelism history of the configuration
+    """
+    return os.path.join(working_dir or '.', '.terraform', HISTORY_FILE)
+
+
+class ParallelismTuner(object):
+    """
+    Choose the -parallelism of plan, apply and destroy from the history of the previous runs of a stack.
+
+    The parallelism is halved after a run with throttled requests and increased by a quarter after
+    a run without, up to the lowest parallelism throttled in the history. It isn't increased when the
+    last increase didn't make the command at least 10% faster. The history keeps the last runs, so
+    the higher values are tried again once the throttled runs are forgotten.
+    """
+
+    HISTORY_SIZE = 20
+    MIN_SPEEDUP = 0.9
+
+    def __init__(self, history_file, min_parallelism=2, max_parallelism=50):
+        """
+        :param history_file: JSON file of the history, shared by the workspaces of the stack
+        :param min_parallelism: lower bound of the parallelism
+        :param max_parallelism: upper bound of the parallelism
+        """
+        self.history_file = history_file
+        self.min_parallelism = min_parallelism
+        self.max_parallelism = max(min_parallelism, max_parallelism)
+
+    def _bound(self, parallelism):
+        return max(self.min_parallelism, min(self.max_parallelism, parallelism))
+
+    def _read(self):
+        if not os.path.exists(self.history_file):
+            return []
+        try:
+            with open(self.history_file) as f:
+                return json.load(f)
+        except ValueError:
+            log.warning('parallelism history {0} is corrupted, it will be rebuilt'.format(self.history_file))
+            return []
+
+    def choose(self, command):
+        """
+        :param command: plan, apply or destroy
+        :return: the parallelism of the next run of the command
+        """
+        history = self._read()
+        if not history:
+            return self._bound(DEFAULT_PARALLELISM)
+        last = history[-1]
+        parallelism = last['parallelism']
+        if last['throttles'] > 0:
+            return self._bound(parallelism // 2)
+        ceiling = min([entry['parallelism'] for entry in history if entry['throttles'] > 0] + [self.max_parallelism + 1]) - 1
+        runs = [entry for entry in history if entry['command'] == command and entry['ret_code'] in (0, 2)]
+        if runs and runs[-1]['parallelism'] == parallelism:
+            previous = next((entry for entry in reversed(runs) if entry['parallelism'] != parallelism), None)
+            if previous is not None and previous['parallelism'] < parallelism \
+                    and runs[-1]['wall_s'] > previous['wall_s'] * self.MIN_SPEEDUP:
+                # the last increase didn't pay off
+                return self._bound(min(parallelism, ceiling))
+        return self._bound(min(parallelism + max(1, parallelism // 4), ceiling))
+
+    def record(self, command, parallelism, wall_s, throttles, ret_code):
+        """
+        add a run to the history
+        :param command: plan, apply or destroy
+        :param parallelism: parallelism of the run
+        :param wall_s: duration of the run in seconds
+        :param throttles: number of throttled requests reported by terraform
+        :param ret_code: exit code of terraform
+        """
+        os.makedirs(os.path.dirname(self.history_file) or '.', exist_ok=True)
+        with FileLock(self.history_file + '.lock'):
+            history = self._read()
+            history.append({'command': command, 'parallelism': parallelism, 'wall_s': round(wall_s, 3),
+                            'throttles': throttles, 'ret_code': ret_code, 'time': round(time.time())})
+            history = history[-self.HISTORY_SIZE:]
+            tmp_path = self.history_file + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(history, f)
+            os.replace(tmp_path, self.history_file)
+        if throttles > 0:
+            log.warning('{0} throttled requests with a parallelism of {1}, it will be lowered'.format(throttles, parallelism))
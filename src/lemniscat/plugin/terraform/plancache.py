@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+# above is for compatibility of python2.7.11
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+from lemniscat.core.util.helpers import LogUtil
+from lemniscat.plugin.terraform.filelock import FileLock
+from lemniscat.plugin.terraform.planrecord import RECORD_SUFFIX
+
+logging.setLoggerClass(LogUtil)
+log = logging.getLogger(__name__.replace('lemniscat.', ''))
+
+# files of the configuration tree not hashed in the key
+_IGNORED_SUFFIXES = ('.tfplan', '.tfstate', '.tfstate.backup', RECORD_SUFFIX)
+
+
+def _hash_file(digest, file_path):
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+
+
+def workspace(working_dir, environ=None):
+    """
+    :param working_dir: the folder of the terraform configuration
+    :param environ: environment of the terraform commands, os.environ by default
+    :return: the selected workspace
+    """
+    environ = os.environ if environ is None else environ
+    if environ.get('TF_WORKSPACE'):
+        return environ['TF_WORKSPACE']
+    environment_file = os.path.join(working_dir or '.', environ.get('TF_DATA_DIR') or '.terraform', 'environment')
+    if os.path.exists(environment_file):
+        with open(environment_file) as f:
+            return f.read().strip() or 'default'
+    return 'default'
+
+
+def compute_key(working_dir, var_files, variables, options, terraform_version, state_id, exclude=None, environ=None):
+    """
+    Compute the key of a plan
+    :param working_dir: the folder of the terraform configuration, every file but the
+                        hidden folders (.terraform...), the plans and the states is hashed
+    :param var_files: list of the variable files, their content is hashed
+    :param variables: dict of the -var variables
+    :param options: other options of the plan command
+    :param terraform_version: version of the terraform binary
+    :param state_id: serial and lineage of the current state
+    :param exclude: list of paths of the configuration tree not to hash
+    :param environ: environment of the terraform commands (TF_VAR_*, TF_WORKSPACE), os.environ by default
+    :return: hex digest of the key
+    """
+    working_dir = os.path.abspath(working_dir or '.')
+    exclude = [os.path.abspath(path) for path in (exclude or [])]
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(working_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if name.endswith(_IGNORED_SUFFIXES) or path in exclude or \
+                    (name.startswith('.') and name != '.terraform.lock.hcl'):
+                continue
+            digest.update(os.path.relpath(path, working_dir).encode('utf-8'))
+            digest.update(b'\0')
+            _hash_file(digest, path)
+            digest.update(b'\0')
+
+    for var_file in var_files or []:
+        if os.path.isfile(var_file):
+            _hash_file(digest, var_file)
+        digest.update(b'\0')
+
+    environ = os.environ if environ is None else environ
+    tf_vars = sorted((key, value) for key, value in environ.items() if key.startswith('TF_VAR_'))
+    digest.update(json.dumps({
+        'variables': variables or {},
+        'tf_vars': tf_vars,
+        'options': options or {},
+        'workspace': workspace(working_dir, environ),
+        'terraform_version': terraform_version,
+        'state': state_id,
+    }, sort_keys=True, default=str).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class PlanCache(object):
+    """
+    Local content-addressed store of plan files with a least recently used eviction.
+
+    Each plan is stored as <key>.tfplan with the record of its outcome,
+    an index records the size and the last use of each entry.
+    The store is modified under an exclusive lock.
+    """
+
+    INDEX_FILE = '.lemniscat.index.json'
+    LOCK_FILE = '.lemniscat.lock'
+
+    def __init__(self, cache_dir, max_size=None):
+        """
+        :param cache_dir: folder of the plan cache
+        :param max_size: maximum size of the cache in bytes, no eviction if None
+        """
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _lock(self):
+        return FileLock(os.path.join(self.cache_dir, self.LOCK_FILE))
+
+    def _plan_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.tfplan')
+
+    def _read_index(self):
+        index_path = os.path.join(self.cache_dir, self.INDEX_FILE)
+        if not os.path.exists(index_path):
+            return {}
+        try:
+            with open(index_path) as f:
+                return json.load(f)
+        except ValueError:
+            log.warning('plan cache index {0} is corrupted, it will be rebuilt'.format(index_path))
+            return {}
+
+    def _write_index(self, index):
+        index_path = os.path.join(self.cache_dir, self.INDEX_FILE)
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, index_path)
+
+    def get(self, key, plan_path):
+        """
+        copy the cached plan to plan_path
+        :param key: key of the plan, see compute_key
+        :param plan_path: destination of the plan file
+        :return: the record of the plan, None if the key isn't in the cache
+        """
+        with self._lock():
+            index = self._read_index()
+            entry = index.get(key)
+            if entry is None or not os.path.exists(self._plan_path(key)):
+                return None
+            shutil.copyfile(self._plan_path(key), plan_path)
+            entry['last_used'] = time.time()
+            self._write_index(index)
+        log.debug('plan {0} read from the plan cache'.format(key))
+        return entry['record']
+
+    def put(self, key, plan_path, record):
+        """
+        store a plan
+        :param key: key of the plan, see compute_key
+        :param plan_path: path of the plan file
+        :param record: record of the plan, see planrecord.write
+        """
+        cache_path = self._plan_path(key)
+        with self._lock():
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            shutil.copyfile(plan_path, cache_path + '.tmp')
+            os.replace(cache_path + '.tmp', cache_path)
+            index = self._read_index()
+            index[key] = {'size': os.path.getsize(cache_path), 'last_used': time.time(), 'record': record}
+            self._write_index(index)
+        log.debug('plan {0} stored in the plan cache'.format(key))
+        self.evict()
+
+    def evict(self):
+        """
+        remove the least recently used plans until the cache fits in max_size
+        :return: list of evicted keys
+        """
+        if self.max_size is None:
+            return []
+        evicted = []
+        with self._lock():
+            index = self._read_index()
+            total = sum(entry['size'] for entry in index.values())
+            for key, entry in sorted(index.items(), key=lambda item: item[1]['last_used']):
+                if total <= self.max_size:
+                    break
+                if os.path.exists(self._plan_path(key)):
+                    os.unlink(self._plan_path(key))
+                total -= entry['size']
+                evicted.append(key)
+                del index[key]
+            self._write_index(index)
+        for key in evicted:
+            log.debug('plan cache: {0} evicted'.format(key))
+        return evicted
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# above is for compatibility of python2.7.11
+
+import hashlib
+import json
+import logging
+import os
+
+from lemniscat.core.util.helpers import LogUtil
+
+logging.setLoggerClass(LogUtil)
+log = logging.getLogger(__name__.replace('lemniscat.', ''))
+
+RECORD_SUFFIX = '.lemniscat.json'
+
+
+def summarize(plan):
+    """
+    Count the changes of a plan
+    :param plan: content of 'terraform show -json <plan>'
+    :return: dict with add, change, destroy, import and outputs counts
+    """
+    summary = {'add': 0, 'change': 0, 'destroy': 0, 'import': 0, 'outputs': 0}
+    for resource_change in (plan or {}).get('resource_changes', []):
+        change = resource_change.get('change', {})
+        actions = change.get('actions', [])
+        if 'create' in actions:
+            summary['add'] += 1
+        if 'delete' in actions:
+            summary['destroy'] += 1
+        if 'update' in actions:
+            summary['change'] += 1
+        if change.get('importing') is not None:
+            summary['import'] += 1
+    for output_change in (plan or {}).get('output_changes', {}).values():
+        if output_change.get('actions', ['no-op']) != ['no-op']:
+            summary['outputs'] += 1
+    return summary
+
+
+def file_hash(file_path):
+    """
+    :param file_path: path of the plan file
+    :return: sha256 hex digest of the file, None if it doesn't exist
+    """
+    if not os.path.isfile(file_path):
+        return None
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def record_path(plan_path):
+    return plan_path + RECORD_SUFFIX
+
+
+def read(plan_path):
+    """
+    Read the record of the plan
+    :param plan_path: path of the plan file
+    :return: the record or None
+    """
+    file_path = record_path(plan_path)
+    if not os.path.exists(file_path):
+        return None
+    try:
+        with open(file_path) as f:
+            return json.load(f)
+    except ValueError:
+        log.warning('plan record {0} is corrupted'.format(file_path))
+        return None
+
+
+def write(plan_path, exit_code, summary):
+    """
+    Store the outcome of a plan next to the plan file
+    :param plan_path: path of the plan file
+    :param exit_code: detailed exit code of the plan (0: no changes, 2: changes)
+    :param summary: change counts, see summarize
+    :return: the record
+    """
+    record = {
+        'exit_code': exit_code,
+        'has_changes': exit_code == 2,
+        'sha256': file_hash(plan_path),
+        'summary': summary,
+    }
+    with open(record_path(plan_path), 'w') as f:
+        json.dump(record, f)
+    log.debug('plan record wrote to {0}'.format(record_path(plan_path)))
+    return record
+
+
+def clear(plan_path):
+    """
+    Remove the record of the plan
+    :param plan_path: path of the plan file
+    """
+    file_path = record_path(plan_path)
+    if os.path.exists(file_path):
+        os.unlink(file_path)
+
+
+def is_noop(plan_path):
+    """
+    Check that the plan file was recorded without changes and hasn't been modified since
+    :param plan_path: path of the plan file
+    :return: True if applying the plan would change nothing
+    """
+    record = read(plan_path)
+    if record is None or record.get('exit_code') != 0:
+        return False
+    return record.get('sha256') is not None and record.get('sha256') == file_hash(plan_path)
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# above is for compatibility of python2.7.11
+
+import json
+import logging
+import os
+import re
+import shutil
+import time
+
+from lemniscat.core.util.helpers import LogUtil
+from lemniscat.plugin.terraform.filelock import FileLock
+
+logging.setLoggerClass(LogUtil)
+log = logging.getLogger(__name__.replace('lemniscat.', ''))
+
+_REGEX_LOCK_PROVIDER = re.compile(r'provider\s+"(?P<source>[^"]+)"\s*\{[^}]*?version\s*=\s*"(?P<version>[^"]+)"', re.DOTALL)
+
+
+def _dir_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class PluginCache(object):
+    """
+    Shared provider plugin cache (TF_PLUGIN_CACHE_DIR) with a least recently used eviction.
+
+    The cache keeps the terraform layout <hostname>/<namespace>/<type>/<version>/<os_arch>
+    and an index recording the size and the last use of each provider version.
+    Terraform reads and writes the cache under a shared lock, the index update and
+    the eviction are done under an exclusive lock.
+    """
+
+    INDEX_FILE = '.lemniscat.index.json'
+    LOCK_FILE = '.lemniscat.lock'
+
+    def __init__(self, cache_dir, max_size=None):
+        """
+        :param cache_dir: folder of the plugin cache
+        :param max_size: maximum size of the cache in bytes, no eviction if None
+        """
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def shared_lock(self):
+        """
+        lock to hold while terraform is using the cache
+        """
+        return FileLock(os.path.join(self.cache_dir, self.LOCK_FILE), shared=True)
+
+    def exclusive_lock(self):
+        """
+        lock to hold while the cache is modified by the plugin
+        """
+        return FileLock(os.path.join(self.cache_dir, self.LOCK_FILE))
+
+    def _read_index(self):
+        index_path = os.path.join(self.cache_dir, self.INDEX_FILE)
+        if not os.path.exists(index_path):
+            return {}
+        try:
+            with open(index_path) as f:
+                return json.load(f)
+        except ValueError:
+            log.warning('plugin cache index {0} is corrupted, it will be rebuilt'.format(index_path))
+            return {}
+
+    def _write_index(self, index):
+        index_path = os.path.join(self.cache_dir, self.INDEX_FILE)
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, index_path)
+
+    def _scan(self):
+        """
+        list the provider versions present in the cache
+        :return: list of keys <hostname>/<namespace>/<type>/<version>
+        """
+        entries = []
+        for host in os.listdir(self.cache_dir):
+            if host.startswith('.'):
+                continue
+            for namespace in self._subdirs(host):
+                for provider_type in self._subdirs(host, namespace):
+                    for version in self._subdirs(host, namespace, provider_type):
+                        entries.append('/'.join([host, namespace, provider_type, version]))
+        return entries
+
+    def _subdirs(self, *parts):
+        path = os.path.join(self.cache_dir, *parts)
+        if not os.path.isdir(path):
+            return []
+        return [name for name in os.listdir(path) if os.path.isdir(os.path.join(path, name))]
+
+    def _locked_providers(self, working_dir):
+        lock_file = os.path.join(working_dir or '.', '.terraform.lock.hcl')
+        if not os.path.exists(lock_file):
+            return []
+        with open(lock_file) as f:
+            content = f.read()
+        return ['{0}/{1}'.format(m.group('source'), m.group('version')) for m in _REGEX_LOCK_PROVIDER.finditer(content)]
+
+    def record_usage(self, working_dir):
+        """
+        mark the providers of a terraform configuration as used now,
+        and register the provider versions added to the cache by terraform
+        :param working_dir: the folder of the terraform configuration
+        """
+        now = time.time()
+        with self.exclusive_lock():
+            index = self._read_index()
+            entries = self._scan()
+            for key in list(index.keys()):
+                if key not in entries:
+                    del index[key]
+            for key in entries:
+                if key not in index:
+                    index[key] = {'size': _dir_size(os.path.join(self.cache_dir, key)), 'last_used': now}
+            for key in self._locked_providers(working_dir):
+                if key in index:
+                    index[key]['last_used'] = now
+            self._write_index(index)
+        log.debug('plugin cache index updated with the providers of {0}'.format(working_dir))
+
+    def evict(self):
+        """
+        remove the least recently used provider versions until the cache fits in max_size
+        :return: list of evicted keys
+        """
+        if self.max_size is None:
+            return []
+        evicted = []
+        with self.exclusive_lock():
+            index = self._read_index()
+            total = sum(entry['size'] for entry in index.values())
+            for key, entry in sorted(index.items(), key=lambda item: item[1]['last_used']):
+                if total <= self.max_size:
+                    break
+                shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+                total -= entry['size']
+                evicted.append(key)
+                del index[key]
+            self._write_index(index)
+        for key in evicted:
+            log.info('plugin cache: {0} evicted'.format(key))
+        return evicted
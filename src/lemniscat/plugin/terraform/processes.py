@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+# above is for compatibility of python2.7.11
+
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+from lemniscat.core.util.helpers import LogUtil
+
+logging.setLoggerClass(LogUtil)
+log = logging.getLogger(__name__.replace('lemniscat.', ''))
+
+# seconds left to a command to stop after SIGINT/SIGTERM (terraform releases the state lock) before SIGKILL
+GRACE_PERIOD = 30
+# return code of a command stopped at its deadline, as the timeout command
+TIMEOUT_RET_CODE = 124
+FORWARDED_SIGNALS = (signal.SIGINT, signal.SIGTERM)
+
+# supervisors of the running commands, receiving the forwarded signals
+_running = set()
+# signals received by forward_signals while commands were running
+_forwarded = []
+# forward_signals blocks running in the main thread
+_forwarding = 0
+# reentrant: the signal handlers run in the main thread, maybe while it holds the lock
+_lock = threading.RLock()
+
+
+class CommandInterrupted(Exception):
+    pass
+
+
+class Deadline(object):
+    """
+    Point in time (monotonic clock) after which a command is stopped.
+    """
+
+    def __init__(self, timeout):
+        """
+        :param timeout: duration in seconds from now
+        """
+        self.timeout = timeout
+        self.expires = time.monotonic() + timeout
+
+    def remaining(self):
+        """
+        :return: seconds before the deadline, 0 when it's exceeded
+        """
+        return max(0, self.expires - time.monotonic())
+
+    def expired(self):
+        return time.monotonic() >= self.expires
+
+
+def earliest(*deadlines):
+    """
+    :param deadlines: Deadline or None (no deadline), ex. the deadline of the task and of the command
+    :return: the Deadline expiring first, None if there is none
+    """
+    deadlines = [deadline for deadline in deadlines if deadline is not None]
+    return min(deadlines, key=lambda deadline: deadline.expires) if deadlines else None
+
+
+def popen_options():
+    """
+    options of subprocess.Popen (or asyncio.create_subprocess_exec) starting the command in its
+    own process group, so that the command and its children (providers, az...) are signaled together.
+    The command only leaves the process group of the caller while forward_signals is active, otherwise
+    it wouldn't receive SIGINT and SIGTERM from the terminal anymore.
+    :return: dict of keyword arguments, empty when the command stays in the process group of the caller
+    """
+    with _lock:
+        if _forwarding == 0:
+            return {}
+    if os.name == 'nt':
+        return {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+    return {'start_new_session': True}
+
+
+def signal_group(process, signum, group=True):
+    """
+    send a signal to the process group of a command started with popen_options
+    :param process: subprocess.Popen or asyncio.subprocess.Process object
+    :param signum: signal.SIGINT, signal.SIGTERM or signal.SIGKILL (terminate the process on Windows)
+    :param group: the command has its own process group, otherwise only the command is signaled
+    """
+    try:
+        if not group:
+            if os.name != 'nt':
+                process.send_signal(signum)
+            else:
+                process.kill()
+        elif os.name != 'nt':
+            os.killpg(process.pid, signum)
+        elif signum in FORWARDED_SIGNALS:
+            # the only signal a process group can receive on Windows
+            process.send_signal(signal.CTRL_BREAK_EVENT)
+        else:
+            process.kill()
+    except (ProcessLookupError, PermissionError):
+        # the group is gone
+        pass
+
+
+def check_interrupted():
+    """
+    raise CommandInterrupted if a signal was forwarded to the running commands, no new command must start
+    """
+    if _forwarded:
+        raise CommandInterrupted('{0} received, command not started'.format(signal.Signals(_forwarded[0]).name))
+
+
+class Supervisor(object):
+    """
+    Stop a command started with popen_options at its deadline or when a signal is forwarded to it:
+    the process group receives SIGINT (or the forwarded signal) so that terraform can stop gracefully
+    and release the state lock, then SIGKILL if it is still running after the grace period.
+    The lines written until then are still pumped, the caller keeps the partial output.
+
+    Used as a context manager around the wait for the command: if the wait is abandoned by an
+    exception (KeyboardInterrupt...), the command is interrupted instead of being left running.
+    """
+
+    def __init__(self, process, deadline=None, grace_period=GRACE_PERIOD, name='command', group=True):
+        """
+        :param process: subprocess.Popen or asyncio.subprocess.Process object
+        :param deadline: Deadline of the command, None to wait for it without limit
+        :param grace_period: seconds between the interruption and SIGKILL
+        :param name: name of the command in the logs
+        :param group: the command was started in its own process group (popen_options isn't empty)
+        """
+        self.process = process
+        self.group = group
+        self.deadline = deadline
+        self.grace_period = grace_period
+        self.name = name
+        self.timed_out = False
+        # signal forwarded to the command
+        self.signum = None
+        self._timers = []
+        self._killing = False
+        self._stopped = False
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop(abandoned=exc_type is not None)
+
+    def _timer(self, delay, function):
+        timer = threading.Timer(delay, function)
+        timer.daemon = True
+        timer.start()
+        self._timers.append(timer)
+
+    def start(self):
+        with _lock:
+            _running.add(self)
+        if self.deadline is not None:
+            with self._lock:
+                self._timer(self.deadline.remaining(), self._expire)
+
+    def _expire(self):
+        with self._lock:
+            if self._stopped:
+                return
+            self.timed_out = True
+        log.error('{0} exceeded its deadline of {1}s, interrupting it'.format(self.name, self.deadline.timeout))
+        self.interrupt(signal.SIGINT)
+
+    def interrupt(self, signum):
+        """
+        send a signal to the command and kill it if it's still running after the grace period
+        """
+        with self._lock:
+            if self._stopped:
+                return
+            signal_group(self.process, signum, self.group)
+            if not self._killing:
+                self._killing = True
+                self._timer(self.grace_period, self._kill)
+
+    def _kill(self):
+        with self._lock:
+            if self._stopped:
+                return
+            log.error('{0} still running {1}s after the interruption, killed, the state may stay locked'.format(
+                self.name, self.grace_period))
+            signal_group(self.process, getattr(signal, 'SIGKILL', signal.SIGTERM), self.group)
+
+    def _kill_abandoned(self):
+        # the process group id may be reused once the command is reaped, it isn't signaled anymore
+        poll = getattr(self.process, 'poll', None)
+        if (poll() if poll is not None else self.process.returncode) is None:
+            signal_group(self.process, getattr(signal, 'SIGKILL', signal.SIGTERM), self.group)
+
+    def stop(self, abandoned=False):
+        """
+        stop supervising the command, once it's finished
+        :param abandoned: the command may still be running, it's interrupted and killed after the grace period
+        """
+        with _lock:
+            _running.discard(self)
+        with self._lock:
+            self._stopped = True
+            for timer in self._timers:
+                timer.cancel()
+        if abandoned:
+            signal_group(self.process, signal.SIGINT, self.group)
+            # not a daemon, the command is killed even if the interpreter exits in the meantime
+            threading.Timer(self.grace_period, self._kill_abandoned).start()
+        elif self.group and (self.timed_out or self.signum is not None or self._killing):
+            # the children left behind by the interrupted command
+            signal_group(self.process, getattr(signal, 'SIGKILL', signal.SIGTERM))
+
+
+def _forward(signum, frame, previous):
+    with _lock:
+        running = list(_running)
+        if running:
+            _forwarded.append(signum)
+    if not running:
+        _call_handler(previous, signum, frame)
+        return
+    log.warning('{0} received, forwarded to {1} running commands'.format(signal.Signals(signum).name, len(running)))
+    for supervisor in running:
+        supervisor.signum = signum
+        supervisor.interrupt(signum)
+
+
+def _call_handler(handler, signum, frame):
+    if callable(handler):
+        handler(signum, frame)
+    elif handler != signal.SIG_IGN:
+        signal.signal(signum, signal.SIG_DFL)
+        signal.raise_signal(signum)
+
+
+@contextmanager
+def forward_signals(signals=FORWARDED_SIGNALS):
+    """
+    Forward SIGINT and SIGTERM to the process groups of the running commands (they don't receive
+    the signals of the terminal since they run in their own process groups), the commands started
+    afterwards raise CommandInterrupted. When the block exits, once the commands are stopped, the
+    signal is raised again with the previous handler (KeyboardInterrupt for SIGINT...).
+    The commands of all the threads are forwarded the signals while a block runs in the main thread.
+    Signal handlers can only be installed by the main thread, the block does nothing in another thread:
+    the commands started without a block in the main thread stay in the process group of the caller.
+    """
+    global _forwarding
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+    previous = {}
+    with _lock:
+        if _forwarding == 0:
+            del _forwarded[:]
+        _forwarding += 1
+    for signum in signals:
+        previous[signum] = signal.getsignal(signum)
+        signal.signal(signum, lambda signum, frame: _forward(signum, frame, previous[signum]))
+    try:
+        yield
+    finally:
+        for signum, handler in previous.items():
+            signal.signal(signum, handler if handler is not None else signal.SIG_DFL)
+        with _lock:
+            _forwarding -= 1
+            received = _forwarded[0] if _forwarded else None
+            if _forwarding == 0:
+                del _forwarded[:]
+        if received is not None:
+            _call_handler(previous[received], received, None)
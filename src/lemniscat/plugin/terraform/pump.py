@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+# above is for compatibility of python2.7.11
+
+import asyncio
+import logging
+import os
+import selectors
+import threading
+import time
+from queue import Queue
+
+from lemniscat.core.util.helpers import LogUtil
+from lemniscat.plugin.terraform.metrics import wait_rusage
+
+logging.setLoggerClass(LogUtil)
+log = logging.getLogger(__name__.replace('lemniscat.', ''))
+
+STDOUT = 1
+STDERR = 2
+
+
+class StreamPump(object):
+    """
+    Read stdout and stderr of a process on the calling thread and dispatch
+    each decoded line to a handler.
+
+    Streams are read by large chunks and split into lines incrementally, the
+    handlers are always called from the thread running the pump.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, on_stdout=None, on_stderr=None, capture=False, buffers=None, redactor=None):
+        """
+        :param on_stdout: callable receiving each line of stdout (without line break)
+        :param on_stderr: callable receiving each line of stderr (without line break)
+        :param capture: keep the lines to return them when the process is done
+        :param buffers: dict of STDOUT/STDERR -> object with append() and iteration
+                        receiving the captured lines, lists by default (ex. BoundedCapture)
+        :param redactor: Redactor masking the secrets of each chunk before it is split into
+                         lines, the handlers and the captured lines only receive masked text
+        """
+        self.handlers = {STDOUT: on_stdout, STDERR: on_stderr}
+        self.capture = capture
+        self.redactor = redactor
+        self.lines = {STDOUT: [], STDERR: []}
+        if buffers:
+            self.lines.update(buffers)
+        self._pending = {STDOUT: b'', STDERR: b''}
+        # measures of the process, see Metrics.record_process
+        self.first_data_time = None
+        self.line_counts = {STDOUT: 0, STDERR: 0}
+        self.rusage = None
+
+    def _dispatch(self, kind, data):
+        handler = self.handlers[kind]
+        text = data.decode('utf-8', errors='replace')
+        if self.redactor is not None:
+            text = self.redactor.redact(text)
+        lines = text.split('\n')
+        if lines[-1] == '':
+            lines.pop()
+        self.line_counts[kind] += len(lines)
+        for line in lines:
+            if line.endswith('\r'):
+                line = line[:-1]
+            if self.capture:
+                self.lines[kind].append(line)
+            if handler is not None:
+                handler(line)
+
+    def feed(self, kind, data):
+        """
+        feed a chunk read from a stream, the complete lines are dispatched
+        :param kind: STDOUT or STDERR
+        :param data: bytes read, empty bytes when the stream is closed
+        """
+        if data and self.first_data_time is None:
+            self.first_data_time = time.perf_counter()
+        if not data:
+            if self._pending[kind]:
+                self._dispatch(kind, self._pending[kind])
+                self._pending[kind] = b''
+            return
+        buffer = self._pending[kind] + data
+        end = buffer.rfind(b'\n')
+        if end < 0:
+            self._pending[kind] = buffer
+            return
+        self._pending[kind] = buffer[end + 1:]
+        self._dispatch(kind, buffer[:end + 1])
+
+    def run(self, process):
+        """
+        pump the output of the process until both streams are closed, then wait for the process,
+        the resources used by the process are kept in rusage
+        :param process: subprocess.Popen object started with stdout and stderr set to PIPE
+        :return: out, err captured as text (None if not captured)
+        """
+        streams = {kind: stream for kind, stream in ((STDOUT, process.stdout), (STDERR, process.stderr)) if stream is not None}
+        if os.name == 'nt':
+            # select() doesn't work on pipes on Windows
+            self._run_threads(streams)
+        else:
+            self._run_selector(streams)
+        self.rusage = wait_rusage(process)
+
+        if not self.capture:
+            return None, None
+        return '\n'.join(self.lines[STDOUT]), '\n'.join(self.lines[STDERR])
+
+    async def run_async(self, process):
+        """
+        pump the output of an asyncio process until both streams are closed, then wait for the process
+        :param process: asyncio.subprocess.Process object started with stdout and stderr set to PIPE
+        :return: out, err captured as text (None if not captured)
+        """
+        async def read(kind, stream):
+            while True:
+                data = await stream.read(self.CHUNK_SIZE)
+                self.feed(kind, data)
+                if not data:
+                    break
+
+        await asyncio.gather(*(read(kind, stream) for kind, stream in ((STDOUT, process.stdout), (STDERR, process.stderr)) if stream is not None))
+        await process.wait()
+
+        if not self.capture:
+            return None, None
+        return '\n'.join(self.lines[STDOUT]), '\n'.join(self.lines[STDERR])
+
+    def _run_selector(self, streams):
+        with selectors.DefaultSelector() as selector:
+            for kind, stream in streams.items():
+                selector.register(stream.fileno(), selectors.EVENT_READ, kind)
+            while selector.get_map():
+                for key, events in selector.select():
+                    data = os.read(key.fd, self.CHUNK_SIZE)
+                    if not data:
+                        selector.unregister(key.fd)
+                    self.feed(key.data, data)
+
+    def _run_threads(self, streams):
+        q = Queue()
+
+        def read(kind, stream):
+            while True:
+                data = stream.read1(self.CHUNK_SIZE) if hasattr(stream, 'read1') else stream.read(self.CHUNK_SIZE)
+                q.put((kind, data))
+                if not data:
+                    break
+
+        readers = [threading.Thread(target=read, args=(kind, stream), daemon=True) for kind, stream in streams.items()]
+        for reader in readers:
+            reader.start()
+        running = len(readers)
+        while running > 0:
+            kind, data = q.get()
+            if not data:
+                running -= 1
+            self.feed(kind, data)
+        for reader in readers:
+            reader.join()
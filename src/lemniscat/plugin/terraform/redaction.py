@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+# above is for compatibility of python2.7.11
+
+import logging
+import re
+import threading
+
+from lemniscat.core.util.helpers import LogUtil
+
+logging.setLoggerClass(LogUtil)
+log = logging.getLogger(__name__.replace('lemniscat.', ''))
+
+MASK = '********'
+# environment variables holding credentials of the backends and the providers
+CREDENTIAL_VARIABLES = ('ARM_ACCESS_KEY', 'ARM_CLIENT_SECRET', 'ARM_CLIENT_CERTIFICATE_PASSWORD', 'ARM_SAS_TOKEN',
+                        'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN')
+
+
+def _trie_pattern(secrets):
+    """
+    regular expression matching any of the secrets, factored by common prefixes
+    so that each position of a text is tried once against the trie instead of once per secret
+    :param secrets: iterable of non empty strings
+    :return: pattern string
+    """
+    trie = {}
+    for secret in secrets:
+        node = trie
+        for char in secret:
+            node = node.setdefault(char, {})
+        node[''] = None
+
+    def pattern(node):
+        # collapse the chains of single characters without end of secret
+        prefix = ''
+        while len(node) == 1 and '' not in node:
+            char, node = next(iter(node.items()))
+            prefix += re.escape(char)
+        if node == {'': None}:
+            return prefix
+        alternatives = []
+        chars = []
+        for char in sorted(key for key in node if key):
+            sub = pattern(node[char])
+            if sub:
+                alternatives.append(re.escape(char) + sub)
+            else:
+                chars.append(re.escape(char))
+        if chars:
+            alternatives.append(chars[0] if len(chars) == 1 else '[{0}]'.format(''.join(chars)))
+        body = alternatives[0] if len(alternatives) == 1 else '(?:{0})'.format('|'.join(alternatives))
+        if '' in node:
+            # greedy, the longest secret wins
+            body = '(?:{0})?'.format(body)
+        return prefix + body
+
+    return pattern(trie)
+
+
+class Redactor(object):
+    """
+    Set of secrets masked in the text logged or captured from the commands.
+
+    Up to REPLACE_MAX_SECRETS secrets, they are replaced one by one (str.replace is faster for a
+    handful of secrets), above all the secrets are replaced in one pass by a regular expression
+    factored by common prefixes. The matcher is rebuilt only when a new secret is added.
+    A Redactor can be shared between threads.
+    """
+
+    REPLACE_MAX_SECRETS = 8
+
+    def __init__(self, secrets=None, min_length=4):
+        """
+        :param secrets: initial secrets
+        :param min_length: secrets shorter than min_length aren't masked, to keep the logs readable
+        """
+        self.min_length = min_length
+        self._secrets = set()
+        self._matcher = None
+        self._lock = threading.Lock()
+        if secrets:
+            self.add(*secrets)
+
+    def __len__(self):
+        return len(self._secrets)
+
+    def add(self, *secrets):
+        """
+        add secrets, a multi-line secret is also masked line by line
+        """
+        new = set()
+        for secret in secrets:
+            if secret is None or isinstance(secret, bool):
+                continue
+            if isinstance(secret, dict):
+                self.add(*secret.values())
+                continue
+            if isinstance(secret, (list, tuple, set)):
+                self.add(*secret)
+                continue
+            secret = str(secret)
+            candidates = [secret] + [line.strip() for line in secret.splitlines()] if '\n' in secret else [secret]
+            new.update(c for c in candidates if len(c) >= self.min_length)
+        with self._lock:
+            new -= self._secrets
+            if new:
+                self._secrets |= new
+                self._matcher = None
+
+    def add_variables(self, variables):
+        """
+        add the values of the sensitive variables
+        :param variables: dict of VariableValue
+        """
+        self.add(*(variable.value for variable in variables.values()
+                   if getattr(variable, 'sensitive', False)))
+
+    def add_environ(self, environ):
+        """
+        add the credentials of an environment, see CREDENTIAL_VARIABLES
+        :param environ: os.environ or EnvOverlay
+        """
+        self.add(*(environ.get(name) for name in CREDENTIAL_VARIABLES))
+
+    def _compiled(self):
+        matcher = self._matcher
+        if matcher is None and self._secrets:
+            with self._lock:
+                if self._matcher is None:
+                    self._matcher = self._build(self._secrets)
+                    log.debug('redaction rebuilt for {0} secrets'.format(len(self._secrets)))
+                matcher = self._matcher
+        return matcher
+
+    @staticmethod
+    def _build(secrets):
+        """
+        :return: callable masking the secrets of a text
+        """
+        if len(secrets) <= Redactor.REPLACE_MAX_SECRETS:
+            # longest first, a secret can contain another one
+            ordered = sorted(secrets, key=len, reverse=True)
+
+            def replace(text):
+                for secret in ordered:
+                    if secret in text:
+                        text = text.replace(secret, MASK)
+                return text
+            return replace
+        regex = re.compile(_trie_pattern(secrets))
+        return lambda text: regex.sub(MASK, text)
+
+    def redact(self, text):
+        """
+        :param text: text to mask
+        :return: the text with each secret replaced by MASK
+        """
+        matcher = self._compiled()
+        if matcher is None or not text:
+            return text
+        return matcher(text)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# above is for compatibility of python2.7.11
+
+import glob
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from lemniscat.core.util.helpers import LogUtil
+
+logging.setLoggerClass(LogUtil)
+log = logging.getLogger(__name__.replace('lemniscat.', ''))
+
+_GLOB_CHARS = ('*', '?', '[')
+
+
+def resolve_stacks(tf_path) -> dict:
+    """
+    Resolve the tfPath parameter into terraform configurations
+    :param tf_path: a path, a glob pattern or a list of paths and glob patterns
+    :return: dict of stack name -> path, the name is the folder name of the stack
+             (or its path if two stacks share the same folder name)
+    """
+    patterns = tf_path if isinstance(tf_path, list) else [tf_path]
+    paths = []
+    for pattern in patterns:
+        if any(c in pattern for c in _GLOB_CHARS):
+            paths += sorted(p for p in glob.glob(pattern) if os.path.isdir(p))
+        else:
+            paths.append(pattern)
+
+    names = [os.path.basename(os.path.normpath(p)) for p in paths]
+    stacks = {}
+    for name, path in zip(names, paths):
+        if names.count(name) > 1:
+            name = os.path.normpath(path)
+        stacks[name] = path
+    return stacks
+
+
+def run_stacks(stacks: dict, run, dependencies: dict = None, max_workers: int = 4) -> dict:
+    """
+    Run a function on each stack with a bounded pool of workers.
+    A stack starts when all the stacks it depends on are completed, it's
+    skipped if one of them failed.
+    :param stacks: dict of stack name -> path
+    :param run: callable(name, path) returning a dict with at least a 'status' key
+                ('Completed' or 'Failed')
+    :param dependencies: dict of stack name -> list of stack names it depends on
+    :param max_workers: maximum number of stacks running at the same time
+    :return: dict of stack name -> result of run, with a 'duration' key in seconds
+    """
+    dependencies = dependencies or {}
+    for name, deps in dependencies.items():
+        for dep in deps:
+            if dep not in stacks:
+                log.warning(f'Stack {name} depends on unknown stack {dep}, dependency ignored')
+    pending = {name: [dep for dep in dependencies.get(name, []) if dep in stacks] for name in stacks}
+    results = {}
+
+    def timed_run(name, path):
+        start = time.monotonic()
+        try:
+            result = run(name, path)
+        except Exception as e:
+            log.error(f'Stack {name} failed: {e}')
+            result = {'status': 'Failed', 'errors': [str(e)]}
+        result['duration'] = round(time.monotonic() - start, 3)
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while pending or running:
+            for name in list(pending.keys()):
+                deps = pending[name]
+                if any(dep in results and results[dep]['status'] != 'Completed' for dep in deps):
+                    log.warning(f'Stack {name} skipped: a stack it depends on failed')
+                    results[name] = {'status': 'Skipped', 'errors': [], 'duration': 0}
+                    del pending[name]
+                elif all(dep in results for dep in deps):
+                    running[executor.submit(timed_run, name, stacks[name])] = name
+                    del pending[name]
+
+            if not running:
+                if pending:
+                    log.error(f'Circular dependencies between stacks: {", ".join(pending.keys())}')
+                    for name in pending:
+                        results[name] = {'status': 'Failed', 'errors': ['circular dependency'], 'duration': 0}
+                break
+
+            done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+    return results
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+# above is for compatibility of python2.7.11
+
+import json
+import logging
+import re
+from collections import namedtuple
+
+from lemniscat.core.util.helpers import LogUtil
+from lemniscat.plugin.terraform.tfstate import ResourceRecord, TfstateIndex
+
+logging.setLoggerClass(LogUtil)
+log = logging.getLogger(__name__.replace('lemniscat.', ''))
+
+OPERATIONS = ('mv', 'rm')
+
+# one step of an address: name with an optional index key, ex. module, vm, rg["key"], nic[0]
+_REGEX_STEP = re.compile(r'(?P<name>[A-Za-z_][\w-]*)(?:\[(?P<key>"(?:[^"\\]|\\.)*"|\d+)\])?(?:\.(?=.)|$)')
+
+# module: None for the root module, type: None for a module address, key: None without index key
+Address = namedtuple('Address', ('module', 'mode', 'type', 'name', 'key'))
+
+
+class StateOperationError(ValueError):
+    pass
+
+
+def _key_string(key):
+    return '' if key is None else '[{0}]'.format(json.dumps(key, ensure_ascii=False))
+
+
+def parse_address(address):
+    """
+    :param address: address of a module (module.a, module.a["x"].module.b), of a resource
+                    (module.a.azurerm_resource_group.rg) or of an instance (azurerm_resource_group.rg["key"])
+    :return: Address
+    """
+    steps = []
+    idx = 0
+    while idx < len(address):
+        m = _REGEX_STEP.match(address, idx)
+        if m is None:
+            raise StateOperationError('invalid address: {0}'.format(address))
+        steps.append((m.group('name'), json.loads(m.group('key')) if m.group('key') is not None else None))
+        idx = m.end()
+    modules = []
+    while len(steps) >= 2 and steps[0] == ('module', None):
+        name, key = steps[1]
+        modules.append('module.{0}{1}'.format(name, _key_string(key)))
+        steps = steps[2:]
+    module = '.'.join(modules) or None
+    if not steps and module is not None:
+        return Address(module, None, None, None, None)
+    mode = 'managed'
+    if len(steps) == 3 and steps[0] == ('data', None):
+        mode = 'data'
+        steps = steps[1:]
+    if len(steps) != 2 or steps[0][1] is not None:
+        raise StateOperationError('invalid address: {0}'.format(address))
+    return Address(module, mode, steps[0][0], steps[1][0], steps[1][1])
+
+
+def parse_operations(operations):
+    """
+    :param operations: list of operations, as dicts ({'mv': [from, to]}, {'rm': address})
+                       or strings ('mv from to', 'rm address')
+    :return: list of (operation, address, destination), destination is None for rm
+    """
+    parsed = []
+    for operation in operations or []:
+        if isinstance(operation, str):
+            parts = operation.split()
+            name, arguments = (parts[0], parts[1:]) if parts else (None, [])
+        elif isinstance(operation, dict) and len(operation) == 1:
+            name, arguments = next(iter(operation.items()))
+            arguments = [arguments] if isinstance(arguments, str) else list(arguments or [])
+        else:
+            raise StateOperationError('invalid operation: {0}'.format(operation))
+        if name not in OPERATIONS or len(arguments) != (2 if name == 'mv' else 1):
+            raise StateOperationError('invalid operation: {0}'.format(operation))
+        parsed.append((name, arguments[0], arguments[1] if name == 'mv' else None))
+    return parsed
+
+
+def _in_module(resource_module, module):
+    """
+    :return: True if a resource of resource_module is in module or in one of its children
+             (module.a matches the instances of module.a when it has count or for_each)
+    """
+    if resource_module is None:
+        return False
+    return resource_module == module or resource_module.startswith((module + '.', module + '['))
+
+
+class StateBatch(object):
+    """
+    mv and rm operations applied in memory on the content of a state, with the checks of
+    'terraform state mv/rm': the source must exist, the destination mustn't, the resource types
+    must be the same. The operations are applied in order, each one on the result of the previous ones.
+    """
+
+    def __init__(self, data):
+        """
+        :param data: content of the state (state pull)
+        """
+        if not data or 'lineage' not in data:
+            raise StateOperationError('there is no state')
+        self.data = data
+        index = TfstateIndex.from_data(data)
+        self.resources = list(index.resources)
+        self.by_address = dict(index.by_address)
+        # instances moved and removed: dicts with operation, from and to (None for rm)
+        self.changes = []
+
+    def apply(self, operations):
+        """
+        :param operations: see parse_operations
+        :return: changes
+        """
+        for name, address, destination in parse_operations(operations):
+            if name == 'mv':
+                self.mv(address, destination)
+            else:
+                self.rm(address)
+        return self.changes
+
+    def _resource_address(self, address):
+        return ResourceRecord(address.module, address.mode, address.type, address.name).address
+
+    def _module_resources(self, module):
+        return [resource for resource in self.resources if _in_module(resource.module, module)]
+
+    def _add_resource(self, resource):
+        self.resources.append(resource)
+        self.by_address[resource.address] = resource
+
+    def _remove_resource(self, resource):
+        self.resources.remove(resource)
+        del self.by_address[resource.address]
+
+    @staticmethod
+    def _instances(resource, key):
+        # with the deposed objects of the instance
+        return [instance for instance in resource.instances if instance.index_key == key]
+
+    def _record(self, operation, instances, destination=None):
+        for instance in instances:
+            if instance.deposed is None:
+                self.changes.append({'operation': operation, 'from': instance.address, 'to': destination(instance) if destination else None})
+
+    def rm(self, address):
+        """
+        remove a module, a resource or an instance
+        """
+        parsed = parse_address(address)
+        if parsed.type is None:
+            resources = self._module_resources(parsed.module)
+            if not resources:
+                raise StateOperationError('rm {0}: no matching objects'.format(address))
+            for resource in resources:
+                self._record('rm', resource.instances)
+                self._remove_resource(resource)
+            return
+        resource = self.by_address.get(self._resource_address(parsed))
+        if resource is None:
+            raise StateOperationError('rm {0}: no matching objects'.format(address))
+        instances = resource.instances if parsed.key is None else self._instances(resource, parsed.key)
+        if not instances:
+            raise StateOperationError('rm {0}: no matching objects'.format(address))
+        self._record('rm', instances)
+        resource.instances = [instance for instance in resource.instances if instance not in instances]
+        if not resource.instances:
+            self._remove_resource(resource)
+
+    def mv(self, source, destination):
+        """
+        move a module, a resource or an instance
+        """
+        parsed_source = parse_address(source)
+        parsed_destination = parse_address(destination)
+        if (parsed_source.type is None) != (parsed_destination.type is None):
+            raise StateOperationError('mv {0} {1}: a module can only be moved to a module'.format(source, destination))
+        if parsed_source.type is None:
+            self._mv_module(source, destination, parsed_source.module, parsed_destination.module)
+        elif parsed_source.key is None and parsed_destination.key is None:
+            self._mv_resource(source, destination, parsed_source, parsed_destination)
+        else:
+            self._mv_instance(source, destination, parsed_source, parsed_destination)
+
+    def _mv_module(self, source, destination, module, new_module):
+        resources = self._module_resources(module)
+        if not resources:
+            raise StateOperationError('mv {0} {1}: no matching objects'.format(source, destination))
+        moved = {}
+        for resource in resources:
+            target_module = new_module + resource.module[len(module):]
+            target = ResourceRecord(target_module, resource.mode, resource.type, resource.name).address
+            if target in self.by_address and self.by_address[target] not in resources:
+                raise StateOperationError('mv {0} {1}: {2} already exists'.format(source, destination, target))
+            moved[resource] = target_module
+        for resource, target_module in moved.items():
+            del self.by_address[resource.address]
+            self._record('mv', resource.instances, lambda instance: new_module + instance.address[len(module):])
+            resource.module = target_module
+        for resource in moved:
+            self.by_address[resource.address] = resource
+
+    def _check_types(self, source, destination, parsed_source, parsed_destination):
+        if (parsed_source.mode, parsed_source.type) != (parsed_destination.mode, parsed_destination.type):
+            raise StateOperationError('mv {0} {1}: the resource types don\'t match'.format(source, destination))
+
+    def _mv_resource(self, source, destination, parsed_source, parsed_destination):
+        self._check_types(source, destination, parsed_source, parsed_destination)
+        resource = self.by_address.get(self._resource_address(parsed_source))
+        if resource is None:
+            raise StateOperationError('mv {0} {1}: no matching objects'.format(source, destination))
+        target = self._resource_address(parsed_destination)
+        if target in self.by_address:
+            raise StateOperationError('mv {0} {1}: {2} already exists'.format(source, destination, target))
+        self._record('mv', resource.instances, lambda instance: target + instance.address[len(resource.address):])
+        self._remove_resource(resource)
+        resource.module = parsed_destination.module
+        resource.name = parsed_destination.name
+        self._add_resource(resource)
+
+    def _mv_instance(self, source, destination, parsed_source, parsed_destination):
+        self._check_types(source, destination, parsed_source, parsed_destination)
+        resource = self.by_address.get(self._resource_address(parsed_source))
+        instances = self._instances(resource, parsed_source.key) if resource is not None else []
+        if not instances:
+            raise StateOperationError('mv {0} {1}: no matching objects'.format(source, destination))
+        target_address = self._resource_address(parsed_destination)
+        target = self.by_address.get(target_address)
+        if target is not None and self._instances(target, parsed_destination.key):
+            raise StateOperationError('mv {0} {1}: {1} already exists'.format(source, destination))
+        # ex. aws_instance.a to aws_instance.a[0] when count is added
+        others = [instance for instance in target.instances if instance not in instances] if target is not None else []
+        if others and (others[0].index_key is None) != (parsed_destination.key is None):
+            raise StateOperationError('mv {0} {1}: the index of {1} doesn\'t match the instances of {2}'.format(
+                source, destination, target_address))
+        self._record('mv', instances, lambda instance: target_address + _key_string(parsed_destination.key))
+        resource.instances = [instance for instance in resource.instances if instance not in instances]
+        if not resource.instances and resource is not target:
+            self._remove_resource(resource)
+        if target is None:
+            target = ResourceRecord(parsed_destination.module, parsed_destination.mode, parsed_destination.type,
+                                    parsed_destination.name, resource.provider)
+            self._add_resource(target)
+        if not others:
+            target.each = None if parsed_destination.key is None else ('list' if isinstance(parsed_destination.key, int) else 'map')
+        for instance in instances:
+            data = dict(instance.to_dict())
+            data.pop('index_key', None)
+            if parsed_destination.key is not None:
+                data = dict({'index_key': parsed_destination.key}, **data)
+            instance.resource = target
+            instance.index_key = parsed_destination.key
+            instance._data = data
+            target.instances.append(instance)
+
+    def to_data(self):
+        """
+        :return: content of the state after the operations, with the next serial and the same lineage
+        """
+        data = dict(self.data)
+        data['serial'] = self.data.get('serial', 0) + 1
+        data['resources'] = [resource.to_dict() for resource in self.resources]
+        return data
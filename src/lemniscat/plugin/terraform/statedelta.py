@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# above is for compatibility of python2.7.11
+
+import hashlib
+import json
+import logging
+
+from lemniscat.core.util.helpers import LogUtil
+
+logging.setLoggerClass(LogUtil)
+log = logging.getLogger(__name__.replace('lemniscat.', ''))
+
+KINDS = ('created', 'updated', 'replaced', 'destroyed')
+
+
+def _instance_hash(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True, separators=(',', ':'), default=str).encode('utf-8')).hexdigest()
+
+
+def snapshot(index, header=None):
+    """
+    Snapshot of the managed instances of a state
+    :param index: TfstateIndex of the state
+    :param header: content of the state file (at least serial and lineage)
+    :return: dict with serial, lineage and instances: address -> (hash of the instance, id attribute)
+    """
+    header = header or {}
+    instances = {}
+    for instance in index.instances():
+        if instance.resource.mode != 'managed':
+            continue
+        address = instance.address
+        if instance.deposed is not None:
+            address = '{0} (deposed {1})'.format(address, instance.deposed)
+        data = instance.to_dict()
+        instances[address] = (_instance_hash(data), (data.get('attributes') or {}).get('id'))
+    return {'serial': header.get('serial'), 'lineage': header.get('lineage'), 'instances': instances}
+
+
+def diff(before, after):
+    """
+    Compare two snapshots of a state
+    An instance is replaced when its id changed, updated when another attribute changed.
+    :param before: snapshot before the command, None if there was no state
+    :param after: snapshot after the command, None if there is no state
+    :return: dict with serial (before, after) and the sorted addresses of each kind of change
+    """
+    before = before or {'serial': None, 'lineage': None, 'instances': {}}
+    after = after or {'serial': None, 'lineage': None, 'instances': {}}
+    delta = {'serial': [before['serial'], after['serial']]}
+    delta.update({kind: [] for kind in KINDS})
+    if before['serial'] is not None and before['serial'] == after['serial'] and before['lineage'] == after['lineage']:
+        # the state wasn't written
+        return delta
+    old = before['instances']
+    new = after['instances']
+    for address, (digest, instance_id) in new.items():
+        previous = old.get(address)
+        if previous is None:
+            delta['created'].append(address)
+        elif previous[0] != digest:
+            delta['replaced' if previous[1] != instance_id else 'updated'].append(address)
+    delta['destroyed'] = [address for address in old if address not in new]
+    for kind in KINDS:
+        delta[kind].sort()
+    return delta
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# above is for compatibility of python2.7.11
+
+import hashlib
+import logging
+import os
+import random
+import re
+import tempfile
+
+from lemniscat.core.util.helpers import LogUtil
+from lemniscat.plugin.terraform.filelock import FileLock
+
+logging.setLoggerClass(LogUtil)
+log = logging.getLogger(__name__.replace('lemniscat.', ''))
+
+DEFAULT_LOCK_DIR = os.path.join(tempfile.gettempdir(), 'lemniscat-terraform-locks')
+
+# commands locking the state, they accept -lock-timeout
+LOCKING_COMMANDS = ('plan', 'apply', 'destroy', 'import', 'refresh', 'taint', 'untaint',
+                    'state mv', 'state rm', 'state push', 'state replace-provider')
+
+_REGEX_LOCK_ERROR = re.compile(r'Error acquiring the state lock|Error locking state|state blob is already locked')
+
+
+def is_locking(cmd):
+    """
+    :param cmd: command and sub-command of terraform, seperated with space
+    :return: True if the command locks the state
+    """
+    return ' '.join(cmd.split()[:2]) in LOCKING_COMMANDS or cmd.split()[0] in LOCKING_COMMANDS
+
+
+def is_lock_error(*texts):
+    """
+    :param texts: stderr of a command, error messages...
+    :return: True if the command failed because the state is locked by someone else
+    """
+    return any(text and _REGEX_LOCK_ERROR.search(text) for text in texts)
+
+
+def retry_delay(attempt, base_delay, max_delay):
+    """
+    exponential backoff with full jitter, so that the waiting pipelines don't retry at the same time
+    :param attempt: number of the retry, from 0
+    :param base_delay: maximum delay of the first retry in seconds
+    :param max_delay: maximum delay in seconds
+    :return: delay in seconds
+    """
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+def local_lock(key, lock_dir=DEFAULT_LOCK_DIR):
+    """
+    lock shared by the processes of the host running commands on the same state
+    :param key: identifier of the state (backend, container, key, workspace...)
+    :param lock_dir: folder of the lock files
+    :return: FileLock
+    """
+    name = hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+    return FileLock(os.path.join(lock_dir, '{0}.lock'.format(name)))
@@ -5,12 +5,32 @@ import os
 import sys
 import json
 import logging
+import re
 import tempfile
-import threading
+import time
+import uuid
+from contextlib import nullcontext
+from functools import partial, wraps
 from typing import Optional
-from threading  import Thread
-from queue import Queue, Empty
-from lemniscat.plugin.terraform.tfstate import Tfstate
+from lemniscat.plugin.terraform.tfstate import Tfstate, TfstateIndex
+from lemniscat.plugin.terraform.pump import StreamPump, STDOUT, STDERR
+from lemniscat.plugin.terraform import binaries
+from lemniscat.plugin.terraform.environment import EnvOverlay
+from lemniscat.plugin.terraform import fingerprint
+from lemniscat.plugin.terraform import bulkimport
+from lemniscat.plugin.terraform import planrecord
+from lemniscat.plugin.terraform import statedelta
+from lemniscat.plugin.terraform.statebatch import StateBatch, StateOperationError
+from lemniscat.plugin.terraform import statelock
+from lemniscat.plugin.terraform import processes
+from lemniscat.plugin.terraform.filelock import FileLock
+from lemniscat.plugin.terraform.parallelism import TUNED_COMMANDS, is_throttle
+from lemniscat.plugin.terraform.plugincache import PluginCache
+from lemniscat.plugin.terraform.plancache import PlanCache
+from lemniscat.plugin.terraform import plancache
+from lemniscat.plugin.terraform.jsonui import JsonUiParser
+from lemniscat.plugin.terraform.capture import BoundedCapture
+from lemniscat.plugin.terraform.metrics import wait_rusage
 
 from lemniscat.core.util.helpers import LogUtil
 from lemniscat.core.model.models import VariableValue
@@ -24,17 +44,16 @@ except ImportError:
             pass
 
 
-def enqueue_stream(stream, queue, type):
-    for line in iter(stream.readline, b''):
-        queue.put(str(type) + line.decode('utf-8').rstrip('\r\n'))
-
-def enqueue_process(process, queue):
-    process.wait()
-    queue.put('x')
-
 logging.setLoggerClass(LogUtil)
 log = logging.getLogger(__name__.replace('lemniscat.', ''))
 
+# commands that never change the state file
+READ_ONLY_COMMANDS = ('version', 'output', 'show', 'validate', 'fmt', 'graph', 'providers',
+                      'workspace show', 'workspace list', 'state list', 'state show', 'state pull')
+
+_REGEX_STATE_SERIAL = re.compile(rb'"serial"\s*:\s*(\d+)')
+_REGEX_STATE_LINEAGE = re.compile(rb'"lineage"\s*:\s*"([^"]*)"')
+
 class IsFlagged:
     pass
 
@@ -49,12 +68,30 @@ class TerraformCommandError(subprocess.CalledProcessError):
       self.out = out
       self.err = err
 
+
+def _flow(method):
+    """
+    Decorator of the methods running terraform commands, written once for Terraform and AsyncTerraform.
+    The method is a generator: it yields the steps which run a command or may block (commands, locks,
+    sleeps, cache files...) as callables without arguments and receives their results.
+    Terraform runs the steps one after the other, AsyncTerraform awaits them (see _run_flow).
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        return self._run_flow(method(self, *args, **kwargs))
+    return wrapper
+
+
 class Terraform(object):
     """
     Wrapper of terraform command line tool
     https://www.terraform.io/
     """
 
+    # states loaded by all the Terraform objects of the process, by path, when not None
+    # (used by the plugin worker to keep the states loaded between the tasks)
+    shared_states = None
+
     def __init__(self, working_dir=None,
                  targets=None,
                  state=None,
@@ -63,6 +100,31 @@ class Terraform(object):
                  var_file=None,
                  terraform_bin_path=None,
                  is_env_vars_included=True, 
+                 plugin_cache_dir=None,
+                 plugin_cache_max_size=None,
+                 lazy_state=False,
+                 capture_max_lines=None,
+                 capture_max_bytes=None,
+                 capture_spill_dir=None,
+                 plan_cache_dir=None,
+                 plan_cache_max_size=None,
+                 metrics=None,
+                 log_sink=None,
+                 versions_dir=None,
+                 version_cache_file=binaries.DEFAULT_CACHE_FILE,
+                 env=None,
+                 data_dir=None,
+                 redactor=None,
+                 lock_timeout=None,
+                 lock_retries=0,
+                 lock_retry_delay=5,
+                 lock_retry_max_delay=60,
+                 state_lock_key=None,
+                 lock_dir=statelock.DEFAULT_LOCK_DIR,
+                 parallelism_tuner=None,
+                 command_timeout=None,
+                 deadline=None,
+                 kill_grace_period=processes.GRACE_PERIOD,
                  ):
         """
         :param working_dir: the folder of the working folder, if not given,
@@ -79,6 +141,54 @@ class Terraform(object):
         :param terraform_bin_path: binary path of terraform
         :type is_env_vars_included: bool
         :param is_env_vars_included: included env variables when calling terraform cmd
+        :param plugin_cache_dir: folder of the provider plugin cache shared between
+                configurations, passed as TF_PLUGIN_CACHE_DIR
+        :param plugin_cache_max_size: maximum size in bytes of the plugin cache,
+                the least recently used providers are evicted after init
+        :param lazy_state: load the state file with Tfstate lazy mode, the attributes
+                of the instances are parsed only when they are accessed
+        :param capture_max_lines: maximum number of lines of stdout/stderr kept in memory
+                by the commands whose output is logged
+        :param capture_max_bytes: maximum size of stdout/stderr kept in memory
+                by the commands whose output is logged
+        :param capture_spill_dir: folder receiving the whole stdout/stderr as gzip files
+                when lines are dropped from memory, the paths are available in output_artifacts
+        :param plan_cache_dir: folder of the plan cache, a plan saved with the 'out' option is
+                reused when the configuration, the variables, the workspace, the terraform
+                version and the state are the same as when it was stored
+        :param plan_cache_max_size: maximum size in bytes of the plan cache,
+                the least recently used plans are evicted
+        :param metrics: Metrics recording the measures of the commands, the state loading and the outputs
+        :param log_sink: LogSink receiving the lines of the commands instead of logging them one by one,
+                it can be shared by the Terraform objects of a task
+        :param versions_dir: folder of terraform versions (<version>/terraform, terraform_<version>...),
+                when terraform_bin_path isn't given, the newest version meeting the required_version
+                constraints of the configuration is used
+        :param version_cache_file: file caching the versions of the terraform binaries by path,
+                mtime and size, None to cache them in memory only
+        :param env: EnvOverlay or dict of environment variables (backend credentials, TF_* settings)
+                added to the environment of the commands, os.environ is left unchanged
+        :param data_dir: folder of the data of the configuration (TF_DATA_DIR) relative to working folder,
+                .terraform by default
+        :param redactor: Redactor masking the secrets in the logged commands, their output and the
+                logged variables, the output of the commands read by the plugin (output, state pull...)
+                isn't masked
+        :param lock_timeout: duration passed as -lock-timeout to the commands locking the state, ex. 60s
+        :param lock_retries: number of times a command is retried when the state is locked by someone else
+        :param lock_retry_delay: maximum delay in seconds before the first retry, doubled on each retry
+                (exponential backoff with jitter)
+        :param lock_retry_max_delay: maximum delay in seconds between two retries
+        :param state_lock_key: identifier of the state (backend, key, workspace...), the commands locking
+                the state wait for a lock of the host on this key, so the tasks of the host using the same
+                state queue up instead of competing for the lock of the backend
+        :param lock_dir: folder of the lock files of the host
+        :param parallelism_tuner: ParallelismTuner choosing the -parallelism of plan, apply and destroy
+                when parallelism isn't given, the runs and their throttled requests are recorded
+        :param command_timeout: maximum duration in seconds of each command
+        :param deadline: processes.Deadline of the task, shared by the Terraform objects of the task,
+                the commands still running at the deadline are stopped and the next ones aren't started
+        :param kill_grace_period: seconds left to a command to stop after SIGINT (so that terraform
+                releases the state lock) before it is killed with its process group
         """
         self.is_env_vars_included = is_env_vars_included
         self.working_dir = working_dir
@@ -86,14 +196,70 @@ class Terraform(object):
         self.targets = [] if targets is None else targets
         self.variables = dict() if variables is None else variables
         self.parallelism = parallelism
+        self.version_cache_file = version_cache_file
+        self.plugin_cache = PluginCache(plugin_cache_dir, plugin_cache_max_size) \
+            if plugin_cache_dir else None
+        self.data_dir = data_dir
+        self.env = EnvOverlay(env)
+        if data_dir:
+            self.env = self.env.union({'TF_DATA_DIR': data_dir})
+        if self.plugin_cache is not None:
+            self.env = self.env.union({'TF_PLUGIN_CACHE_DIR': self.plugin_cache.cache_dir})
+        # environment of the commands, built on first use
+        self._environ = None
         self.terraform_bin_path = terraform_bin_path \
             if terraform_bin_path else 'terraform'
+        if not terraform_bin_path and versions_dir:
+            self.terraform_bin_path, _ = binaries.resolve(working_dir, versions_dir, cache_file=version_cache_file,
+                                                           env=self.environ())
         self.var_file = var_file
-        self.temp_var_files = VariableFiles()
-
-        # store the tfstate data
-        self.tfstate = None
-        self.read_state_file(self.state)
+        self.redactor = redactor
+        self.lock_timeout = lock_timeout
+        self.lock_retries = lock_retries
+        self.lock_retry_delay = lock_retry_delay
+        self.lock_retry_max_delay = lock_retry_max_delay
+        self.state_lock_key = state_lock_key
+        self.lock_dir = lock_dir
+        # number of waits for the lock of the host and of retries after a lock error of the backend
+        self.state_lock_waits = 0
+        self.state_lock_retries = 0
+        self.parallelism_tuner = parallelism_tuner
+        # parallelism chosen by the tuner for the last command, throttled requests seen in the output
+        self.tuned_parallelism = None
+        self.throttles = 0
+        self.import_results = None
+        # import blocks written by the running bulk import
+        self._imports_file = None
+        self.state_changes = None
+        self.command_timeout = command_timeout
+        self.deadline = deadline
+        self.kill_grace_period = kill_grace_period
+        self.timed_out = False
+        self.temp_var_files = VariableFiles(redactor)
+        self.init_skipped = False
+        self.apply_skipped = False
+        self.state_delta = None
+        self.plan_record = None
+        self.json_ui = None
+        self.capture_max_lines = capture_max_lines
+        self.capture_max_bytes = capture_max_bytes
+        self.capture_spill_dir = capture_spill_dir
+        self.output_artifacts = {}
+        self.plan_cache = PlanCache(plan_cache_dir, plan_cache_max_size) \
+            if plan_cache_dir else None
+        self.plan_cache_hit = None
+        self.metrics = metrics
+        self.log_sink = log_sink
+        if log_sink is not None and log_sink.logger is None:
+            log_sink.logger = log
+
+        # the tfstate data is loaded on first access of tfstate
+        self.lazy_state = lazy_state
+        self._tfstate = None
+        self._tfstate_path = None
+        self._tfstate_signature = None
+        # snapshot of the remote state, dropped by the commands changing the state
+        self._pulled_state = None
 
     def __getattr__(self, item):
         def wrapper(*args, **kwargs):
@@ -106,8 +272,9 @@ class Terraform(object):
         return wrapper
         
 
+    @_flow
     def apply(self, dir_or_plan=None, input=False, skip_plan=False, no_color=IsNotFlagged,
-              **kwargs):
+              json_ui=False, skip_noop_plan=True, state_delta=False, **kwargs):
         """
         refer to https://terraform.io/docs/commands/apply.html
         no-color is flagged by default
@@ -115,9 +282,28 @@ class Terraform(object):
         :param input: disable prompt for a missing variable
         :param dir_or_plan: folder relative to working folder
         :param skip_plan: force apply without plan (default: false)
+        :param json_ui: use the machine readable UI, the parsed events are available in json_ui
+        :param skip_noop_plan: don't run apply when dir_or_plan is a plan file recorded
+                without changes by plan and unchanged since, apply_skipped is set
+        :param state_delta: compare the state before and after apply, the created, updated,
+                replaced and destroyed instances are available in state_delta
         :param kwargs: same as kwags in method 'cmd'
         :returns return_code, stdout, stderr
         """
+        args, option_dict = self._apply_options(dir_or_plan, input, skip_plan, no_color, json_ui, kwargs)
+        if self._check_noop_plan(dir_or_plan, skip_plan, skip_noop_plan):
+            self.state_delta = statedelta.diff(None, None) if state_delta else None
+            return 0, '', ''
+        before = (yield partial(self.state_snapshot)) if state_delta else None
+        result = yield partial(self.cmd, 'apply', *args, **option_dict)
+        after = (yield partial(self.state_snapshot)) if state_delta and before is not None else None
+        self._diff_state(state_delta, before, after)
+        return result
+
+    def _apply_options(self, dir_or_plan, input, skip_plan, no_color, json_ui, kwargs):
+        """
+        :return: args, options of the apply command
+        """
         default = kwargs
         default['input'] = input
         default['no_color'] = no_color
@@ -128,9 +314,37 @@ class Terraform(object):
                 option_dict.pop('var')
             if(option_dict.keys().__contains__('var_file')):
                 option_dict.pop('var_file')
-                     
-        args = self._generate_default_args(dir_or_plan)
-        return self.cmd('apply', *args, **option_dict)
+        self._set_json_ui(option_dict, json_ui)
+        return self._generate_default_args(dir_or_plan), option_dict
+
+    def _plan_path(self, plan_file):
+        if plan_file is None or os.path.isabs(plan_file):
+            return plan_file
+        return os.path.abspath(os.path.join(self.working_dir or '.', plan_file))
+
+    def _check_noop_plan(self, dir_or_plan, skip_plan, skip_noop_plan):
+        """
+        set apply_skipped if the plan file was recorded without changes
+        :return: apply_skipped
+        """
+        self.apply_skipped = False
+        plan_path = self._plan_path(dir_or_plan)
+        if skip_noop_plan and not skip_plan and plan_path and os.path.isfile(plan_path):
+            self.plan_record = planrecord.read(plan_path)
+            if planrecord.is_noop(plan_path):
+                log.info('Terraform apply skipped: the plan has no changes')
+                self.apply_skipped = True
+        return self.apply_skipped
+
+    def _set_json_ui(self, options, json_ui):
+        """
+        add the -json option and a new JsonUiParser to the options if json_ui is True
+        """
+        self.json_ui = None
+        if json_ui:
+            self.json_ui = JsonUiParser()
+            options['json'] = IsFlagged
+            options['json_ui'] = self.json_ui
 
     def _generate_default_args(self, dir_or_plan):
         return [dir_or_plan] if dir_or_plan else []
@@ -147,34 +361,345 @@ class Terraform(object):
         option_dict.update(input_options)
         return option_dict
 
-    def destroy(self, dir_or_plan=None, force=IsFlagged, **kwargs):
+    @_flow
+    def destroy(self, dir_or_plan=None, force=IsFlagged, json_ui=False, state_delta=False, **kwargs):
         """
         refer to https://www.terraform.io/docs/commands/destroy.html
         force/no-color option is flagged by default
+        :param json_ui: use the machine readable UI, the parsed events are available in json_ui
+        :param state_delta: compare the state before and after destroy, see apply
         :return: ret_code, stdout, stderr
         """
+        args, options = self._destroy_options(dir_or_plan, force, json_ui, kwargs)
+        before = (yield partial(self.state_snapshot)) if state_delta else None
+        result = yield partial(self.cmd, 'destroy', *args, **options)
+        after = (yield partial(self.state_snapshot)) if state_delta and before is not None else None
+        self._diff_state(state_delta, before, after)
+        return result
+
+    def _destroy_options(self, dir_or_plan, force, json_ui, kwargs):
         default = kwargs
         default['auto-approve'] = force
         options = self._generate_default_options(default)
+        self._set_json_ui(options, json_ui)
         args = self._generate_default_args(dir_or_plan)
-        return self.cmd('destroy', *args, **options)
+        return args, options
+
+    @_flow
+    def bulk_import(self, mapping, batch_size=None, json_ui=False, **kwargs):
+        """
+        import existing resources with generated import blocks (terraform 1.5 or later), instead of
+        one 'terraform import' by resource, each one locking, reading and writing the state.
+        Each batch of resources is planned with its import blocks and targets, then the plan is applied.
+        When a batch fails, its resources missing in the state are imported again by halves, so that
+        a wrong id only fails its own resource. The result of each resource is read from the state
+        and available in import_results: address -> imported, failed or managed (already in the state).
+        The import blocks are written in the working folder, the imports of a configuration run one
+        at a time on the host.
+        :param mapping: dict address -> id of the resources, see bulkimport.read_mapping
+        :param batch_size: maximum number of resources imported by one plan/apply, all at once if None
+        :param json_ui: use the machine readable UI, the parsed events are available in json_ui
+        :param kwargs: options of plan
+        :return: ret_code, stdout, stderr (of the last failed batch if a resource isn't imported)
+        """
+        self.import_results = None
+        error = self._check_import_version((yield partial(self.version)))
+        if error is not None:
+            return 1, '', error
+        lock = self._import_lock()
+        yield partial(self._blocking, lock.acquire)
+        try:
+            progress = self._import_start(mapping, batch_size, (yield partial(self.state_snapshot)))
+            while progress is not None and progress['pending']:
+                batch = progress['pending'].pop(0)
+                plan_file = self._plan_path(bulkimport.PLAN_FILE)
+                try:
+                    try:
+                        self._imports_file = bulkimport.write_imports(self.working_dir, {address: mapping[address] for address in batch})
+                    except FileExistsError as e:
+                        log.error(str(e))
+                        return 1, '', str(e)
+                    result = yield partial(self.plan, out=plan_file, target=batch, json_ui=json_ui, **kwargs)
+                    result = self._check_import_plan(result)
+                    if result[0] == 0 or result[0] == 2:
+                        result = yield partial(self.apply, dir_or_plan=plan_file, json_ui=json_ui, skip_noop_plan=False)
+                finally:
+                    self._import_clean_up(self._imports_file, plan_file)
+                    self._imports_file = None
+                self._import_batch_done(progress, batch, result, (yield partial(self.state_snapshot)))
+        finally:
+            lock.release()
+        return self._import_done(progress)
+
+    @staticmethod
+    def _check_import_version(version):
+        """
+        :return: an error if the version of terraform doesn't support the import blocks, None otherwise
+        """
+        if version is not None and binaries.parse_version(version)[0] < bulkimport.MIN_VERSION:
+            return 'terraform {0} doesn\'t support the import blocks, terraform 1.5 or later is required'.format(version)
+        return None
+
+    def _import_start(self, mapping, batch_size, snapshot):
+        """
+        :param snapshot: snapshot of the state before the import
+        :return: progress of the import, None if the state can't be read
+        """
+        if snapshot is None:
+            log.error('the state can\'t be read, the resources aren\'t imported')
+            return None
+        results = {address: bulkimport.MANAGED for address in mapping if address in snapshot['instances']}
+        pending = [address for address in mapping if address not in results]
+        log.info('Import of {0} resources ({1} already in the state)'.format(len(pending), len(results)))
+        # a failure of all the batches (credentials, configuration...) stops the import
+        # after the failures needed to isolate one wrong id by halves
+        return {'results': results, 'pending': bulkimport.batches(pending, batch_size),
+                'failures': 0, 'max_failures': len(pending).bit_length() + 1, 'failed_result': None}
+
+    def _check_import_plan(self, result):
+        """
+        :param result: ret_code, stdout, stderr of the plan of a batch
+        :return: the result, or an error if the plan has other actions than the imports
+        """
+        if result[0] != 2:
+            return result
+        summary = self.plan_record['summary'] if self.plan_record is not None else None
+        if summary is None or summary['add'] > 0 or summary['change'] > 0 or summary['destroy'] > 0:
+            return 1, result[1], 'the plan of the import creates, updates or destroys resources, it isn\'t applied'
+        return result
+
+    def _import_lock(self):
+        return FileLock(os.path.join(self.working_dir or '.', '.terraform', bulkimport.LOCK_FILE))
 
-    def plan(self, dir_or_plan=None, detailed_exitcode=IsFlagged, **kwargs):
+    def _check_imports_file(self):
+        """
+        remove the import blocks left by an interrupted bulk import, they would be planned with the configuration
+        :return: an error if a bulk import of the configuration is running, None otherwise
+        """
+        file_path = os.path.join(self.working_dir or '.', bulkimport.IMPORTS_FILE)
+        if self._imports_file is not None or not os.path.exists(file_path):
+            return None
+        lock = self._import_lock()
+        if not lock.acquire(blocking=False):
+            return '{0} is used by a running import, the configuration can\'t be planned'.format(file_path)
+        try:
+            if os.path.exists(file_path):
+                log.warning('{0} left by an interrupted import is removed'.format(file_path))
+                os.unlink(file_path)
+        finally:
+            lock.release()
+        return None
+
+    @staticmethod
+    def _import_clean_up(imports_file, plan_file):
+        for file_path in (imports_file, plan_file, planrecord.record_path(plan_file)):
+            if file_path is not None and os.path.exists(file_path):
+                os.unlink(file_path)
+
+    def _import_batch_done(self, progress, batch, result, snapshot):
+        """
+        set the results of the resources of a batch, the resources of a failed batch
+        are imported again by halves
+        """
+        managed = snapshot['instances'] if snapshot is not None else {}
+        failed = [address for address in batch if address not in managed]
+        progress['results'].update({address: bulkimport.IMPORTED for address in batch if address in managed})
+        if not failed:
+            progress['failures'] = 0
+            return
+        progress['failed_result'] = result
+        progress['failures'] = progress['failures'] + 1 if len(failed) == len(batch) else 0
+        if progress['failures'] >= progress['max_failures']:
+            log.error('The import is stopped after {0} failed batches'.format(progress['failures']))
+            failed += [address for pending in progress['pending'] for address in pending]
+            progress['pending'] = []
+        elif result[0] != 0 and len(failed) > 1:
+            log.warning('{0} resources not imported, they are imported again by halves'.format(len(failed)))
+            half = (len(failed) + 1) // 2
+            progress['pending'][0:0] = [failed[:half], failed[half:]]
+            return
+        progress['results'].update({address: bulkimport.FAILED for address in failed})
+
+    def _import_done(self, progress):
+        """
+        set import_results
+        :return: ret_code, stdout, stderr of the import
+        """
+        if progress is None:
+            return 1, '', 'the state can\'t be read'
+        self.import_results = progress['results']
+        counts = {status: 0 for status in (bulkimport.IMPORTED, bulkimport.MANAGED, bulkimport.FAILED)}
+        for status in self.import_results.values():
+            counts[status] += 1
+        log.info('  Import: {imported} imported, {managed} already in the state, {failed} failed'.format(**counts))
+        if counts[bulkimport.FAILED] == 0:
+            return 0, '', ''
+        ret_code, out, err = progress['failed_result']
+        failed = [address for address, status in self.import_results.items() if status == bulkimport.FAILED]
+        return ret_code or 1, out, 'resources not imported: {0}\n{1}'.format(', '.join(failed), err or '')
+
+    @_flow
+    def state_snapshot(self) -> Optional[dict]:
+        """
+        snapshot of the managed instances of the state, read from the local state file
+        or from a pull of the remote state
+        :return: see statedelta.snapshot, None if the remote state can't be pulled
+        """
+        data = self.tfstate.native_data
+        if data and 'backend' in data:
+            data = yield partial(self.pull_state)
+            if data is None:
+                return None
+            with self._measure('state snapshot', source='pull'):
+                return statedelta.snapshot(TfstateIndex.from_data(data), data)
+        with self._measure('state snapshot', source='state'):
+            return statedelta.snapshot(self.tfstate.index, data)
+
+    def _diff_state(self, state_delta, before, after):
+        """
+        set state_delta from the snapshots of the state before and after a command
+        """
+        self.state_delta = None
+        if not state_delta:
+            return
+        if before is None or after is None:
+            log.warning('the state can\'t be read, the changed resources are unknown')
+            return
+        self.state_delta = statedelta.diff(before, after)
+
+    @_flow
+    def plan(self, dir_or_plan=None, detailed_exitcode=IsFlagged, json_ui=False, **kwargs):
         """
         refer to https://www.terraform.io/docs/commands/plan.html
+        When the plan is saved with the 'out' option, its outcome is recorded next to the
+        plan file and available in plan_record (see show_plan)
         :param detailed_exitcode: Return a detailed exit code when the command exits.
         :param dir_or_plan: relative path to plan/folder
+        :param json_ui: use the machine readable UI, the parsed events are available in json_ui
         :param kwargs: options
         :return: ret_code, stdout, stderr
         """
+        args, options = self._plan_options(dir_or_plan, detailed_exitcode, json_ui, kwargs)
+        error = self._check_imports_file()
+        if error is not None:
+            log.error(error)
+            return 1, '', error
+        plan_file = self._plan_path(options.get('out'))
+        plan_cache_key = None
+        if self._use_plan_cache(plan_file, detailed_exitcode):
+            version = yield partial(self.version)
+            state_id = yield partial(self.state_id)
+            plan_cache_key = self._plan_cache_key(args, options, version, state_id)
+            cached = yield partial(self._blocking, self._plan_cache_get, plan_cache_key, plan_file)
+            if cached is not None:
+                return cached
+
+        ret_code, out, err = yield partial(self.cmd, 'plan', *args, **options)
+        summary = None
+        if plan_file is not None and (ret_code == 0 or ret_code == 2):
+            summary = yield partial(self.show_plan, plan_file)
+        self._record_plan(plan_file, detailed_exitcode, ret_code, summary)
+        yield partial(self._blocking, self._plan_cache_put, plan_cache_key, plan_file)
+        return ret_code, out, err
+
+    def _plan_options(self, dir_or_plan, detailed_exitcode, json_ui, kwargs):
+        """
+        :return: args, options of the plan command
+        """
         options = kwargs
         options['detailed_exitcode'] = detailed_exitcode
         options = self._generate_default_options(options)
-        args = self._generate_default_args(dir_or_plan)
-        return self.cmd('plan', *args, **options)
+        self._set_json_ui(options, json_ui)
+        return self._generate_default_args(dir_or_plan), options
 
+    def _record_plan(self, plan_file, detailed_exitcode, ret_code, summary):
+        """
+        write the record of a plan, set plan_record
+        """
+        self.plan_record = None
+        if plan_file is None:
+            return
+        if summary is None or detailed_exitcode is not IsFlagged:
+            # without the detailed exit code, 0 doesn't mean there is no changes
+            planrecord.clear(plan_file)
+            return
+        self.plan_record = planrecord.write(plan_file, ret_code, summary)
+        log.info('  Plan: {add} to add, {change} to change, {destroy} to destroy'.format(**summary))
+
+    def _use_plan_cache(self, plan_file, detailed_exitcode):
+        self.plan_cache_hit = None
+        return self.plan_cache is not None and plan_file is not None and detailed_exitcode is IsFlagged
+
+    def _plan_cache_key(self, args, options, version, state_id):
+        """
+        :return: key of the plan in the plan cache, None if the version or the state is unknown
+        """
+        if version is None or state_id is None:
+            return None
+        var_files = options.get('var_file') or []
+        if not isinstance(var_files, list):
+            var_files = [var_files]
+        var_files = [os.path.join(self.working_dir or '.', var_file) for var_file in var_files]
+        other_options = {key: value for key, value in options.items()
+                         if key not in ('var', 'var_file', 'out', 'json', 'json_ui', 'no_color')}
+        other_options['args'] = args
+        return plancache.compute_key(self.working_dir, var_files, options.get('var'), other_options,
+                                     version, state_id, exclude=[options.get('out')], environ=self.environ())
+
+    def _plan_cache_get(self, key, plan_file):
+        """
+        copy the cached plan to plan_file and record it, set plan_cache_hit
+        :return: ret_code, stdout, stderr of the cached plan, None if it isn't in the cache
+        """
+        if key is None:
+            return None
+        record = self.plan_cache.get(key, plan_file)
+        self.plan_cache_hit = record is not None
+        if record is None:
+            log.info('Plan cache miss')
+            return None
+        log.info('Terraform plan read from the plan cache: nothing changed since it was stored')
+        self._record_plan(plan_file, IsFlagged, record['exit_code'], record['summary'])
+        return record['exit_code'], '', ''
+
+    def _plan_cache_put(self, key, plan_file):
+        if key is not None and self.plan_record is not None:
+            self.plan_cache.put(key, plan_file, self.plan_record)
+
+    @_flow
+    def state_id(self):
+        """
+        :return: serial and lineage of the current state, the remote state is pulled with
+                 a remote backend, None if it can't be read
+        """
+        data = self.tfstate.native_data or {}
+        if 'backend' in data:
+            data = yield partial(self.pull_state)
+            if data is None:
+                return None
+        return data.get('serial'), data.get('lineage')
+
+    @_flow
+    def show_plan(self, plan_file) -> Optional[dict]:
+        """
+        refer to https://developer.hashicorp.com/terraform/internals/json-format
+        :param plan_file: path of a plan file
+        :return: the change counts of the plan, see planrecord.summarize, None if an error occured
+        """
+        ret, out, err = yield partial(self.cmd, 'show', plan_file, json=IsFlagged, disable_logs=True)
+        return self._parse_plan(ret, out)
+
+    def _parse_plan(self, ret, out):
+        if ret != 0:
+            return None
+        try:
+            return planrecord.summarize(json.loads(out))
+        except ValueError:
+            return None
+
+    @_flow
     def init(self, dir_or_plan=None, backend_config=None,
-             reconfigure=IsFlagged, backend=True, **kwargs):
+             reconfigure=IsFlagged, backend=True, use_fingerprint=True, **kwargs):
         """
         refer to https://www.terraform.io/docs/commands/init.html
 
@@ -188,6 +713,9 @@ class Terraform(object):
                 'secret_key': 'mysecretkey', 'bucket': 'mybucketname'})
         :param reconfigure: whether or not to force reconfiguration of backend
         :param backend: whether or not to use backend settings for init
+        :param use_fingerprint: skip init when the backend config, the options, the lock file,
+                the module sources and the terraform version are unchanged
+                since the last successful init, never with the upgrade option
         :param kwargs: options
         :return: ret_code, stdout, stderr
         """
@@ -195,10 +723,89 @@ class Terraform(object):
         options['backend_config'] = backend_config
         options['reconfigure'] = reconfigure
         options['backend'] = backend
+        init_options = dict(options, dir_or_plan=dir_or_plan)
+        init_options.pop('backend_config')
         options = self._generate_default_options(options)
         args = self._generate_default_args(dir_or_plan)
-        self.cmd('version')
-        return self.cmd('init', *args, **options)
+        init_fingerprint = self._check_init_fingerprint(backend_config, use_fingerprint, (yield partial(self.version)),
+                                                        init_options)
+        if self.init_skipped:
+            return 0, '', ''
+
+        lock = self.plugin_cache.shared_lock() if self.plugin_cache is not None else None
+        if lock is not None:
+            yield partial(self._blocking, lock.acquire)
+        try:
+            ret_code, out, err = yield partial(self.cmd, 'init', *args, **options)
+        finally:
+            if lock is not None:
+                lock.release()
+
+        return self._init_done(init_fingerprint, ret_code, out, err)
+
+    def _check_init_fingerprint(self, backend_config, use_fingerprint, version, options=None):
+        """
+        compare the init fingerprint with the one of the last successful init,
+        set init_skipped if they match
+        :param options: options of init except backend_config, and dir_or_plan
+        :return: the init fingerprint, None if not used
+        """
+        self.init_skipped = False
+        if not use_fingerprint or version is None:
+            return None
+        if (options or {}).get('upgrade') not in (None, False, IsNotFlagged):
+            # the providers and the modules are upgraded on each call
+            return None
+        init_fingerprint = fingerprint.compute(self.working_dir, backend_config, version, options)
+        if fingerprint.read(self.working_dir) == init_fingerprint \
+                and fingerprint.providers_intact(self.working_dir):
+            log.info('Terraform init skipped: nothing changed since the last init')
+            self.init_skipped = True
+            if self.plugin_cache is not None:
+                self.plugin_cache.record_usage(self.working_dir)
+        return init_fingerprint
+
+    def _init_done(self, init_fingerprint, ret_code, out, err):
+        if ret_code == 0 and init_fingerprint is not None:
+            fingerprint.write(self.working_dir, init_fingerprint)
+        else:
+            fingerprint.clear(self.working_dir)
+
+        if ret_code == 0 and self.plugin_cache is not None:
+            self.plugin_cache.record_usage(self.working_dir)
+            self.plugin_cache.evict()
+        return ret_code, out, err
+
+    @_flow
+    def version(self) -> Optional[str]:
+        """
+        https://www.terraform.io/docs/commands/version.html
+
+        Note that this method does not conform to the (ret_code, out, err) return convention. To use
+        the "version" command with the standard convention, call "version_cmd" instead of
+        "version".
+
+        The version is probed once for each binary, see binaries.probe
+
+        :return: the version of the terraform binary, None if an error occured
+        """
+        version = yield partial(self._blocking, binaries.probe, self.terraform_bin_path, self.version_cache_file, self.environ())
+        if version is not None:
+            log.info(f'  Terraform v{version}')
+            return version
+        ret, out, err = yield partial(self.cmd, 'version', json=IsFlagged, disable_logs=True)
+        return self._parse_version(ret, out)
+
+    def _parse_version(self, ret, out):
+        if ret != 0:
+            return None
+        try:
+            version = json.loads(out)['terraform_version']
+        except (ValueError, KeyError):
+            # terraform < 0.13 doesn't support -json
+            version = out.strip().splitlines()[0].replace('Terraform v', '') if out.strip() else None
+        log.info(f'  Terraform v{version}')
+        return version
 
     def generate_cmd_string(self, cmd, *args, **kwargs):
         """
@@ -265,6 +872,7 @@ class Terraform(object):
         cmds += args
         return cmds
 
+    @_flow
     def cmd(self, cmd, *args, **kwargs):
         """
         run a terraform command, if success, will try to read state file
@@ -280,6 +888,8 @@ class Terraform(object):
                 if it's a flag could be used multiple times, assign list to it's value
                 if it's a "var" variable flag, assign dictionary to it
                 if a value is None, will skip this option
+                if the option 'json_ui' is passed with a JsonUiParser, each line of stdout
+                    is parsed as an event of the machine readable UI and its message is logged
                 if the option 'capture_output' is passed (with any value other than
                     True), terraform output will be printed to stdout/stderr and
                     "None" will be returned as out and err.
@@ -288,13 +898,86 @@ class Terraform(object):
                     a TerraformCommandError exception will be raised. The exception object will
                     have the following properties:
                       returncode: The command's return code
+                      cmd: The command line, with the secrets masked by the redactor
                       out: The captured stdout, or None if not captured
                       err: The captured stderr, or None if not captured
+                if the command locks the state (see statelock.LOCKING_COMMANDS), it waits for
+                    the lock of the host on state_lock_key, lock_timeout is passed as -lock-timeout
+                    and the command is retried lock_retries times while the state is locked
+                the command runs in its own process group, it's stopped at the deadline of the task
+                    or after command_timeout seconds, then ret_code is processes.TIMEOUT_RET_CODE
+                    and out, err hold the output written until then
+        :return: ret_code, out, err
+        """
+        if not statelock.is_locking(cmd) or kwargs.get('synchronous', True) is not True:
+            return (yield partial(self._run_cmd, cmd, *args, **kwargs))
+        raise_on_error = kwargs.pop('raise_on_error', False)
+        kwargs.setdefault('lock_timeout', self.lock_timeout)
+        throttles = self._tune_parallelism(cmd, kwargs)
+        lock = yield partial(self._blocking, self._acquire_local_state_lock)
+        try:
+            attempt = 0
+            while True:
+                start = time.perf_counter()
+                try:
+                    ret_code, out, err = yield partial(self._run_cmd, cmd, *args, raise_on_error=raise_on_error, **kwargs)
+                    error = None
+                except TerraformCommandError as e:
+                    # raised once the lock retries are over, with the argv of the command
+                    ret_code, out, err, error = e.returncode, e.out, e.err, e
+                wall_s = time.perf_counter() - start
+                delay = self._lock_retry_delay(ret_code, err, attempt)
+                if delay is None:
+                    break
+                yield partial(self._sleep, delay)
+                self._reset_json_ui(kwargs)
+                attempt += 1
+        finally:
+            if lock is not None:
+                lock.release()
+        if self.tuned_parallelism is not None:
+            yield partial(self._blocking, self._record_parallelism, cmd, wall_s, throttles, ret_code)
+        if error is not None:
+            raise error
+        return ret_code, out, err
+
+    def _run_flow(self, flow):
+        """
+        run the steps of a flow (see _flow) one after the other, the exception of a step is raised in the flow
+        :return: the value returned by the flow
+        """
+        result = error = None
+        while True:
+            try:
+                step = flow.send(result) if error is None else flow.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                result, error = step(), None
+            except BaseException as e:
+                result, error = None, e
+
+    @staticmethod
+    def _blocking(function, *args, **kwargs):
+        """
+        run a step of a flow which may block without running a command (file lock, cache...)
+        """
+        return function(*args, **kwargs)
+
+    @staticmethod
+    def _sleep(delay):
+        time.sleep(delay)
+
+    def _run_cmd(self, cmd, *args, **kwargs):
+        """
+        run a terraform command once, see cmd
         :return: ret_code, out, err
         """
         capture_output = kwargs.pop('capture_output', True)
         raise_on_error = kwargs.pop('raise_on_error', False)
         disable_logs = kwargs.pop('disable_logs', False)
+        synchronous = kwargs.pop('synchronous', True)
+        json_ui = kwargs.pop('json_ui', None)
         if capture_output is True:
             stderr = subprocess.PIPE
             stdout = subprocess.PIPE
@@ -302,76 +985,274 @@ class Terraform(object):
             stderr = sys.stderr
             stdout = sys.stdout
 
+        if not synchronous:
+            cmds, working_folder, environ_vars = self._prepare_cmd(cmd, *args, **kwargs)
+            p = subprocess.Popen(cmds, stdout=stdout, stderr=stderr,
+                                 cwd=working_folder, env=environ_vars)
+            return p, None, None
+
+        deadline = self._command_deadline()
+        if deadline is not None and deadline.expired():
+            return self._deadline_exceeded(cmd, *args, raise_on_error=raise_on_error, **kwargs)
+        cmds, working_folder, environ_vars = self._prepare_cmd(cmd, *args, **kwargs)
+        start = time.perf_counter()
+        options = processes.popen_options()
+        p = subprocess.Popen(cmds, stdout=stdout, stderr=stderr,
+                             cwd=working_folder, env=environ_vars, **options)
+        spawned = time.perf_counter()
+
+        pump = None
+        with processes.Supervisor(p, deadline, self.kill_grace_period, f'terraform {cmd}', group=bool(options)) as supervisor:
+            if capture_output is True:
+                buffers = self._capture_buffers(cmd) if disable_logs is False else None
+                pump = StreamPump(capture=True, buffers=buffers,
+                                  redactor=self.redactor if disable_logs is False else None)
+                if disable_logs is False or json_ui is not None:
+                    pump.handlers = self._log_handlers(json_ui, disable_logs is False)
+                try:
+                    out, err = pump.run(p)
+                finally:
+                    self._close_buffers(buffers)
+                    if self.log_sink is not None and disable_logs is False:
+                        self.log_sink.end_command()
+                rusage = pump.rusage
+            else:
+                rusage = wait_rusage(p)
+                out = None
+                err = None
+
+        if self.metrics is not None:
+            self.metrics.record_process(f'terraform {cmd}', start, spawned, pump, rusage, p.returncode,
+                                        working_dir=self.working_dir)
+        ret_code, err = self._check_timed_out(cmd, supervisor, p.returncode, err)
+        return self._cmd_done(cmds, ret_code, out, err, raise_on_error)
+
+    def _command_deadline(self):
+        """
+        :return: the Deadline of the next command (the deadline of the task or command_timeout), None if there is none
+        """
+        processes.check_interrupted()
+        command_deadline = processes.Deadline(self.command_timeout) if self.command_timeout else None
+        return processes.earliest(self.deadline, command_deadline)
+
+    def _deadline_exceeded(self, cmd, *args, **kwargs):
+        """
+        result of a command not started because the deadline of the task is exceeded
+        :param cmd, args, kwargs: the command, same as in method 'cmd'
+        :return: ret_code, out, err
+        """
+        self.timed_out = True
+        err = f'terraform {cmd} not started, the deadline of {self.deadline.timeout}s is exceeded'
+        log.error(err)
+        if kwargs.pop('raise_on_error', False):
+            for option in ('capture_output', 'disable_logs', 'synchronous', 'json_ui'):
+                kwargs.pop(option, None)
+            cmds = self.generate_cmd_string(cmd, *args, **kwargs)
+            raise TerraformCommandError(processes.TIMEOUT_RET_CODE, self._redact(' '.join(cmds)), out='', err=err)
+        return processes.TIMEOUT_RET_CODE, '', err
+
+    def _check_timed_out(self, cmd, supervisor, ret_code, err):
+        """
+        :return: ret_code, err of a finished command, TIMEOUT_RET_CODE and err completed with the
+                 timeout if it was stopped at its deadline
+        """
+        if not supervisor.timed_out:
+            return ret_code, err
+        self.timed_out = True
+        message = f'terraform {cmd} timed out after {supervisor.deadline.timeout}s'
+        return processes.TIMEOUT_RET_CODE, f'{err}\n{message}' if err else message
+
+    def _acquire_local_state_lock(self):
+        """
+        acquire the lock of the host on state_lock_key, the waits are counted in state_lock_waits
+        :return: the acquired FileLock, None if there is no state_lock_key
+        """
+        if self.state_lock_key is None:
+            return None
+        lock = statelock.local_lock(self.state_lock_key, self.lock_dir)
+        if not lock.acquire(blocking=False):
+            self.state_lock_waits += 1
+            log.info('Waiting for another task of this host using the same state...')
+            with self._measure('state lock wait'):
+                lock.acquire()
+        return lock
+
+    def _lock_retry_delay(self, ret_code, err, attempt):
+        """
+        :return: delay in seconds before retrying a command which failed on the state lock,
+                 None if the command mustn't be retried
+        """
+        if ret_code in (0, 2, processes.TIMEOUT_RET_CODE) or attempt >= self.lock_retries:
+            return None
+        errors = [d['summary'] for d in self.json_ui.errors] if self.json_ui is not None else []
+        if not statelock.is_lock_error(err, *errors):
+            return None
+        self.state_lock_retries += 1
+        delay = statelock.retry_delay(attempt, self.lock_retry_delay, self.lock_retry_max_delay)
+        log.warning('The state is locked, retry {0}/{1} in {2:.1f}s'.format(attempt + 1, self.lock_retries, delay))
+        return delay
+
+    def _tune_parallelism(self, cmd, options):
+        """
+        set the -parallelism option chosen by parallelism_tuner
+        :return: number of throttled requests before the command
+        """
+        self.tuned_parallelism = None
+        if self.parallelism_tuner is not None and cmd in TUNED_COMMANDS and options.get('parallelism') is None:
+            self.tuned_parallelism = options['parallelism'] = self.parallelism_tuner.choose(cmd)
+            log.info('Parallelism {0} chosen from the previous runs'.format(self.tuned_parallelism))
+        return self.throttles
+
+    def _record_parallelism(self, cmd, wall_s, throttles, ret_code):
+        """
+        record the run of a command with the parallelism chosen by parallelism_tuner
+        """
+        if self.tuned_parallelism is not None:
+            self.parallelism_tuner.record(cmd, self.tuned_parallelism, wall_s, self.throttles - throttles, ret_code)
+
+    def _reset_json_ui(self, options):
+        # the diagnostics of the failed attempt are dropped
+        if options.get('json_ui') is not None:
+            self.json_ui = options['json_ui'] = JsonUiParser()
+
+    def _measure(self, phase, **values):
+        """
+        measure the wall time of a block if metrics are recorded
+        """
+        if self.metrics is None:
+            return nullcontext(values)
+        return self.metrics.measure(phase, working_dir=self.working_dir, **values)
+
+    def _capture_buffers(self, cmd):
+        """
+        bounded buffers capturing stdout and stderr of a command
+        :return: dict of buffers for StreamPump, None if the capture isn't bounded
+        """
+        self.output_artifacts = {}
+        if self.capture_max_lines is None and self.capture_max_bytes is None:
+            return None
+        buffers = {}
+        for kind, name in ((STDOUT, 'stdout'), (STDERR, 'stderr')):
+            spill_path = None
+            if self.capture_spill_dir:
+                spill_path = os.path.join(self.capture_spill_dir, '{0}-{1}-{2}-{3}.log.gz'.format(
+                    cmd.replace(' ', '-'), time.strftime('%Y%m%d%H%M%S'), uuid.uuid4().hex[:8], name))
+            buffers[kind] = BoundedCapture(self.capture_max_lines, self.capture_max_bytes, spill_path)
+        return buffers
+
+    def _close_buffers(self, buffers):
+        if buffers is None:
+            return
+        for kind, name in ((STDOUT, 'stdout'), (STDERR, 'stderr')):
+            artifact = buffers[kind].close()
+            if artifact is not None:
+                self.output_artifacts[name] = artifact
+
+    def _prepare_cmd(self, cmd, *args, **kwargs):
+        """
+        build the argv, the working folder and the environment of a terraform command
+        :return: cmds, working_folder, environ_vars
+        """
         cmds = self.generate_cmd_string(cmd, *args, **kwargs)
-        log.info('command: {c}'.format(c=' '.join(cmds)))
+        log.info(self._redact('command: {c}'.format(c=' '.join(cmds))))
 
         working_folder = self.working_dir if self.working_dir else None
 
-        environ_vars = {}
-        if self.is_env_vars_included:
-            environ_vars = os.environ.copy()
+        return cmds, working_folder, self.environ()
 
-        p = subprocess.Popen(cmds, stdout=stdout, stderr=stderr,
-                             cwd=working_folder, env=environ_vars)
-         
-        synchronous = kwargs.pop('synchronous', True)
-        if not synchronous:
-            return p, None, None
+    def environ(self):
+        """
+        environment of the commands: os.environ or the base of the env overlay (if is_env_vars_included)
+        with the env overlay,
+        built once and reused by all the commands of the object
+        :return: dict of the environment, not to be modified
+        """
+        if self._environ is None:
+            self._environ = self.env.apply(None if self.is_env_vars_included else {})
+        return self._environ
 
-        if(disable_logs is False):
-            q = Queue()
-            to = threading.Thread(target=enqueue_stream, args=(p.stdout, q, 1))
-            te = threading.Thread(target=enqueue_stream, args=(p.stderr, q, 2))
-            tp = threading.Thread(target=enqueue_process, args=(p, q))
-            te.start()
-            to.start()
-            tp.start()
-            
-            while True:
-                line = q.get()
-                if line[0] == 'x':
-                    break
-                if line[0] == '2':  # stderr
-                    if(line[1:].startswith("ERROR:")):
-                        log.error(f'  {line[1:]}')
-                    else:
-                        log.warning(f'  {line[1:]}')
-                if line[0] == '1':
-                    # hide the outputs of terraform apply
-                    if(line[1:] == 'Outputs:'):
-                        disable_logs = True
-                    if(disable_logs is False):
-                        log.info(f'  {line[1:]}')
-
-            tp.join()
-            to.join()
-            te.join()
-
-        out, err = p.communicate()
-        ret_code = p.returncode
-            
+    def update_env(self, values):
+        """
+        add environment variables to the next commands, ex. a refreshed storage account key
+        :param values: dict of the environment variables
+        """
+        self.env = self.env.union(values)
+        self._environ = None
+
+    def _redact(self, text):
+        return self.redactor.redact(text) if self.redactor is not None else text
+
+    def _cmd_done(self, cmds, ret_code, out, err, raise_on_error=False):
+        """
+        post-process a finished terraform command
+        :return: ret_code, out, err
+        """
+        if not self._is_read_only(cmds):
+            self._pulled_state = None
         if ret_code == 0 or ret_code == 2:
-            self.read_state_file()   
-        else:
-            subProcessErrors = list(filter(lambda x: x != "",err.decode('utf-8').splitlines()))
+            if not self._is_read_only(cmds):
+                self._refresh_state()
+        elif err is not None:
+            subProcessErrors = list(filter(lambda x: x != "", err.splitlines()))
             log.warn('❌ Terraform error:')
             for errorLine in subProcessErrors:
                 log.warn(f'  {errorLine}')
 
         self.temp_var_files.clean_up()
-        if capture_output is True:
-            out = out.decode('utf-8')
-            err = err.decode('utf-8')
-        else:
-            out = None
-            err = None
 
         if ret_code != 0 and raise_on_error:
             raise TerraformCommandError(
-                ret_code, ' '.join(cmds), out=out, err=err)
+                ret_code, self._redact(' '.join(cmds)), out=out, err=err)
 
         return ret_code, out, err
 
+    def _log_handlers(self, json_ui=None, log_lines=True):
+        """
+        handlers logging the lines of stdout and stderr of a terraform command
+        :param json_ui: JsonUiParser fed with the lines of stdout
+        :param log_lines: log the lines, if False the lines are only fed to json_ui
+        :return: dict of handlers for StreamPump
+        """
+        state = {'hide': False}
+        sink = self.log_sink or log
+        count_throttles = self.parallelism_tuner is not None
+
+        def on_stdout(line):
+            if count_throttles and is_throttle(line, diagnostic_only=True):
+                self.throttles += 1
+            if json_ui is not None:
+                event = json_ui.feed(line)
+                if event is not None:
+                    if log_lines and event.get('type') != 'outputs':
+                        level = event.get('@level')
+                        if level == 'error':
+                            sink.error(f'  {event.get("@message")}')
+                        elif level == 'warn':
+                            sink.warning(f'  {event.get("@message")}')
+                        else:
+                            sink.info(f'  {event.get("@message")}')
+                    return
+            if not log_lines:
+                return
+            # hide the outputs of terraform apply
+            if line == 'Outputs:':
+                state['hide'] = True
+            if not state['hide']:
+                sink.info(f'  {line}')
+
+        def on_stderr(line):
+            if count_throttles and is_throttle(line):
+                self.throttles += 1
+            if not log_lines:
+                return
+            if line.startswith("ERROR:"):
+                sink.error(f'  {line}')
+            else:
+                sink.warning(f'  {line}')
+
+        return {STDOUT: on_stdout, STDERR: on_stderr}
+
+    @_flow
     def output(self, prefix: str=None, *args, **kwargs) -> Optional[dict]:
         """
         https://www.terraform.io/docs/commands/output.html
@@ -403,8 +1284,11 @@ class Terraform(object):
         if not kwargs.get('capture_output', True) is True:
           raise ValueError('capture_output is required for this method')
 
-        ret, out, err = self.cmd('output', *args, **kwargs)
+        with self._measure('output', source='command'):
+            ret, out, err = yield partial(self.cmd, 'output', *args, **kwargs)
+            return self._parse_outputs(ret, out, prefix, name_provided, full_value)
 
+    def _parse_outputs(self, ret, out, prefix=None, name_provided=False, full_value=False):
         if ret != 0:
             return None
 
@@ -415,41 +1299,243 @@ class Terraform(object):
         if name_provided and not full_value:
             values = values['value']
 
+        return self._map_outputs(values, prefix)
+
+    @staticmethod
+    def _map_outputs(values, prefix=None):
         # append prefix to the key if prefix is provided
         outputs = {}
         if(prefix is not None):
             for key, value in values.items():
-                outputs[f'{prefix}.{key}'] = VariableValue(value['value'], value['sensitive'])
+                outputs[f'{prefix}.{key}'] = VariableValue(value['value'], value.get('sensitive', False))
         else:
             for key, value in values.items():
-                outputs[f'{key}'] = VariableValue(value['value'], value['sensitive'])
+                outputs[f'{key}'] = VariableValue(value['value'], value.get('sensitive', False))
 
         return outputs
 
-    def read_state_file(self, file_path=None):
+    @_flow
+    def state_outputs(self, prefix: str=None) -> Optional[dict]:
         """
-        read .tfstate file
-        :param file_path: relative path to working dir
-        :return: states file in dict type
+        read the outputs from the state instead of running 'terraform output'.
+        With a remote backend, the outputs are read from a snapshot of the remote state
+        (see pull_state). 'terraform output -json' is used when no state is available.
+        :param prefix: prefix of the names of the outputs
+        :return: dict of VariableValue, None if an error occured
+        """
+        start = time.perf_counter()
+        source = 'state'
+        data = self.tfstate.native_data
+        if data and 'backend' in data:
+            source = 'pull'
+            data = yield partial(self.pull_state)
+        if data is None or 'outputs' not in data:
+            log.debug('no state available, outputs are read with terraform output')
+            return (yield partial(self.output, prefix=prefix))
+        outputs = self._map_outputs(data['outputs'], prefix)
+        if self.metrics is not None:
+            self.metrics.record('output', wall_s=round(time.perf_counter() - start, 6), source=source,
+                                outputs=len(outputs), working_dir=self.working_dir)
+        return outputs
+
+    @_flow
+    def state_batch(self, operations, dry_run=False):
+        """
+        apply 'state mv' and 'state rm' operations with one pull and one push of the state,
+        instead of one process locking, pulling and pushing the state by operation.
+        The operations are applied in order on the pulled state (see statebatch.StateBatch), then
+        the state is pushed with the next serial, without -force: terraform refuses the push if
+        the lineage differs or if the state was written since the pull. If an operation fails,
+        nothing is pushed.
+        :param operations: list of operations, see statebatch.parse_operations
+        :param dry_run: only compute the changes, the state isn't pushed
+        :return: ret_code, stdout, stderr; the moved and removed instances are available in state_changes
+        """
+        self._pulled_state = None
+        batch, result = self._state_batch_changes((yield partial(self.pull_state)), operations, dry_run)
+        if result is not None:
+            return result
+        state_file = self._write_state_file(batch.to_data())
+        try:
+            return (yield partial(self.cmd, 'state push', state_file))
+        finally:
+            os.unlink(state_file)
+
+    def _state_batch_changes(self, data, operations, dry_run):
+        """
+        apply the operations on the pulled state, set state_changes
+        :return: StateBatch, result of state_batch if nothing has to be pushed
+        """
+        self.state_changes = None
+        if data is None:
+            return None, (1, '', 'the state can\'t be pulled')
+        try:
+            batch = StateBatch(data)
+            self.state_changes = batch.apply(operations)
+        except StateOperationError as e:
+            log.error(str(e))
+            return None, (1, '', str(e))
+        for change in self.state_changes:
+            if change['operation'] == 'mv':
+                log.info('  {0} -> {1}'.format(change['from'], change['to']))
+            else:
+                log.info('  {0} removed'.format(change['from']))
+        moved = len([change for change in self.state_changes if change['operation'] == 'mv'])
+        log.info('  State: {0} moved, {1} removed{2}'.format(moved, len(self.state_changes) - moved,
+                                                             ' (dry run, the state isn\'t pushed)' if dry_run else ''))
+        if dry_run or not self.state_changes:
+            return batch, (0, '', '')
+        return batch, None
+
+    @staticmethod
+    def _write_state_file(data):
+        """
+        :return: path of a temporary file (readable by the user only) with the content of a state
         """
+        with tempfile.NamedTemporaryFile('w', suffix='.tfstate', delete=False) as f:
+            json.dump(data, f)
+        return f.name
 
+    @_flow
+    def pull_state(self) -> Optional[dict]:
+        """
+        https://developer.hashicorp.com/terraform/cli/commands/state/pull
+        The snapshot is kept until a command changes the state.
+        :return: content of the remote state, None if an error occured
+        """
+        if self._pulled_state is None:
+            ret, out, err = yield partial(self.cmd, 'state pull', disable_logs=True)
+            self._pulled_state = self._parse_pulled_state(ret, out)
+        return self._pulled_state
+
+    @staticmethod
+    def _parse_pulled_state(ret, out):
+        if ret != 0:
+            return None
+        if not out.strip():
+            # no state yet
+            return {'outputs': {}}
+        try:
+            return json.loads(out)
+        except ValueError:
+            return None
+
+    @property
+    def tfstate(self) -> Tfstate:
+        """
+        content of the state file, loaded on first access and
+        reloaded after a command only if the state file changed
+        """
+        if self._tfstate is None:
+            self.read_state_file()
+        return self._tfstate
+
+    @tfstate.setter
+    def tfstate(self, value):
+        self._tfstate = value
+
+    def _state_file_path(self, file_path=None):
         working_dir = self.working_dir or ''
 
         file_path = file_path or self.state or ''
 
         if not file_path:
-            backend_path = os.path.join(file_path, '.terraform',
+            backend_path = os.path.join(file_path, self.data_dir or '.terraform',
                                         'terraform.tfstate')
 
             if os.path.exists(os.path.join(working_dir, backend_path)):
                 file_path = backend_path
             else:
+                workspace = plancache.workspace(self.working_dir, self.environ())
+                if workspace != 'default':
+                    # local state of a workspace
+                    file_path = os.path.join(file_path, 'terraform.tfstate.d', workspace)
                 file_path = os.path.join(file_path, 'terraform.tfstate')
 
-        file_path = os.path.join(working_dir, file_path)
+        return os.path.join(working_dir, file_path)
 
-        self.tfstate = Tfstate.load_file(file_path)
+    @staticmethod
+    def _state_signature(file_path):
+        """
+        signature of a state file: mtime, size, serial and lineage read from the header
+        :return: tuple, None if the file doesn't exist
+        """
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        with open(file_path, 'rb') as f:
+            header = f.read(4096)
+        serial = _REGEX_STATE_SERIAL.search(header)
+        lineage = _REGEX_STATE_LINEAGE.search(header)
+        return (stat.st_mtime_ns, stat.st_size,
+                serial.group(1) if serial else None, lineage.group(1) if lineage else None)
+
+    @staticmethod
+    def _same_state(signature, other):
+        if signature is None or other is None:
+            return signature == other
+        if signature[:2] == other[:2]:
+            return True
+        # rewritten without change of content: same serial and lineage
+        return signature[2] is not None and signature[2:] == other[2:]
+
+    @staticmethod
+    def _is_read_only(cmds):
+        return len(cmds) > 1 and (cmds[1] in READ_ONLY_COMMANDS or ' '.join(cmds[1:3]) in READ_ONLY_COMMANDS)
+
+    def _refresh_state(self):
+        """
+        forget the loaded state if the state file changed, it will be reloaded on next access
+        """
+        file_path = self._state_file_path()
+        if self._tfstate is None:
+            return
+        if file_path != self._tfstate_path or not self._same_state(self._state_signature(file_path), self._tfstate_signature):
+            log.debug('{0} changed, it will be reloaded'.format(file_path))
+            self._release_state()
 
+    def read_state_file(self, file_path=None):
+        """
+        read .tfstate file, the file isn't parsed again if it didn't change since the last read
+        :param file_path: relative path to working dir
+        :return: states file in dict type
+        """
+        file_path = self._state_file_path(file_path)
+        signature = self._state_signature(file_path)
+        if self._tfstate is not None and file_path == self._tfstate_path \
+                and self._same_state(signature, self._tfstate_signature):
+            return self._tfstate
+
+        self._release_state()
+        self._tfstate_path = file_path
+        self._tfstate_signature = signature
+        shared = Terraform.shared_states.get(file_path) if Terraform.shared_states is not None else None
+        if shared is not None and shared[0] == self.lazy_state and self._same_state(signature, shared[1]):
+            self._tfstate = shared[2]
+            return self._tfstate
+
+        with self._measure('state load', lazy=self.lazy_state) as measure:
+            self._tfstate = Tfstate.load_file(file_path, lazy=self.lazy_state)
+            measure['size'] = signature[1] if signature else 0
+        if Terraform.shared_states is not None and signature is not None:
+            if shared is not None:
+                shared[2].close()
+            Terraform.shared_states[file_path] = (self.lazy_state, signature, self._tfstate)
+        return self._tfstate
+
+    def _release_state(self):
+        """
+        forget the loaded state, its memory map is closed unless it is shared
+        """
+        if self._tfstate is None:
+            return
+        if Terraform.shared_states is None or \
+                not any(entry[2] is self._tfstate for entry in Terraform.shared_states.values()):
+            self._tfstate.close()
+        self._tfstate = None
+
+    @_flow
     def set_workspace(self, workspace):
         """
         set workspace
@@ -457,8 +1543,9 @@ class Terraform(object):
         :return: status
         """
 
-        return self.cmd('workspace' ,'select', workspace)
+        return (yield partial(self.cmd, 'workspace', 'select', workspace))
 
+    @_flow
     def create_workspace(self, workspace):
         """
         create workspace
@@ -466,8 +1553,9 @@ class Terraform(object):
         :return: status
         """
 
-        return self.cmd('workspace', 'new', workspace)     
+        return (yield partial(self.cmd, 'workspace', 'new', workspace))
 
+    @_flow
     def delete_workspace(self, workspace):
         """
         delete workspace
@@ -475,30 +1563,52 @@ class Terraform(object):
         :return: status
         """
 
-        return self.cmd('workspace', 'delete', workspace)    
+        return (yield partial(self.cmd, 'workspace', 'delete', workspace))
+
+    @_flow
+    def select_workspace(self, workspace):
+        """
+        select a workspace, it is created if it doesn't exist
+        nothing is run if the workspace is already selected in the data dir
+        :param workspace: the desired workspace.
+        :return: ret_code, out, err
+        """
+        if plancache.workspace(self.working_dir, self.environ()) == workspace:
+            return 0, '', ''
+        ret_code, out, err = yield partial(self.cmd, 'workspace', 'select', workspace, disable_logs=True)
+        if ret_code != 0:
+            log.info('  Workspace {0} created'.format(workspace))
+            return (yield partial(self.create_workspace, workspace))
+        log.info('  Workspace {0} selected'.format(workspace))
+        return ret_code, out, err
 
+    @_flow
     def show_workspace(self):
         """
         show workspace
         :return: workspace
         """
 
-        return self.cmd('workspace', 'show')  
+        return (yield partial(self.cmd, 'workspace', 'show'))
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.temp_var_files.clean_up()
 
 
 class VariableFiles(object):
-    def __init__(self):
+    def __init__(self, redactor=None):
+        """
+        :param redactor: Redactor masking the secrets in the logged variables
+        """
         self.files = []
+        self.redactor = redactor
 
     def create(self, variables):
         with tempfile.NamedTemporaryFile('w+t', suffix='.tfvars.json', delete=False) as temp:
             log.info('{0} is created'.format(temp.name))
             self.files.append(temp)
-            log.info(
-                'variables wrote to tempfile: {0}'.format(str(variables)))
+            message = 'variables wrote to tempfile: {0}'.format(str(variables))
+            log.info(self.redactor.redact(message) if self.redactor is not None else message)
             temp.write(json.dumps(variables))
             file_name = temp.name
 
@@ -2,36 +2,378 @@
 # above is for compatibility of python2.7.11
 
 import json
+import mmap
 import os
 import logging
+import re
+import weakref
 
 from lemniscat.core.util.helpers import LogUtil
 
 logging.setLoggerClass(LogUtil)
 log = logging.getLogger(__name__.replace('lemniscat.', ''))
 
+# the lazy index scans the bytes of the state file, only the values it keeps are decoded
+_WS = re.compile(rb'[ \t\n\r]*')
+_STRING = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"')
+_SCALAR = re.compile(rb'[^,\]}\s]+')
+_TOKEN = re.compile(rb'["\[\]{}]')
+# members of the instances kept in the lazy index, the others are parsed on access
+INDEXED_INSTANCE_KEYS = ('index_key', 'schema_version', 'status', 'deposed', 'dependencies')
+
+
+class ResourceRecord(object):
+    """
+    A resource of the state (one entry of 'resources')
+    """
+    __slots__ = ('module', 'mode', 'type', 'name', 'provider', 'each', 'instances')
+
+    def __init__(self, module=None, mode='managed', type=None, name=None, provider=None, each=None):
+        self.module = module
+        self.mode = mode
+        self.type = type
+        self.name = name
+        self.provider = provider
+        self.each = each
+        self.instances = []
+
+    @property
+    def address(self):
+        address = '{0}.{1}'.format(self.type, self.name)
+        if self.mode == 'data':
+            address = 'data.' + address
+        if self.module:
+            address = '{0}.{1}'.format(self.module, address)
+        return address
+
+    def to_dict(self):
+        data = {'mode': self.mode, 'type': self.type, 'name': self.name, 'provider': self.provider}
+        if self.module:
+            data = dict({'module': self.module}, **data)
+        if self.each is not None:
+            data['each'] = self.each
+        data['instances'] = [instance.to_dict() for instance in self.instances]
+        return data
+
+
+class InstanceRecord(object):
+    """
+    An instance of a resource of the state.
+    In lazy mode, the attributes are parsed from the state file each time they are accessed.
+    """
+    __slots__ = ('resource', 'index_key', 'schema_version', 'status', 'deposed', 'dependencies', '_data', '_span', '_source')
+
+    def __init__(self, resource, index_key=None, schema_version=None, status=None, deposed=None, dependencies=None, data=None, span=None, source=None):
+        self.resource = resource
+        self.index_key = index_key
+        self.schema_version = schema_version
+        self.status = status
+        self.deposed = deposed
+        self.dependencies = dependencies
+        self._data = data
+        self._span = span
+        self._source = source
+
+    @property
+    def address(self):
+        if self.index_key is None:
+            return self.resource.address
+        return '{0}[{1}]'.format(self.resource.address, json.dumps(self.index_key, ensure_ascii=False))
+
+    def to_dict(self):
+        """
+        :return: the instance as stored in the state file
+        """
+        if self._data is not None:
+            return self._data
+        return self._source.load(self._span)
+
+    @property
+    def attributes(self):
+        return self.to_dict().get('attributes')
+
+
+class _LazySource(object):
+    """
+    Memory map of a state file, instances are parsed from their byte span
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        with open(file_path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def load(self, span):
+        return json.loads(self.mmap[span[0]:span[1]].decode('utf-8'))
+
+    def close(self):
+        self.mmap.close()
+
+
+def _skip_value(buf, idx):
+    """
+    :return: the index after the JSON value starting at idx
+    """
+    start = buf[idx:idx + 1]
+    if start == b'"':
+        return _STRING.match(buf, idx).end()
+    if start != b'{' and start != b'[':
+        return _SCALAR.match(buf, idx).end()
+    depth = 0
+    while True:
+        token = _TOKEN.search(buf, idx)
+        if token.group() == b'"':
+            idx = _STRING.match(buf, token.start()).end()
+            continue
+        idx = token.end()
+        depth += 1 if token.group() in (b'{', b'[') else -1
+        if depth == 0:
+            return idx
+
+
+def _decode_value(buf, idx):
+    """
+    :return: the JSON value starting at idx, the index after the value
+    """
+    end = _skip_value(buf, idx)
+    return json.loads(buf[idx:end].decode('utf-8')), end
+
+
+def _iter_members(buf, idx):
+    """
+    iterate on the members of the JSON object starting at idx
+    :return: generator of (key, index of the value), the consumer sends back the index after the value,
+             returns the index after the closing bracket
+    """
+    idx = _WS.match(buf, idx + 1).end()
+    if buf[idx:idx + 1] == b'}':
+        return idx + 1
+    while True:
+        key, idx = _decode_value(buf, idx)
+        idx = _WS.match(buf, idx).end() + 1  # ':'
+        idx = _WS.match(buf, idx).end()
+        idx = yield key, idx
+        idx = _WS.match(buf, idx).end()
+        if buf[idx:idx + 1] == b'}':
+            return idx + 1
+        idx = _WS.match(buf, idx + 1).end()  # ','
+
+
+def _iter_items(buf, idx):
+    """
+    iterate on the items of the JSON array starting at idx
+    :return: generator of index of the item, the consumer sends back the index after the item,
+             returns the index after the closing bracket
+    """
+    idx = _WS.match(buf, idx + 1).end()
+    if buf[idx:idx + 1] == b']':
+        return idx + 1
+    while True:
+        idx = yield idx
+        idx = _WS.match(buf, idx).end()
+        if buf[idx:idx + 1] == b']':
+            return idx + 1
+        idx = _WS.match(buf, idx + 1).end()  # ','
+
+
+def _walk(generator, consume):
+    """
+    drive a member/item generator, consume(item) returns the index after the item
+    :return: index after the closing bracket
+    """
+    try:
+        item = next(generator)
+        while True:
+            item = generator.send(consume(item))
+    except StopIteration as e:
+        return e.value
+
+
+class TfstateIndex(object):
+    """
+    Index of the resources and instances of a state,
+    by address, type, module and provider
+    """
+
+    def __init__(self):
+        self.resources = []
+        self.by_address = {}
+        self.by_instance_address = {}
+        self.by_type = {}
+        self.by_module = {}
+        self.by_provider = {}
+        self._source = None
+        self._finalizer = None
+
+    def add(self, resource):
+        self.resources.append(resource)
+        self.by_address[resource.address] = resource
+        for instance in resource.instances:
+            if instance.deposed is None:
+                self.by_instance_address[instance.address] = instance
+        self.by_type.setdefault(resource.type, []).append(resource)
+        self.by_module.setdefault(resource.module or '', []).append(resource)
+        self.by_provider.setdefault(resource.provider, []).append(resource)
+
+    def get(self, address):
+        """
+        :param address: address of a resource (ex. module.a.azurerm_resource_group.rg)
+                        or of an instance (ex. azurerm_resource_group.rg["key"])
+        :return: ResourceRecord or InstanceRecord, None if not found
+        """
+        return self.by_address.get(address) or self.by_instance_address.get(address)
+
+    def instances(self):
+        for resource in self.resources:
+            for instance in resource.instances:
+                yield instance
+
+    def __len__(self):
+        return len(self.resources)
+
+    @staticmethod
+    def _resource(data):
+        return ResourceRecord(data.get('module'), data.get('mode', 'managed'), data.get('type'),
+                              data.get('name'), data.get('provider'), data.get('each'))
+
+    @staticmethod
+    def from_data(data):
+        """
+        build the index of a parsed state
+        :param data: content of the state file
+        """
+        index = TfstateIndex()
+        if data and 'modules' in data:
+            log.warning('state format version {0} is not indexed'.format(data.get('version')))
+            return index
+        for resource_data in (data or {}).get('resources', []):
+            resource = TfstateIndex._resource(resource_data)
+            for instance_data in resource_data.get('instances', []):
+                resource.instances.append(InstanceRecord(
+                    resource, instance_data.get('index_key'), instance_data.get('schema_version'),
+                    instance_data.get('status'), instance_data.get('deposed'),
+                    instance_data.get('dependencies'), data=instance_data))
+            index.add(resource)
+        return index
+
+    @staticmethod
+    def load_lazy(file_path):
+        """
+        index a state file without keeping the attributes of its instances in memory
+        :param file_path: path of the state file
+        :return: index, header (content of the state file without 'resources')
+        """
+        source = _LazySource(file_path)
+        buf = source.mmap
+        index = TfstateIndex()
+        index._source = source
+        # the memory map is closed when the index is dropped, an open mapping prevents the replacement of the file on Windows
+        index._finalizer = weakref.finalize(index, source.close)
+        header = {}
+
+        def consume_instance_member(member):
+            key, idx = member
+            if key not in INDEXED_INSTANCE_KEYS:
+                return _skip_value(buf, idx)
+            data[key], end = _decode_value(buf, idx)
+            return end
+
+        def consume_instance(idx):
+            data.clear()
+            end = _walk(_iter_members(buf, idx), consume_instance_member)
+            resource.instances.append(InstanceRecord(
+                resource, data.get('index_key'), data.get('schema_version'),
+                data.get('status'), data.get('deposed'), data.get('dependencies'),
+                span=(idx, end), source=source))
+            return end
+
+        def consume_resource_member(member):
+            key, idx = member
+            if key == 'instances':
+                return _walk(_iter_items(buf, idx), consume_instance)
+            value, end = _decode_value(buf, idx)
+            setattr(resource, key, value)
+            return end
+
+        def consume_resource(idx):
+            nonlocal resource
+            resource = ResourceRecord()
+            end = _walk(_iter_members(buf, idx), consume_resource_member)
+            index.add(resource)
+            return end
+
+        def consume_member(member):
+            key, idx = member
+            if key == 'resources':
+                return _walk(_iter_items(buf, idx), consume_resource)
+            header[key], end = _decode_value(buf, idx)
+            return end
+
+        resource = None
+        data = {}
+        _walk(_iter_members(buf, _WS.match(buf, 0).end()), consume_member)
+        return index, header
+
+    def close(self):
+        if self._finalizer is not None:
+            self._finalizer()
+            self._finalizer = None
+        self._source = None
+
+
 class Tfstate(object):
-    
+
     def __init__(self, data=None):
         self.tfstate_file = None
         self.native_data = data
+        self._index = None
         if data:
-            self.__dict__ = data
+            self.__dict__.update(data)
+
+    def __getattr__(self, item):
+        # in lazy mode, resources are rebuilt from the index when they are accessed
+        index = self.__dict__.get('_index')
+        if item == 'resources' and index is not None and index._source is not None:
+            return [resource.to_dict() for resource in index.resources]
+        raise AttributeError(item)
+
+    @property
+    def index(self) -> TfstateIndex:
+        """
+        index of the resources and instances of the state, built on first access
+        """
+        if self._index is None:
+            self._index = TfstateIndex.from_data(self.native_data)
+        return self._index
+
+    def close(self):
+        """
+        release the memory map of the state file in lazy mode
+        """
+        if self._index is not None:
+            self._index.close()
 
     @staticmethod
-    def load_file(file_path):
+    def load_file(file_path, lazy=False):
         """
         Read the tfstate file and load its contents, parses then as JSON and put the result into the object
+        :param file_path: path of the tfstate file
+        :param lazy: index the resources without keeping the attributes of the instances in memory,
+                     they are parsed from the file when they are accessed
         """
         log.debug('read data from {0}'.format(file_path))
         if os.path.exists(file_path):
-            with open(file_path) as f:
-                json_data = json.load(f)
-
-            tf_state = Tfstate(json_data)
+            if lazy and os.path.getsize(file_path) > 0:
+                index, header = TfstateIndex.load_lazy(file_path)
+                tf_state = Tfstate(header)
+                tf_state._index = index
+            else:
+                with open(file_path) as f:
+                    json_data = json.load(f)
+                tf_state = Tfstate(json_data)
             tf_state.tfstate_file = file_path
             return tf_state
 
         log.debug('{0} is not exist'.format(file_path))
 
-        return Tfstate()
\ No newline at end of file
+        return Tfstate()
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+# above is for compatibility of python2.7.11
+"""
+Long running worker of the plugin, reachable over a local Unix socket.
+
+The worker keeps the Action (and its parsed manifest), the credential cache and
+the loaded states between the tasks.
+WorkerAction forwards invoke(parameters, variables) to the worker and can be used
+instead of Action.
+
+Each message is a JSON object prefixed with its length (4 bytes, big endian).
+Requests: {"op": "invoke", "parameters": {...}, "variables": {name: {"value": ..., "sensitive": ...}}, "environ": {...}},
+{"op": "ping"} and {"op": "shutdown"}.
+While a task runs, the worker sends {"log": {"name": ..., "level": ..., "message": ...}} messages,
+then {"result": {...}, "type": <TaskResult class name>, "variables": {...}} or {"error": "..."}.
+
+The worker needs Unix sockets, it isn't available on Windows.
+
+    python -m lemniscat.plugin.terraform.worker serve [--socket PATH] [--metrics-hook MODULE:FUNCTION]
+    python -m lemniscat.plugin.terraform.worker invoke -p "{...}" -v "{...}" [--socket PATH]
+"""
+
+import argparse
+import ast
+import dataclasses
+import json
+import logging
+import os
+import socket
+import struct
+import sys
+import tempfile
+
+from lemniscat.core.model.models import TaskResult, VariableValue
+from lemniscat.core.util.helpers import LogUtil
+from lemniscat.plugin.terraform.main import Action
+from lemniscat.plugin.terraform.models import TerraformTaskResult
+from lemniscat.plugin.terraform.terraform import Terraform
+
+logging.setLoggerClass(LogUtil)
+log = logging.getLogger(__name__.replace('lemniscat.', ''))
+
+_HEADER = struct.Struct('>I')
+
+
+def check_platform():
+    """
+    raise OSError if the platform doesn't support the worker
+    """
+    if not hasattr(socket, 'AF_UNIX') or not hasattr(os, 'getuid'):
+        raise OSError('the plugin worker needs Unix sockets, it isn\'t supported on {0}'.format(sys.platform))
+
+
+def default_socket_path():
+    """
+    :return: path of the socket of the worker, LEMNISCAT_TERRAFORM_WORKER_SOCKET if set
+    """
+    check_platform()
+    return os.environ.get('LEMNISCAT_TERRAFORM_WORKER_SOCKET') or \
+        os.path.join(tempfile.gettempdir(), 'lemniscat-terraform-{0}.sock'.format(os.getuid()))
+
+
+def send_message(sock, message):
+    data = json.dumps(message, default=str).encode('utf-8')
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1024 * 1024))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_message(sock):
+    """
+    :return: the next message, None if the connection is closed
+    """
+    header = _recv_exactly(sock, _HEADER.size)
+    if header is None:
+        return None
+    data = _recv_exactly(sock, _HEADER.unpack(header)[0])
+    if data is None:
+        return None
+    return json.loads(data.decode('utf-8'))
+
+
+def _encode_variables(variables):
+    return {key: {'value': value.value, 'sensitive': value.sensitive} for key, value in variables.items()}
+
+
+def _decode_variables(data):
+    return {key: VariableValue(value['value'], value['sensitive']) for key, value in data.items()}
+
+
+class _LogForwarder(logging.Handler):
+    """
+    send the log records of a task to the client
+    """
+
+    def __init__(self, sock):
+        super().__init__()
+        self.sock = sock
+
+    def emit(self, record):
+        try:
+            send_message(self.sock, {'log': {'name': record.name, 'level': record.levelno, 'message': record.getMessage()}})
+        except OSError:
+            pass
+
+
+class PluginWorker(object):
+    """
+    Run the tasks sent over a Unix socket one at a time with the same Action
+    """
+
+    def __init__(self, socket_path=None, logger=None, metrics_hook=None):
+        """
+        :param socket_path: path of the socket, see default_socket_path
+        :param logger: logger of the Action
+        :param metrics_hook: hook receiving the measures of the tasks (module:function), the hooks
+                set by the tasks are ignored: the clients mustn't load modules in the worker
+        """
+        check_platform()
+        self.socket_path = socket_path or default_socket_path()
+        self.metrics_hook = metrics_hook
+        self.logger = logger or LogUtil.create()
+        self.action = Action(self.logger)
+        # keep the states loaded between the tasks
+        if Terraform.shared_states is None:
+            Terraform.shared_states = {}
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            # the socket is only accessible by the user from its creation
+            umask = os.umask(0o177)
+            try:
+                server.bind(self.socket_path)
+            finally:
+                os.umask(umask)
+            server.listen()
+            log.info('plugin worker listening on {0}'.format(self.socket_path))
+            while True:
+                conn, _ = server.accept()
+                with conn:
+                    if not self.handle(conn):
+                        break
+        finally:
+            server.close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+        log.info('plugin worker stopped')
+
+    def handle(self, conn):
+        """
+        run the request of a connection
+        :return: False if the worker must stop
+        """
+        request = recv_message(conn)
+        if request is None:
+            return True
+        op = request.get('op')
+        if op == 'ping':
+            send_message(conn, {'result': 'pong'})
+            return True
+        if op == 'shutdown':
+            send_message(conn, {'result': 'bye'})
+            return False
+        if op != 'invoke':
+            send_message(conn, {'error': 'unknown op {0}'.format(op)})
+            return True
+
+        if not isinstance(request.get('environ'), dict):
+            send_message(conn, {'error': 'the environment of the client is missing in the request'})
+            return True
+        parameters = dict(request.get('parameters', {}))
+        variables = _decode_variables(request.get('variables', {}))
+        forwarder = _LogForwarder(conn)
+        root = logging.getLogger()
+        root.addHandler(forwarder)
+        try:
+            hooks = [parameters.pop('metricsHook', None), variables.pop('tf.metricsHook', None)]
+            if any(hook is not None for hook in hooks):
+                log.warning('metricsHook of the task is ignored by the plugin worker, it is set with --metrics-hook')
+            if self.metrics_hook is not None:
+                parameters['metricsHook'] = self.metrics_hook
+            # the task runs with the credentials and the settings of the client, not of the worker
+            self.action.base_env = request['environ']
+            result = self.action.invoke(parameters, variables)
+            response = {
+                'result': dataclasses.asdict(result),
+                'type': type(result).__name__,
+                'variables': _encode_variables(self.action.getVariables()),
+            }
+        except Exception as e:
+            log.error('task failed in the plugin worker: {0}'.format(e))
+            response = {'error': str(e)}
+        finally:
+            self.action.base_env = None
+            root.removeHandler(forwarder)
+        # log records can still be sent by other threads
+        forwarder.acquire()
+        try:
+            send_message(conn, response)
+        finally:
+            forwarder.release()
+        return True
+
+
+class WorkerAction(object):
+    """
+    Client of the plugin worker with the interface of Action
+    """
+
+    def __init__(self, logger, socket_path=None):
+        """
+        :param logger: logger of the task
+        :param socket_path: path of the socket of the worker, see default_socket_path
+        """
+        check_platform()
+        self._logger = logger
+        self.socket_path = socket_path or default_socket_path()
+        self.variables = {}
+
+    def _request(self, request):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.socket_path)
+            send_message(sock, request)
+            while True:
+                message = recv_message(sock)
+                if message is None:
+                    raise ConnectionError('the plugin worker closed the connection')
+                if 'log' in message:
+                    record = message['log']
+                    logging.getLogger(record['name']).log(record['level'], record['message'])
+                    continue
+                return message
+
+    def ping(self) -> bool:
+        """
+        :return: True if the worker is running
+        """
+        try:
+            return self._request({'op': 'ping'}).get('result') == 'pong'
+        except OSError:
+            return False
+
+    def shutdown(self):
+        self._request({'op': 'shutdown'})
+
+    def invoke(self, parameters: dict = {}, variables: dict = {}) -> TaskResult:
+        response = self._request({'op': 'invoke', 'parameters': parameters, 'variables': _encode_variables(variables),
+                                  'environ': dict(os.environ)})
+        if 'error' in response:
+            self._logger.error(f'plugin worker: {response["error"]}')
+            return TaskResult(name=f'Terraform {parameters.get("action")}', status='Failed', errors=[response['error']])
+        self.variables = _decode_variables(response['variables'])
+        result = response['result']
+        if response.get('type') == TerraformTaskResult.__name__:
+            return TerraformTaskResult(**result)
+        return TaskResult(name=result['name'], status=result['status'], errors=result['errors'])
+
+    def getVariables(self) -> dict:
+        return self.variables
+
+
+def __init_cli() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='plugin worker of lemniscat.plugin.terraform')
+    parser.add_argument('command', choices=['serve', 'invoke', 'ping', 'shutdown'])
+    parser.add_argument('--socket', help='path of the socket of the worker')
+    parser.add_argument('--metrics-hook', help='function receiving the measures of the tasks, as module:function (serve)')
+    parser.add_argument('-p', '--parameters', default='{}', help='dictionary of parameters of the task (invoke)')
+    parser.add_argument('-v', '--variables', default='{}', help='dictionary of variables of the task (invoke)')
+    return parser
+
+
+if __name__ == "__main__":
+    __cli_args = __init_cli().parse_args()
+    logger = LogUtil.create()
+    if __cli_args.command == 'serve':
+        PluginWorker(__cli_args.socket, logger, __cli_args.metrics_hook).serve_forever()
+    else:
+        client = WorkerAction(logger, __cli_args.socket)
+        if __cli_args.command == 'ping':
+            print('running' if client.ping() else 'not running')
+        elif __cli_args.command == 'shutdown':
+            client.shutdown()
+        else:
+            variables = {}
+            vars = ast.literal_eval(__cli_args.variables)
+            for key in vars:
+                variables[key] = VariableValue(vars[key])
+            print(client.invoke(ast.literal_eval(__cli_args.parameters), variables))
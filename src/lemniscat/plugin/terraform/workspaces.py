@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# above is for compatibility of python2.7.11
+
+import json
+import logging
+import os
+import shutil
+
+from lemniscat.core.util.helpers import LogUtil
+from lemniscat.plugin.terraform.filelock import FileLock
+
+logging.setLoggerClass(LogUtil)
+log = logging.getLogger(__name__.replace('lemniscat.', ''))
+
+# folders of the data dir installed by init, shared by the workspaces
+LINKED_DIRS = ('providers', 'modules')
+# backend configuration of the last init
+COPIED_FILES = ('terraform.tfstate',)
+# files linked in the data dir of a workspace by the last prepare
+LINKS_FILE = '.lemniscat.links'
+
+
+def data_dir(working_dir, workspace):
+    """
+    :param working_dir: the folder of the terraform configuration
+    :param workspace: name of the workspace
+    :return: absolute path of the data dir (TF_DATA_DIR) of the workspace
+    """
+    return os.path.abspath(os.path.join(working_dir or '.', '.terraform', 'workspaces', workspace))
+
+
+def selected_workspace(workspace_data_dir):
+    """
+    :param workspace_data_dir: data dir of a workspace
+    :return: the workspace selected in the data dir, None if none was selected
+    """
+    environment_file = os.path.join(workspace_data_dir, 'environment')
+    if not os.path.exists(environment_file):
+        return None
+    with open(environment_file) as f:
+        return f.read().strip() or None
+
+
+def _link_tree(source, target):
+    """
+    hard-link the files of source into target, files are copied when they can't be linked
+    (other file system) and symbolic links are recreated with their absolute target
+    """
+    for root, dirs, files in os.walk(source):
+        target_root = os.path.join(target, os.path.relpath(root, source))
+        os.makedirs(target_root, exist_ok=True)
+        for name in list(dirs) + files:
+            path = os.path.join(root, name)
+            target_path = os.path.join(target_root, name)
+            if os.path.islink(path):
+                # links to the plugin cache, os.walk doesn't follow them
+                os.symlink(os.path.realpath(path), target_path)
+                if name in dirs:
+                    dirs.remove(name)
+            elif name in files:
+                try:
+                    os.link(path, target_path)
+                except OSError:
+                    shutil.copy2(path, target_path)
+
+
+def _link_set(shared_dir):
+    """
+    :param shared_dir: data dir of the last init
+    :return: list of the files and links of LINKED_DIRS in shared_dir, with their inode and modification time
+    """
+    entries = []
+    for name in LINKED_DIRS:
+        for root, dirs, files in os.walk(os.path.join(shared_dir, name)):
+            for entry in sorted(dirs) + sorted(files):
+                path = os.path.join(root, entry)
+                if os.path.islink(path):
+                    entries.append([os.path.relpath(path, shared_dir), os.path.realpath(path)])
+                elif entry in files:
+                    stat = os.stat(path)
+                    entries.append([os.path.relpath(path, shared_dir), stat.st_ino, stat.st_mtime_ns])
+    return entries
+
+
+def _read_link_set(target):
+    try:
+        with open(os.path.join(target, LINKS_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def prepare(working_dir, workspace):
+    """
+    Populate the data dir of a workspace from the data dir of the last init of the
+    configuration (.terraform), instead of running init for each workspace.
+    The providers and the modules are hard-linked again when they changed since the
+    last call, the selected workspace is kept. The tasks preparing the same workspace
+    wait for each other.
+    :param working_dir: the folder of the terraform configuration
+    :param workspace: name of the workspace
+    :return: path of the data dir of the workspace
+    """
+    shared_dir = os.path.join(working_dir or '.', '.terraform')
+    target = data_dir(working_dir, workspace)
+    with FileLock(target + '.lock'):
+        os.makedirs(target, exist_ok=True)
+        link_set = _link_set(shared_dir)
+        if link_set != _read_link_set(target):
+            for name in LINKED_DIRS:
+                target_path = os.path.join(target, name)
+                if os.path.islink(target_path) or os.path.isfile(target_path):
+                    os.unlink(target_path)
+                elif os.path.isdir(target_path):
+                    shutil.rmtree(target_path)
+                if os.path.isdir(os.path.join(shared_dir, name)):
+                    _link_tree(os.path.join(shared_dir, name), target_path)
+            with open(os.path.join(target, LINKS_FILE), 'w') as f:
+                json.dump(link_set, f)
+            log.debug('providers and modules of workspace {0} linked in {1}'.format(workspace, target))
+        for name in COPIED_FILES:
+            if os.path.exists(os.path.join(shared_dir, name)):
+                shutil.copy2(os.path.join(shared_dir, name), os.path.join(target, name))
+    log.debug('data dir of workspace {0} prepared in {1}'.format(workspace, target))
+    return target